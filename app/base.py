@@ -58,9 +58,15 @@ class Umap2App(object):
         self.logger.info('Loading physical interface: %s' % phy_string)
         phy_arr = phy_string.split(':')
         phy_type = phy_arr[0]
-        self.logger.debug('Physical interface is GadgetFs')
-        phy = GadgetFsPhy(self)
-        return phy
+        if phy_type == 'gadgetfs':
+            self.logger.debug('Physical interface is GadgetFs')
+            phy = GadgetFsPhy(self)
+            return phy
+        elif phy_type == 'gadgetfs-async':
+            from phy.async_gadgetfs_phy import AsyncGadgetFsPhy
+            self.logger.debug('Physical interface is GadgetFs, asyncio')
+            phy = AsyncGadgetFsPhy(self)
+            return phy
         raise Exception('Phy type not supported: %s' % phy_type)
 
     def load_device(self, dev_name, phy):
@@ -88,6 +94,15 @@ class Umap2App(object):
         kwargs = {}
         self.update_from_user_param('--vid', 'vid', kwargs, 'int')
         self.update_from_user_param('--pid', 'pid', kwargs, 'int')
+        self.update_from_user_param('--chunk-size', 'chunk_size', kwargs, 'int')
+        self.update_from_user_param('--adaptive', 'adaptive', kwargs, 'bool')
+        self.update_from_user_param('--ramdump', 'ramdump', kwargs, 'str')
+        self.update_from_user_param('--profile', 'profile', kwargs, 'str')
+        self.update_from_user_param('--profiles', 'profiles', kwargs, 'str')
+        self.update_from_user_param('--store', 'store', kwargs, 'str')
+        self.update_from_user_param('--images', 'images', kwargs, 'str')
+        self.update_from_user_param('--storage', 'storage', kwargs, 'str')
+        self.update_from_user_param('--timeline', 'timeline', kwargs, 'str')
         return kwargs
 
     def update_from_user_param(self, flag, arg_name, kwargs, type):
@@ -96,6 +111,14 @@ class Umap2App(object):
             if type == 'int':
                 kwargs[arg_name] = int(val, 0)
                 self.logger.info('Setting user-supplied %s: %#x' % (arg_name, kwargs[arg_name]))
+            elif type == 'str':
+                kwargs[arg_name] = val
+                self.logger.info('Setting user-supplied %s: %s' % (arg_name, val))
+            elif type == 'bool':
+                # docopt reports absent flags as False
+                if val:
+                    kwargs[arg_name] = True
+                    self.logger.info('Setting user-supplied %s' % (arg_name))
             else:
                 raise Exception('arg type not supported!!')
 
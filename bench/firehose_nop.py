@@ -0,0 +1,56 @@
+'''
+Microbenchmark of the Firehose command path.
+
+<nop /> commands are pushed through :class:`FirehoseTarget` and the
+number of round trips (command in, response out) per second is
+reported, once with every command in a single packet and once with
+each command split over several small packets.
+
+Usage:
+    python -m bench.firehose_nop [ROUNDS]
+'''
+import os
+import sys
+import time
+import tempfile
+
+from qcom.firehose import FirehoseStorage, FirehoseTarget
+
+NOP = b'<?xml version="1.0" encoding="UTF-8" ?>\n<data>\n<nop /></data>'
+SPLIT_SIZE = 16
+
+
+def bench_nop(target, packets, rounds):
+    handle_data = target.handle_data
+    start = time.time()
+    for _ in range(rounds):
+        for packet in packets:
+            handle_data(packet)
+    return rounds, time.time() - start
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    fd, filename = tempfile.mkstemp()
+    os.ftruncate(fd, 0x10000)
+    os.close(fd)
+    storage = FirehoseStorage(filename)
+    responses = []
+    try:
+        target = FirehoseTarget(storage, responses.append)
+        split = [NOP[i:i + SPLIT_SIZE] for i in range(0, len(NOP), SPLIT_SIZE)]
+        whole_rounds, whole_elapsed = bench_nop(target, [NOP], rounds)
+        split_rounds, split_elapsed = bench_nop(target, split, rounds)
+    finally:
+        storage.close()
+        os.unlink(filename)
+    if len(responses) != whole_rounds + split_rounds:
+        raise Exception('Got %d responses for %d commands' % (len(responses), whole_rounds + split_rounds))
+    print('nop, one packet   : %d in %.3f s, %d round trips/s' % (whole_rounds, whole_elapsed, whole_rounds / whole_elapsed))
+    print('nop, %d packets   : %d in %.3f s, %d round trips/s' % (
+        len(split), split_rounds, split_elapsed, split_rounds / split_elapsed
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+'''
+Microbenchmark of the Sahara state machine.
+
+Command phase packets (EXECUTE requests and data reads) and image data
+packets are pushed through :class:`USBSaharaInterface` as fast as
+possible and the number of packets handled per second is reported.
+
+Usage:
+    python -m bench.sahara_dispatch [ROUNDS]
+'''
+import os
+import sys
+import struct
+import shutil
+import tempfile
+import time
+
+from dev.sahara import USBSaharaInterface
+from bench.sahara_loader import LoopbackPhy, PACKET_SIZE
+
+EXEC_CMDS = (0x1, 0x2, 0x3, 0x7)
+
+
+def bench_commands(rounds):
+    phy = LoopbackPhy()
+    iface = USBSaharaInterface(None, phy, 0)
+    iface.handle_buffer_available()
+    packets = []
+    for cmd in EXEC_CMDS:
+        packets.append(struct.pack('<III', 0xD, 0xC, cmd))
+        packets.append(struct.pack('<III', 0xF, 0xC, cmd))
+    start = time.time()
+    for _ in range(rounds):
+        for packet in packets:
+            iface.handle_data_available(packet)
+        del phy.sent[:]
+    return rounds * len(packets), time.time() - start
+
+
+def bench_data(rounds):
+    phy = LoopbackPhy()
+    iface = USBSaharaInterface(None, phy, 0)
+    iface.handle_buffer_available()
+    header = struct.pack('<IIIIIIII', 0, 0, 0, 0, 0, 0x50, 0, 0x50 + rounds * PACKET_SIZE)
+    header += b'\x00' * (0x50 - len(header))
+    packet = b'\xa5' * PACKET_SIZE
+    iface.handle_data_available(struct.pack('<IIIIII', 0x2, 0x30, 2, 1, 0, 0) + b'\x00' * 0x18)
+    iface.handle_data_available(header)
+    start = time.time()
+    for _ in range(rounds):
+        iface.handle_data_available(packet)
+    return rounds, time.time() - start
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        cmd_packets, cmd_elapsed = bench_commands(rounds // 8 or 1)
+        data_packets, data_elapsed = bench_data(rounds)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+    print('command packets : %d in %.3f s, %d packets/s' % (cmd_packets, cmd_elapsed, cmd_packets / cmd_elapsed))
+    print('data packets    : %d in %.3f s, %d packets/s' % (data_packets, data_elapsed, data_packets / data_elapsed))
+
+
+if __name__ == '__main__':
+    main()
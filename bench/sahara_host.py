@@ -0,0 +1,244 @@
+'''
+Sahara host simulator.
+
+Drives :class:`USBSaharaInterface` in-process through a stand-in phy
+the way a flashing tool on the other end of the cable would: HELLO in
+command mode, EXECUTE queries for the device identity, then a switch to
+image transfer mode, answering READ_DATA requests from local image
+files until the device reports the session complete.
+
+Packets/s, MB/s and the latency of every protocol phase are reported.
+
+Usage:
+    python -m bench.sahara_host [IMAGE] [PROFILE]
+
+Without IMAGE a synthetic 4 MB loader is uploaded.
+'''
+import os
+import sys
+import struct
+import binascii
+import shutil
+import tempfile
+import time
+from collections import deque, OrderedDict
+from mmap import mmap, ACCESS_READ
+
+from dev.sahara import USBSaharaInterface
+from qcom.profiles import ProfileStore, DEFAULT_PROFILES
+from bench.sahara_loader import LoopbackPhy, PACKET_SIZE, build_elf_loader
+
+SAHARA_HELLO_REQ = 0x1
+SAHARA_HELLO_RSP = 0x2
+SAHARA_READ_DATA = 0x3
+SAHARA_END_TRANSFER = 0x4
+SAHARA_DONE_REQ = 0x5
+SAHARA_DONE_RSP = 0x6
+SAHARA_CMD_READY = 0xB
+SAHARA_SWITCH_MODE = 0xC
+SAHARA_EXECUTE_REQ = 0xD
+SAHARA_EXECUTE_RSP = 0xE
+SAHARA_EXECUTE_DATA = 0xF
+SAHARA_64BIT_MEMORY_READ_DATA = 0x12
+
+SAHARA_MODE_IMAGE_TX_PENDING = 0x0
+SAHARA_MODE_IMAGE_TX_COMPLETE = 0x1
+SAHARA_MODE_COMMAND = 0x3
+
+EXECUTE_CMDS = OrderedDict([
+    (0x1, 'serial'),
+    (0x2, 'hwid'),
+    (0x3, 'pkhash'),
+    (0x7, 'sblversion'),
+])
+
+HELLO_RSP_PKT = struct.Struct('<IIIIII24x')
+SWITCH_MODE_PKT = struct.Struct('<III')
+EXECUTE_PKT = struct.Struct('<III')
+DONE_REQ_PKT = struct.Struct('<II')
+
+
+class SaharaHost(object):
+    '''
+    The host side of a Sahara session
+
+    :param iface: :class:`USBSaharaInterface` to talk to
+    :param phy: phy of the interface, collecting what it sends in ``sent``
+    :param images: dict of image id -> filename to upload
+    '''
+
+    def __init__(self, iface, phy, images):
+        self.iface = iface
+        self.phy = phy
+        self.images = {}
+        for image_id, filename in images.items():
+            with open(filename, 'rb') as f:
+                self.images[image_id] = mmap(f.fileno(), 0, access=ACCESS_READ)
+        self.pending = deque()
+        # phase -> latencies in seconds
+        self.latencies = OrderedDict()
+        self.execute_data = {}
+        self.packets = 0
+        self.moved = 0
+        self.elapsed = 0
+
+    def _collect(self):
+        sent, self.phy.sent = self.phy.sent, []
+        self.pending.extend(sent)
+
+    def _send(self, packet):
+        self.iface.handle_data_available(packet)
+        self.packets += 1
+
+    def _timed(self, phase, packet, expect):
+        '''
+        Send a packet and wait for the device to answer with an opcode
+
+        :return: the answer
+        '''
+        start = time.time()
+        self._send(packet)
+        self._collect()
+        self.latencies.setdefault(phase, []).append(time.time() - start)
+        return self._expect(expect)
+
+    def _expect(self, opcode):
+        if not self.pending:
+            raise Exception('Device did not answer, expected %#x' % opcode)
+        packet = self.pending.popleft()
+        got = struct.unpack_from('<I', packet)[0]
+        if got != opcode:
+            raise Exception('Expected %#x from the device, got %#x' % (opcode, got))
+        return packet
+
+    def run(self):
+        start = time.time()
+        self.iface.handle_buffer_available()
+        self._collect()
+        self.latencies['enumeration'] = [time.time() - start]
+        self._expect(SAHARA_HELLO_REQ)
+        self._timed('hello', HELLO_RSP_PKT.pack(SAHARA_HELLO_RSP, 0x30, 2, 1, 0, SAHARA_MODE_COMMAND), SAHARA_CMD_READY)
+        for cmd in EXECUTE_CMDS:
+            rsp = self._timed('execute', EXECUTE_PKT.pack(SAHARA_EXECUTE_REQ, EXECUTE_PKT.size, cmd), SAHARA_EXECUTE_RSP)
+            size = struct.unpack_from('<IIII', rsp)[3]
+            if size:
+                self.execute_data[cmd] = self._execute_data(cmd)
+        self._timed(
+            'switch_mode', SWITCH_MODE_PKT.pack(SAHARA_SWITCH_MODE, SWITCH_MODE_PKT.size, SAHARA_MODE_IMAGE_TX_PENDING),
+            SAHARA_HELLO_REQ
+        )
+        first = time.time()
+        self._send(HELLO_RSP_PKT.pack(SAHARA_HELLO_RSP, 0x30, 2, 1, 0, SAHARA_MODE_IMAGE_TX_PENDING))
+        self._collect()
+        self.latencies['hello_rsp'] = [time.time() - first]
+        self._transfer()
+        self.elapsed = time.time() - start
+
+    def _execute_data(self, cmd):
+        '''
+        :return: the raw response data of a client command
+        '''
+        start = time.time()
+        self._send(EXECUTE_PKT.pack(SAHARA_EXECUTE_DATA, EXECUTE_PKT.size, cmd))
+        self._collect()
+        self.latencies.setdefault('execute_data', []).append(time.time() - start)
+        if not self.pending:
+            raise Exception('Device sent no data for client command %#x' % cmd)
+        return self.pending.popleft()
+
+    def _transfer(self):
+        '''
+        Serve READ_DATA requests until the device says it is done
+        '''
+        while True:
+            if not self.pending:
+                raise Exception('Device stopped sending requests')
+            packet = self.pending.popleft()
+            opcode = struct.unpack_from('<I', packet)[0]
+            if opcode == SAHARA_READ_DATA:
+                _, _, image_id, offset, length = struct.unpack('<IIIII', packet)
+                self._read_data('read_data', image_id, offset, length)
+            elif opcode == SAHARA_64BIT_MEMORY_READ_DATA:
+                _, _, image_id, offset, length = struct.unpack('<IIQQQ', packet)
+                self._read_data('read_data_64', image_id, offset, length)
+            elif opcode == SAHARA_END_TRANSFER:
+                status = struct.unpack_from('<IIII', packet)[3]
+                if status:
+                    raise Exception('Device ended the transfer with status %#x' % status)
+                rsp = self._timed('done', DONE_REQ_PKT.pack(SAHARA_DONE_REQ, DONE_REQ_PKT.size), SAHARA_DONE_RSP)
+                if struct.unpack_from('<III', rsp)[2] == SAHARA_MODE_IMAGE_TX_COMPLETE:
+                    return
+            else:
+                raise Exception('Unexpected opcode %#x from the device' % opcode)
+
+    def _read_data(self, phase, image_id, offset, length):
+        image = self.images.get(image_id, None)
+        if image is None:
+            raise Exception('No image %#x to upload' % image_id)
+        start = time.time()
+        end = offset + length
+        for pos in range(offset, end, PACKET_SIZE):
+            count = min(PACKET_SIZE, end - pos)
+            packet = image[pos:pos + count]
+            if len(packet) < count:
+                # reads past the end of the image are answered with zeros
+                packet += b'\x00' * (count - len(packet))
+            self._send(packet)
+        self._collect()
+        self.latencies.setdefault(phase, []).append(time.time() - start)
+        self.moved += length
+
+    def close(self):
+        for image in self.images.values():
+            image.close()
+
+    def report(self):
+        print('packets       : %d (%d packets/s)' % (self.packets, self.packets / self.elapsed))
+        print('bytes moved   : %#x (%.2f MB/s)' % (self.moved, self.moved / self.elapsed / 0x100000))
+        print('elapsed       : %.3f s' % self.elapsed)
+        print('%-13s   %6s %10s %10s %10s' % ('phase', 'count', 'mean us', 'min us', 'max us'))
+        for phase, latencies in self.latencies.items():
+            print('%-13s : %6d %10.1f %10.1f %10.1f' % (
+                phase, len(latencies), sum(latencies) * 1e6 / len(latencies), min(latencies) * 1e6, max(latencies) * 1e6
+            ))
+
+
+def main():
+    workdir = tempfile.mkdtemp()
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    else:
+        filename = os.path.join(workdir, 'loader.elf')
+        with open(filename, 'wb') as f:
+            f.write(build_elf_loader(4 * 0x100000))
+    store = ProfileStore(DEFAULT_PROFILES)
+    profile = store.find(sys.argv[2] if len(sys.argv) > 2 else 0)
+    store.close()
+    phy = LoopbackPhy()
+    iface = USBSaharaInterface(None, phy, 0, profile=profile, output_dir=workdir)
+    host = SaharaHost(iface, phy, {0xD: filename})
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        host.run()
+        with open(filename, 'rb') as f, open(iface.captures[0][0], 'rb') as capture:
+            ok = f.read() == capture.read()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        host.close()
+        shutil.rmtree(workdir)
+    print('profile       : %s' % profile)
+    print('hwid          : %s' % binascii.hexlify(host.execute_data[0x2][:8]).decode().upper())
+    host.report()
+    print('device timeline:')
+    for name, histogram in sorted(iface.timeline.histograms().items()):
+        print('%-13s : %6d %10.1f %10.1f %10.1f  %s' % (
+            name, histogram['count'], histogram['mean_us'], histogram['min_us'], histogram['max_us'],
+            ' '.join('<%d:%d' % (bound, count) for (bound, count) in histogram['buckets'])
+        ))
+    print('capture intact: %s' % ok)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+'''
+Benchmark the Sahara loader download path without USB hardware.
+
+A synthetic ELF loader is served to :class:`USBSaharaInterface` in
+512 byte packets, the way the GadgetFS OUT endpoint hands them up,
+and the achieved throughput and peak RSS are reported.
+
+Usage:
+    python -m bench.sahara_loader [SIZE_MB] [CHUNK_SIZE|adaptive]
+'''
+import os
+import sys
+import struct
+import shutil
+import tempfile
+import time
+import hashlib
+import resource
+
+from dev.sahara import USBSaharaInterface
+
+PACKET_SIZE = 0x200
+
+
+def build_elf_loader(size):
+    '''
+    Build an ELF64 image laid out like a signed loader: program header
+    and hash segments followed by two PT_LOAD segments, with alignment
+    holes in between. The hash segment holds a v3 hash table with the
+    SHA-256 of every other segment.
+
+    :param size: total size of the image
+    :return: the image as a bytearray
+    '''
+    half = (size - 0x13000) // 2
+    segments = [
+        (0, 0x07000000, 0x0, 0x40 + 4 * 0x38),
+        (0, 0x02200000, 0x1000, 0x800),
+        (1, 0x5, 0x3000, half),
+        (1, 0x6, 0x13000 + half, size - 0x13000 - half),
+    ]
+    ehdr = struct.pack(
+        '<4sBBBBB7sHHIQQQIHHHHHH',
+        b'\x7fELF', 2, 1, 1, 0, 0, b'\x00' * 7,
+        2, 0xb7, 1, 0, 0x40, 0, 0, 0x40, 0x38, len(segments), 0, 0, 0
+    )
+    image = bytearray(size)
+    image[:len(ehdr)] = ehdr
+    block = bytearray(x & 0xff for x in range(0x100)) * 0x1000
+    for i, (p_type, p_flags, p_offset, p_filesz) in enumerate(segments):
+        phdr = struct.pack('<IIQQQQQQ', p_type, p_flags, p_offset, 0, 0, p_filesz, p_filesz, 0x1000)
+        image[0x40 + i * 0x38:0x40 + (i + 1) * 0x38] = phdr
+        if p_offset == 0:
+            continue
+        for pos in range(p_offset, p_offset + p_filesz, len(block)):
+            chunk = min(len(block), p_offset + p_filesz - pos)
+            image[pos:pos + chunk] = block[:chunk]
+    digests = b''
+    for (p_type, p_flags, p_offset, p_filesz) in segments:
+        if p_flags == 0x02200000:
+            digests += b'\x00' * 32
+        else:
+            digests += hashlib.sha256(image[p_offset:p_offset + p_filesz]).digest()
+    table = struct.pack('<10I', 0, 3, 0, 0, len(digests), len(digests), 0, 0, 0, 0) + digests
+    image[0x1000:0x1000 + len(table)] = table
+    return image
+
+
+class LoopbackPhy(object):
+    '''
+    Minimal phy that records what the device sends on its IN endpoint
+    '''
+
+    def __init__(self):
+        self.sent = []
+
+    def send_on_endpoint(self, ep_num, data, more=False):
+        self.sent.append(bytes(data))
+
+    def wakeup(self):
+        pass
+
+
+def run(image, **kwargs):
+    phy = LoopbackPhy()
+    iface = USBSaharaInterface(None, phy, 0, **kwargs)
+    iface.handle_buffer_available()
+    hello_rsp = struct.pack('<IIIIII', 0x2, 0x30, 2, 1, 0, 0) + b'\x00' * 0x18
+    packets = 0
+    reads = 0
+    moved = 0
+    start = time.time()
+    iface.handle_data_available(hello_rsp)
+    done = False
+    while not done:
+        requests, phy.sent = phy.sent, []
+        if not requests:
+            raise Exception('device stopped requesting data')
+        for req in requests:
+            cmd = struct.unpack_from('<I', req)[0]
+            if cmd == 0x3:
+                _, _, _, offset, length = struct.unpack('<IIIII', req)
+            elif cmd == 0x12:
+                _, _, _, offset, length = struct.unpack('<IIQQQ', req)
+            elif cmd == 0x4:
+                done = True
+                continue
+            else:
+                continue
+            reads += 1
+            moved += length
+            end = offset + length
+            for pos in range(offset, end, PACKET_SIZE):
+                packet = bytes(image[pos:min(pos + PACKET_SIZE, end)])
+                if len(packet) < min(PACKET_SIZE, end - pos):
+                    # reads past the end of the image are answered with zeros
+                    packet += b'\x00' * (min(PACKET_SIZE, end - pos) - len(packet))
+                iface.handle_data_available(packet)
+                packets += 1
+    verdict = iface.captures[0][2] if iface.captures else None
+    return time.time() - start, packets, reads, moved, verdict
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    kwargs = {}
+    if len(sys.argv) > 2:
+        if sys.argv[2] == 'adaptive':
+            kwargs['adaptive'] = True
+        else:
+            kwargs['chunk_size'] = int(sys.argv[2], 0)
+    image = build_elf_loader(size_mb * 0x100000)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    try:
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            elapsed, packets, requests, moved, verdict = run(image, **kwargs)
+            rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        captured = [f for f in os.listdir(workdir) if f.endswith('.bin')]
+        with open(os.path.join(workdir, captured[0]), 'rb') as f:
+            ok = f.read() == image
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+    print('loader size   : %d MB' % size_mb)
+    print('packets       : %d' % packets)
+    print('bytes moved   : %#x' % moved)
+    print('requests      : %d' % requests)
+    print('elapsed       : %.3f s' % elapsed)
+    print('throughput    : %.2f MB/s' % (len(image) / elapsed / 0x100000))
+    print('peak RSS      : %d KB (+%d KB during transfer)' % (rss_after, rss_after - rss_before))
+    print('capture intact: %s' % ok)
+    print('verdict       : %s' % verdict)
+
+
+if __name__ == '__main__':
+    main()
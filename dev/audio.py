@@ -116,6 +116,9 @@ class AudioStreaming(object):
             self.phy.send_on_endpoint(self.tx_ep, b'\x00\x00\x00\x00\x00\x00\x00\x00')
         else:
             self.phy.send_on_endpoint(self.tx_ep, self.txq.get())
+        # the stream needs a packet every interval, offer the endpoint
+        # again once this one is read
+        self.phy.wakeup()
 
     def data_available(self, data):
         self.app.logger.info('[AudioStreaming] Got %#x bytes on streaming endpoint' % (len(data)))
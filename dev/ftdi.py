@@ -141,6 +141,7 @@ class USBFtdiInterface(USBInterface):
         self.debug('received string (%d): %s' % (len(data), data))
         reply = b'\x01\x00' + data
         self.txq.put(reply)
+        self.phy.wakeup()
 
     def handle_ep3_buffer_available(self):
         if not self.txq.empty():
@@ -175,6 +175,9 @@ class USBKeyboardInterface(USBInterface):
             else:
                 letter = '\x00'
             self.type_letter(letter)
+            if self.keys:
+                # type the next key once this report is read
+                self.phy.wakeup()
 
     def type_letter(self, letter, modifiers=0):
         data = struct.pack('<BBB', 0, 0, ord(letter))
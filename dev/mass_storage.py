@@ -15,15 +15,15 @@ import os
 import struct
 from binascii import hexlify
 from threading import Thread, Event
-import time
 
-from six.moves.queue import Queue
+from six.moves.queue import Queue, Empty
 from usb.usb_device import USBDevice
 from usb.usb_configuration import USBConfiguration
 from usb.usb_interface import USBInterface
 from usb.usb_endpoint import USBEndpoint
 from usb.usb_class import USBClass
 from usb.usb_base import USBBaseActor
+from phy.tx_queue import TxQueue
 
 
 class ScsiCmds(object):
@@ -121,6 +121,10 @@ as a small disk image (extract it using `tar xvf fat32.3M.stick.img`)
         block_end = block_start + self.block_size   # slices are NON-inclusive
         return self.image[block_start:block_end]
 
+    def get_sectors_data(self, address, count):
+        block_start = address * self.block_size
+        return self.image[block_start:block_start + count * self.block_size]
+
     def put_sector_data(self, address, data):
         block_start = address * self.block_size
         block_end = (address + 1) * self.block_size   # slices are NON-inclusive
@@ -131,6 +135,16 @@ as a small disk image (extract it using `tar xvf fat32.3M.stick.img`)
         self.image.flush()
 
 
+# most data queued for the host at once by a read
+READ_CHUNK_SIZE = 0x10000
+# most data waiting for the host, reads block beyond that
+SCSI_TX_LIMIT = 4 * READ_CHUNK_SIZE
+
+CBW_SIZE = 31
+CBW_SIGNATURE = b'USBC'
+CBW_DIRECTION_IN = 0x80
+
+
 def scsi_status(cbw, status):
     csw = b'USBS' + cbw.tag + struct.pack('<IB', 0x00000000, status)
     return csw
@@ -142,8 +156,14 @@ class ScsiDevice(USBBaseActor):
     '''
     name = 'ScsiDevice'
 
-    def __init__(self, app, disk_image):
-        super(ScsiDevice, self).__init__(app, None)
+    def __init__(self, app, disk_image, phy=None, tx_limit=SCSI_TX_LIMIT):
+        '''
+        :param app: Umap2 application
+        :param disk_image: DiskImage to serve
+        :param phy: phy woken up when there is data for the host (default: None)
+        :param tx_limit: most bytes queued for the host (default: SCSI_TX_LIMIT)
+        '''
+        super(ScsiDevice, self).__init__(app, phy)
         self.disk_image = disk_image
         self.handlers = {
             ScsiCmds.INQUIRY: self.handle_inquiry,
@@ -164,6 +184,7 @@ class ScsiDevice(USBBaseActor):
             ScsiCmds.READ_CAPACITY_16: self.handle_read_capacity_16,
         }
         self.is_write_in_progress = False
+        self.tx = TxQueue(tx_limit)
         self.handle_reset()
         self.stop_event = Event()
         self.thread = Thread(target=self.handle_data_loop)
@@ -179,19 +200,36 @@ class ScsiDevice(USBBaseActor):
         self.write_base_lba = 0
         self.write_length = 0
         self.write_data = b''
-        self.tx = Queue()
+        # drops data of an aborted command, even if its handler waits for room
+        self.tx.clear()
         self.rx = Queue()
 
     def stop(self):
         self.stop_event.set()
+        self.info('Data queue: %s' % (self.tx.stats()))
+        self.tx.clear()
 
     def handle_data_loop(self):
         while not self.stop_event.isSet():
-            if not self.rx.empty():
-                data = self.rx.get()
-                self.handle_data(data)
-            else:
-                time.sleep(0.0001)
+            try:
+                data = self.rx.get(True, 0.1)
+            except Empty:
+                continue
+            self.handle_data(data)
+
+    def send(self, data, more=False):
+        '''
+        Queue data for the host and let the phy know, waiting while the
+        host is behind
+
+        :param more: more data of the same transfer follows (default: False)
+        :return: False if the queue was reset and the data dropped
+        '''
+        if not self.tx.put(data, more):
+            return False
+        if self.phy is not None:
+            self.phy.wakeup()
+        return True
 
     def handle_data(self, data):
         if self.is_write_in_progress:
@@ -203,15 +241,15 @@ class ScsiDevice(USBBaseActor):
                 try:
                     resp = self.handlers[opcode](cbw)
                     if resp is not None:
-                        self.tx.put(resp)
-                    self.tx.put(scsi_status(cbw, ScsiCmdStatus.COMMAND_PASSED))
+                        self.send(resp)
+                    self.send(scsi_status(cbw, ScsiCmdStatus.COMMAND_PASSED))
                 except Exception as ex:
                     self.warning('exception while processing opcode %#x' % (opcode))
                     self.warning(ex)
-                    self.tx.put(scsi_status(cbw, ScsiCmdStatus.COMMAND_FAILED))
+                    self.send(scsi_status(cbw, ScsiCmdStatus.COMMAND_FAILED))
             else:
                 self.error('No handler for opcode %#x, return CSW with ScsiCmdStatus.COMMAND_FAILED' % (opcode))
-                self.tx.put(scsi_status(cbw, ScsiCmdStatus.COMMAND_FAILED))
+                self.send(scsi_status(cbw, ScsiCmdStatus.COMMAND_FAILED))
 
     def handle_write_data(self, data):
         self.write_data += data
@@ -222,7 +260,7 @@ class ScsiDevice(USBBaseActor):
             self.disk_image.put_sector_data(self.write_base_lba, self.write_data)
             self.is_write_in_progress = False
             self.write_data = b''
-            self.tx.put(scsi_status(self.write_cbw, ScsiCmdStatus.COMMAND_PASSED))
+            self.send(scsi_status(self.write_cbw, ScsiCmdStatus.COMMAND_PASSED))
 
     def handle_inquiry(self, cbw):
         self.debug('SCSI Inquiry, data: %s' % hexlify(cbw.cb[1:]))
@@ -308,9 +346,14 @@ class ScsiDevice(USBBaseActor):
     def handle_read_10(self, cbw):
         base_lba, group, num_blocks = struct.unpack('>IBH', cbw.cb[2:9])
         self.debug('SCSI Read (10), lba %#x + %#x block(s)' % (base_lba, num_blocks))
-        for block_num in range(num_blocks):
-            data = self.disk_image.get_sector_data(base_lba + block_num)
-            self.tx.put(data)
+        # the data is one transfer, queued in large pieces
+        blocks_per_chunk = READ_CHUNK_SIZE // self.disk_image.block_size
+        for block_num in range(0, num_blocks, blocks_per_chunk):
+            count = min(blocks_per_chunk, num_blocks - block_num)
+            data = self.disk_image.get_sectors_data(base_lba + block_num, count)
+            if not self.send(data, more=block_num + count < num_blocks):
+                self.debug('SCSI Read (10) aborted by reset')
+                return
 
     def handle_write_6(self, cbw):
         raise NotImplementedError('yet...')
@@ -477,15 +520,30 @@ class USBMassStorageInterface(USBInterface):
             usb_class=USBMassStorageClass(app, phy, scsi_device),
         )
         self.scsi_device = scsi_device
+        self.ep_out = self.endpoints[0]
 
     def handle_buffer_available(self):
-        if not self.scsi_device.tx.empty():
-            data = self.scsi_device.tx.get()
-            self.send_on_endpoint(3, data)
+        # hand over everything queued, so the phy can merge the pieces of a transfer
+        tx = self.scsi_device.tx
+        while True:
+            try:
+                data, more = tx.get_nowait()
+            except Empty:
+                return
+            self.send_on_endpoint(3, data, more)
 
     def handle_data_available(self, data):
         self.debug('handling %d bytes of SCSI data' % (len(data)))
-        self.scsi_device.rx.put(data)
+        ep_out = self.ep_out
+        if ep_out.transfer_size:
+            ep_out.transfer_size = max(0, ep_out.transfer_size - len(data)) or None
+        elif len(data) == CBW_SIZE and data[:4] == CBW_SIGNATURE:
+            length, flags = struct.unpack_from('<IB', data, 8)
+            if length and not flags & CBW_DIRECTION_IN:
+                # the data of a write comes next, read it in large transfers
+                ep_out.transfer_size = length
+        # the SCSI thread handles the data after the read buffer is reused
+        self.scsi_device.rx.put(bytes(data))
 
 
 class USBMassStorageDevice(USBDevice):
@@ -497,7 +555,7 @@ class USBMassStorageDevice(USBDevice):
         disk_image_filename='stick.img'
     ):
         self.disk_image = DiskImage(disk_image_filename, 0x200)
-        self.scsi_device = ScsiDevice(app, self.disk_image)
+        self.scsi_device = ScsiDevice(app, self.disk_image, phy)
 
         super(USBMassStorageDevice, self).__init__(
             app=app,
@@ -2,14 +2,33 @@
 USB Class definitions for Qualcomm QDLoader 9008 Firehose
 (c) B. Kerler 2017
 
-At least set up hwid and hash.
-serial and sbversion is optional for testing.
+The device identity (hwid, pkhash, serial, sblversion, read64) comes
+from a profile store, see qcom/profiles.py. Select a profile by index,
+name, hwid, pkhash or MSM id with --profile, another store with --profiles.
 Supports extraction of firehose loaders, saves as [hwid].bin in local directory
+A list of image ids can be requested in one session, see --images.
+With a storage image the device answers Firehose commands once the
+session is complete, reading and programming the image.
+With a loader store, captures are also kept by SHA-256 and transfers of
+images the store already holds are cut short after the hash segment.
+Legacy tools sending the DIAG download command 0x3A get a DMSS download
+target, the programmer they write to memory is saved as [hwid]_dload.bin.
+With a storage image, SWITCH_TO_STREAM_DLOAD and a DMSS go lead to the
+streaming download protocol, reading and writing the image.
+Protocol events are kept in a session timeline, see --timeline.
+With a ramdump directory the device acts as a crashed phone in memory
+debug mode and serves the region files in it to the host.
 
 '''
+import os
+import re
+import bisect
 import struct
 import binascii
+import hashlib
+import json
 import time
+from mmap import mmap, ACCESS_READ
 from six.moves.queue import Queue
 from usb.usb_device import USBDevice
 from usb.usb_configuration import USBConfiguration
@@ -17,22 +36,13 @@ from usb.usb_interface import USBInterface
 from usb.usb_endpoint import USBEndpoint
 from usb.usb_vendor import USBVendor
 from usb.usb_class import USBClass
-
-#z ultra c 6833 msm8974_23_4_aid_4
-#hash = bytearray.fromhex("49109A8016C239CD8F76540FE4D5138C87B2297E49C6B30EC31852330BDDB177")
-#hwid = 0x04000100E1007B00
-#serial = 0x01678739
-#sblversion = 0x00000000
-
-#oneplus one 3t
-hash = bytearray.fromhex("c0c66e278fe81226585252b851370eabf8d4192f0f335576c3028190d49d14d4")
-serial = 0x8d3e01ed
-hwid = bytearray.fromhex("B93D702AE1F00500")
-sblversion = 0x00000002
-
-#hash = b"\xCC\x31\x53\xA8\x02\x93\x93\x9B\x90\xD0\x2D\x3B\xF8\xB2\x3E\x02\x92\xE4\x52\xFE\xF6\x62\xC7\x49\x98\x42\x1A\xDA\xD4\x2A\x38\x0F"
-#hash = bytearray.fromhex("1801000F43240892D02F0DC96313C81351B40FD5029ED98FF9EC7074DDAE8B05CDC8E1")
-#hash = bytearray.fromhex("5A93232B8EF5567752D0CB5554835215D1C473502E6F1052A78A6715B8B659AA")
+from qcom.elf import ElfHeaders, ELFCLASS32, SegmentVerifier, is_elf, image_size, fetch_ranges, merge_ranges, subtract_ranges
+from qcom.store import LoaderStore
+from qcom.firehose import FirehoseStorage, FirehoseTarget
+from qcom.dload import DmssTarget, MemoryImage
+from qcom.streaming import StreamingTarget
+from qcom.timeline import SessionTimeline, EVENT_ENUMERATED, EVENT_CMD_READY, EVENT_DONE_REQ, EVENT_DONE_RSP, EVENT_END_TRANSFER, EVENT_EXECUTE_DATA, EVENT_EXECUTE_REQ, EVENT_HELLO, EVENT_HELLO_RSP, EVENT_MEMORY_READ, EVENT_MEMORY_READ_DONE, EVENT_READ_DATA, EVENT_READ_DONE, EVENT_RESET, EVENT_SWITCH_MODE
+from qcom.profiles import DeviceProfile, ProfileStore, DEFAULT_PROFILES, EXEC_U32_DATA, EXEC_HWID_DATA, EXEC_PKHASH_DATA
 
 class USBSaharaVendor(USBVendor):
     name = 'SaharaVendor'
@@ -111,6 +121,321 @@ class USBSaharaVendor(USBVendor):
         return b'\x31\x60'
 
 
+LOADER_HEADER = struct.Struct('<IIIIIIII')
+
+
+class LoaderBuffer(object):
+    '''
+    Reassembly buffer for the headers of a loader image.
+
+    The buffer is sized from the image header as soon as it is known and
+    incoming chunks are copied into place through a memoryview, so the
+    headers are never rebuilt while they are being received.
+    '''
+
+    def __init__(self, size=0):
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def reserve(self, size):
+        '''
+        Make sure the buffer holds at least size bytes
+
+        :param size: required size in bytes
+        '''
+        if size > len(self.data):
+            data = bytearray(size)
+            data[:len(self.data)] = self.view
+            self.view.release()
+            self.data = data
+            self.view = memoryview(self.data)
+
+    def write(self, offset, data):
+        '''
+        Place a chunk of the image at the given offset
+
+        :param offset: offset of the chunk in the image
+        :param data: chunk data (any bytes-like object)
+        '''
+        end = offset + len(data)
+        self.reserve(end)
+        self.view[offset:end] = data
+
+
+class LoaderFileSink(object):
+    '''
+    Streams a loader image to disk while it is being received.
+
+    Every chunk is written at its offset with a positioned write, so the
+    image never has to be held in memory. Data goes to a temporary file
+    which is renamed to its final name once the transfer is complete;
+    an interrupted capture is left behind as the temporary file.
+    '''
+
+    def __init__(self, filename, tmpname=None):
+        '''
+        :param filename: final name of the image
+        :param tmpname: existing partial capture to continue writing to
+            (default: None, start a new one next to filename)
+        '''
+        self.filename = filename
+        if tmpname is None:
+            self.tmpname = filename + '.part'
+            self.fd = os.open(self.tmpname, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        else:
+            self.tmpname = tmpname
+            self.fd = os.open(self.tmpname, os.O_RDWR)
+
+    def write(self, offset, data):
+        '''
+        Write a chunk of the image at the given offset
+
+        :param offset: offset of the chunk in the image
+        :param data: chunk data (any bytes-like object)
+        '''
+        written = os.pwrite(self.fd, data, offset)
+        while written < len(data):
+            data = memoryview(data)[written:]
+            offset += written
+            written = os.pwrite(self.fd, data, offset)
+
+    def commit(self, size):
+        '''
+        Finish the capture and move it to its final name
+
+        :param size: real size of the image
+        '''
+        os.ftruncate(self.fd, size)
+        os.fsync(self.fd)
+        self.close()
+        os.rename(self.tmpname, self.filename)
+
+    def move(self, tmpname):
+        '''
+        Move the partial capture to another temporary name, writes go on
+        to the same file
+        '''
+        os.rename(self.tmpname, tmpname)
+        self.tmpname = tmpname
+
+    def discard(self):
+        '''
+        Drop the capture, removing the temporary file
+        '''
+        self.close()
+        os.unlink(self.tmpname)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+SAHARA_MAX_CHUNK_SIZE = 0x100000
+SAHARA_64BIT_MAX_CHUNK_SIZE = 0x1000000
+
+HELLO_PKT = struct.Struct('<IIIIII24x')
+HELLO_RSP_PKT = struct.Struct('<IIIIII')
+HELLO_RSP_SIZE = 0x30
+SWITCH_MODE_PKT = struct.Struct('<III')
+EXECUTE_PKT = struct.Struct('<III')
+EXECUTE_RSP_PKT = struct.Struct('<IIII')
+READ_DATA_PKT = struct.Struct('<IIIII')
+READ_DATA_64_PKT = struct.Struct('<IIQQQ')
+END_TRANSFER_PKT = struct.Struct('<IIII')
+CMD_READY_PKT = struct.Struct('<II')
+MEMORY_DEBUG_PKT = struct.Struct('<IIII')
+MEMORY_DEBUG_64_PKT = struct.Struct('<IIQQ')
+MEMORY_READ_PKT = struct.Struct('<IIII')
+MEMORY_READ_64_PKT = struct.Struct('<IIQQ')
+RESET_RSP_PKT = struct.Struct('<II')
+DONE_RSP_PKT = struct.Struct('<III')
+# save_pref, mem_base, length, desc, filename
+MEMORY_TABLE_ENTRY = struct.Struct('<III20s20s')
+MEMORY_TABLE_ENTRY_64 = struct.Struct('<QQQ20s20s')
+
+
+class MemoryRegion(object):
+    '''
+    A RAM dump region backed by a read-only mmap of its file
+    '''
+
+    def __init__(self, filename, base):
+        self.filename = filename
+        self.base = base
+        self.size = os.stat(filename).st_size
+        self.end = base + self.size
+        self.name = os.path.splitext(os.path.basename(filename))[0]
+        with open(filename, 'rb') as f:
+            self.image = mmap(f.fileno(), 0, access=ACCESS_READ)
+        self.view = memoryview(self.image)
+
+    def close(self):
+        self.view.release()
+        self.image.close()
+
+
+class RamDump(object):
+    '''
+    Memory of a crashed device, made of the region files in a directory.
+
+    Region addresses are taken from a load.cmm script in the directory
+    (d.load.binary lines, as written by the usual ramdump tools);
+    without one, the files are laid out one after the other from
+    default_base.
+    '''
+
+    default_base = 0x80000000
+    load_cmd = re.compile(r'd\.load\.binary\s+(\S+)\s+(0x[0-9a-f]+)', re.IGNORECASE)
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.regions = []
+        for filename, base in self._layout():
+            path = os.path.join(directory, filename)
+            if os.path.isfile(path) and os.stat(path).st_size:
+                self.regions.append(MemoryRegion(path, base))
+        if not self.regions:
+            raise Exception('No memory regions found in %s' % directory)
+        self.regions.sort(key=lambda r: r.base)
+        self.bases = [r.base for r in self.regions]
+        # the memory table lives right after the highest region
+        self.table_address = (self.regions[-1].end + 0xfff) & ~0xfff
+        self.tables = {}
+
+    def _layout(self):
+        script = os.path.join(self.directory, 'load.cmm')
+        if os.path.isfile(script):
+            with open(script, 'r') as f:
+                return [(m.group(1), int(m.group(2), 16)) for m in self.load_cmd.finditer(f.read())]
+        layout = []
+        base = self.default_base
+        for filename in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, filename)
+            if not os.path.isfile(path):
+                continue
+            layout.append((filename, base))
+            base = (base + os.stat(path).st_size + 0xfff) & ~0xfff
+        return layout
+
+    def table(self, is64=False):
+        '''
+        :param is64: build the table with 64-bit entries
+        :return: the memory debug table, as advertised to the host
+        '''
+        if is64 not in self.tables:
+            entry = MEMORY_TABLE_ENTRY_64 if is64 else MEMORY_TABLE_ENTRY
+            self.tables[is64] = b''.join(
+                entry.pack(0x1, r.base, r.size, r.name.encode()[:20], os.path.basename(r.filename).encode()[:20])
+                for r in self.regions
+            )
+        return self.tables[is64]
+
+    def read(self, address, length, is64=False):
+        '''
+        :param address: memory address
+        :param length: number of bytes to read
+        :param is64: whether the host reads the 64-bit memory table
+        :return: memoryview of the requested memory, or None if the range
+            is not backed by a single region
+        '''
+        if address >= self.table_address:
+            table = self.table(is64)
+            offset = address - self.table_address
+            if offset + length <= len(table):
+                return memoryview(table)[offset:offset + length]
+            return None
+        i = bisect.bisect_right(self.bases, address) - 1
+        if i < 0:
+            return None
+        region = self.regions[i]
+        if address + length > region.end:
+            return None
+        offset = address - region.base
+        return region.view[offset:offset + length]
+
+    def close(self):
+        for region in self.regions:
+            region.close()
+        self.regions = []
+
+
+class ChunkPlanner(object):
+    '''
+    Decides how much data every READ_DATA request of a transfer asks for.
+
+    In adaptive mode the request size is doubled for as long as the time
+    the host needs to answer a request stays flat, i.e. while the round
+    trip rather than the link dominates, up to SAHARA_MAX_CHUNK_SIZE.
+    Once several round trips in a row are slow, the size steps back to
+    the previous one, which then caps further growth.
+    '''
+
+    # latency increase that is still considered flat
+    latency_tolerance = 1.5
+    # slow round trips in a row before the request size steps back
+    slow_limit = 3
+
+    def __init__(self, chunk_size=0x1000, adaptive=False, max_chunk_size=SAHARA_MAX_CHUNK_SIZE):
+        if chunk_size <= 0 or chunk_size > max_chunk_size:
+            raise Exception('READ_DATA chunk size must be between 1 and %#x' % max_chunk_size)
+        self.chunk_size = chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.adaptive = adaptive
+        self.latency = None
+        self.slow = 0
+        # sizes the request size was doubled from, to step back to
+        self.grown_from = []
+        self.ceiling = max_chunk_size
+        self.requested = 0
+        self.sent_at = None
+
+    def plan(self, offset, end):
+        '''
+        :param offset: offset of the next request
+        :param end: end of the range being transferred
+        :return: length of the next request
+        '''
+        length = min(self.chunk_size, end - offset)
+        self.requested = length
+        self.sent_at = time.time()
+        return length
+
+    def complete(self):
+        '''
+        Account for the completion of the outstanding request
+        '''
+        if not self.adaptive or self.sent_at is None:
+            return
+        elapsed = time.time() - self.sent_at
+        self.sent_at = None
+        if self.requested < self.chunk_size:
+            # short tail requests say nothing about the link
+            return
+        if self.latency is not None and elapsed > self.latency * self.latency_tolerance:
+            # a single slow round trip may just be the host being busy
+            self.slow += 1
+            if self.slow >= self.slow_limit:
+                self._step_back()
+            return
+        self.slow = 0
+        self.latency = elapsed
+        if self.chunk_size < self.ceiling:
+            self.grown_from.append(self.chunk_size)
+            self.chunk_size = min(self.chunk_size * 2, self.ceiling)
+
+    def _step_back(self):
+        self.slow = 0
+        # measure the latency of the size we end up with afresh
+        self.latency = None
+        if self.grown_from:
+            self.chunk_size = self.grown_from.pop()
+        self.ceiling = self.chunk_size
+
+
 class USBSaharaInterface(USBInterface):
     name = 'SaharaInterface'
 
@@ -141,22 +466,170 @@ class USBSaharaInterface(USBInterface):
     SAHARA_EXEC_CMD_SWITCH_TO_STREAM_DLOAD = 0x05
     SAHARA_EXEC_CMD_READ_DEBUG_DATA = 0x06
     SAHARA_EXEC_CMD_GET_SOFTWARE_VERSION_SBL = 0x07
+
+    SAHARA_STATUS_SUCCESS = 0x00
+    SAHARA_NAK_INVALID_MEMORY_READ = 0x19
+
+    # outcome of checking a capture against its hash table segment
+    VERDICT_VERIFIED = 'verified'
+    VERDICT_UNVERIFIED = 'unverified'
+    VERDICT_CORRUPT = 'corrupt'
+    # how often segments that fail verification are fetched again
+    verify_retries = 2
+    # bytes received between two saves of the resume state
+    resume_save_interval = 0x100000
     
     SAHARA_MODE_IMAGE_TX_PENDING = 0x0
     SAHARA_MODE_IMAGE_TX_COMPLETE = 0x1
     SAHARA_MODE_MEMORY_DEBUG = 0x2
     SAHARA_MODE_COMMAND = 0x3
 
-    def __init__(self, app, phy, interface_number):
+    # first byte of a DIAG download request, sent by legacy tools
+    DIAG_DLOAD_F = 0x3A
+
+    # values of self.switch
+    STATE_COMMAND = 0
+    STATE_IMAGE_HEADER = 1
+    STATE_ELF_HEADERS = 2
+    STATE_IMAGE_DATA = 3
+    STATE_MEMORY_DEBUG = 4
+    STATE_HASH_SEGMENT = 5
+    STATE_FIREHOSE = 6
+    STATE_DMSS = 7
+    STATE_STREAMING = 8
+
+    HELLO_IMAGE_TX_PENDING = HELLO_PKT.pack(SAHARA_HELLO_REQ, HELLO_PKT.size, 0x2, 0x1, 0x400, SAHARA_MODE_IMAGE_TX_PENDING)
+    HELLO_IMAGE_TX_COMPLETE = HELLO_PKT.pack(SAHARA_HELLO_REQ, HELLO_PKT.size, 0x2, 0x1, 0x400, SAHARA_MODE_IMAGE_TX_COMPLETE)
+    HELLO_MEMORY_DEBUG = HELLO_PKT.pack(SAHARA_HELLO_REQ, HELLO_PKT.size, 0x2, 0x1, 0x400, SAHARA_MODE_MEMORY_DEBUG)
+    RESET_RSP = RESET_RSP_PKT.pack(SAHARA_RESET_RSP, RESET_RSP_PKT.size)
+    CMD_READY = CMD_READY_PKT.pack(SAHARA_CMD_READY, CMD_READY_PKT.size)
+    DONE_RSP_PENDING = DONE_RSP_PKT.pack(SAHARA_DONE_RSP, DONE_RSP_PKT.size, SAHARA_MODE_IMAGE_TX_PENDING)
+    DONE_RSP_COMPLETE = DONE_RSP_PKT.pack(SAHARA_DONE_RSP, DONE_RSP_PKT.size, SAHARA_MODE_IMAGE_TX_COMPLETE)
+
+    # client command -> size of the data returned by SAHARA_EXECUTE_DATA
+    EXECUTE_RESPONSE_SIZES = {
+        SAHARA_EXEC_CMD_SERIAL_NUM_READ: EXEC_U32_DATA.size,
+        SAHARA_EXEC_CMD_MSM_HW_ID_READ: EXEC_HWID_DATA.size,
+        SAHARA_EXEC_CMD_OEM_PK_HASH_READ: EXEC_PKHASH_DATA.size,
+        SAHARA_EXEC_CMD_GET_SOFTWARE_VERSION_SBL: EXEC_U32_DATA.size,
+        SAHARA_EXEC_CMD_SWITCH_TO_DMSS_DLOAD: 0,
+        SAHARA_EXEC_CMD_SWITCH_TO_STREAM_DLOAD: 0,
+    }
+
+    def __init__(self, app, phy, interface_number, profile=None, chunk_size=None, adaptive=False, ramdump=None, output_dir='.', store=None, images=None, storage=None):
+        '''
+        :param app: umap2 application
+        :param phy: physical connection
+        :param interface_number: interface number
+        :param profile: DeviceProfile to impersonate
+            (default: the first profile of the default store)
+        :param chunk_size: size of the READ_DATA requests
+            (default: 0x1000, 0x100000 with 64-bit reads)
+        :param adaptive: grow the request size while the host keeps up (default: False)
+        :param ramdump: RamDump to serve in memory debug mode (default: None)
+        :param output_dir: directory captured loaders are stored in (default: '.')
+        :param store: LoaderStore to keep captures in and to recognize
+            known images with (default: None)
+        :param images: list of (image id, filename or None) to request in
+            turn within one session (default: only the loader, 0xD)
+        :param storage: FirehoseStorage to serve over Firehose once the
+            session is complete, or over streaming download
+            (default: None, stay idle)
+        '''
+        if profile is None:
+            profile=ProfileStore(DEFAULT_PROFILES)[0]
+        self.profile=profile
+        self.read64=profile.read64
+        self.ramdump=ramdump
+        if self.ramdump is not None:
+            self.hello=self.HELLO_MEMORY_DEBUG
+        else:
+            self.hello=self.HELLO_IMAGE_TX_PENDING
+        if self.read64:
+            if chunk_size is None:
+                chunk_size=SAHARA_MAX_CHUNK_SIZE
+            self.planner=ChunkPlanner(chunk_size, adaptive, SAHARA_64BIT_MAX_CHUNK_SIZE)
+        else:
+            if chunk_size is None:
+                chunk_size=0x1000
+            self.planner=ChunkPlanner(chunk_size, adaptive)
         self.count=0
         self.timer=None
-        self.switch=0
+        self.timeline=SessionTimeline()
+        self.switch=self.STATE_COMMAND
+        self.state_handlers = {
+            self.STATE_COMMAND: self.handle_command,
+            self.STATE_IMAGE_HEADER: self.handle_image_data,
+            self.STATE_ELF_HEADERS: self.handle_image_data,
+            self.STATE_IMAGE_DATA: self.handle_image_data,
+            self.STATE_HASH_SEGMENT: self.handle_image_data,
+            self.STATE_FIREHOSE: self.handle_firehose_data,
+            self.STATE_DMSS: self.handle_dmss_data,
+            self.STATE_STREAMING: self.handle_streaming_data,
+            self.STATE_MEMORY_DEBUG: self.handle_memory_debug_command,
+        }
+        self.command_handlers = {
+            self.DIAG_DLOAD_F: self.handle_dload_request,
+            self.SAHARA_SWITCH_MODE: self.handle_switch_mode,
+            self.SAHARA_HELLO_RSP: self.handle_hello_rsp,
+            self.SAHARA_EXECUTE_REQ: self.handle_execute_req,
+            self.SAHARA_EXECUTE_DATA: self.handle_execute_data,
+            self.SAHARA_RESET_REQ: self.handle_reset_req,
+            self.SAHARA_DONE_REQ: self.handle_done_req,
+        }
+        self.memory_debug_handlers = {
+            self.SAHARA_MEMORY_READ: self.handle_memory_read,
+            self.SAHARA_64BIT_MEMORY_READ: self.handle_memory_read_64,
+            self.SAHARA_RESET_REQ: self.handle_reset_req,
+        }
+        # client commands that leave Sahara once the host asks for their data
+        self.execute_switches = {
+            self.SAHARA_EXEC_CMD_SWITCH_TO_DMSS_DLOAD: self._start_dmss,
+            self.SAHARA_EXEC_CMD_SWITCH_TO_STREAM_DLOAD: self._start_streaming,
+        }
+        self.execute_responses = dict(
+            (cmd, EXECUTE_RSP_PKT.pack(self.SAHARA_EXECUTE_RSP, EXECUTE_RSP_PKT.size, cmd, size))
+            for (cmd, size) in self.EXECUTE_RESPONSE_SIZES.items()
+        )
         self.bytestoread=0
-        self.bytestotal=0
+        self.rx_offset=0
         self.curoffset=0
-        self.buffer=bytes(b'')
-        self.loader=bytes(b'')
-        self.receive_buffer = bytes(b'')
+        self.rangeend=0
+        self.ranges=[]
+        self.reallen=0
+        self.elf=None
+        self.elf_fetched=[]
+        self.header=LoaderBuffer()
+        self.phdr_table=None
+        self.phdr_table_offset=0
+        self.hash_segment=None
+        self.hash_segment_offset=0
+        self.header_hash=None
+        self.verifier=None
+        self.verify_retries_left=0
+        self.images=list(images) if images else [(0xD, None)]
+        self.image_index=0
+        self.image_id=0xD
+        self.session_done=False
+        self.done_rsp_queued=False
+        self.storage=storage
+        self.firehose=None
+        if storage is not None:
+            self.firehose=FirehoseTarget(storage, self.send_data)
+        self.dmss=None
+        self.streaming=None
+        self.chunk_start=0
+        # ranges of the image in the output file, kept to resume the
+        # transfer after an interruption
+        self.received=[]
+        self.unsaved=0
+        self.resume_dir=os.path.join(output_dir, '.resume')
+        self.resume_key=None
+        self.store=store
+        self.sink=None
+        self.output_dir=output_dir
+        # (filename, size, verdict) of every loader captured so far
+        self.captures=[]
         super(USBSaharaInterface, self).__init__(
             app=app,
             phy=phy,
@@ -193,6 +666,8 @@ class USBSaharaInterface(USBInterface):
                 )
             ],
         )
+        self.ep_out = self.endpoints[0]
+        self.ep_in = self.endpoints[1]
         #self.txq = Queue()
 
     def send_data(self, data):
@@ -205,218 +680,638 @@ class USBSaharaInterface(USBInterface):
     def bytes_as_hex(self, b, delim=" "):
         return delim.join(["%02x" % x for x in b])
 
-    def handle_data_available(self, data):
-        global hash
-        global hwid
-        global serial
-        if (self.switch>=2):
-            if (len(self.buffer)<self.bytestoread):
-                self.buffer+=bytes(data)
-                if (len(self.buffer)==self.bytestoread):
-                   data=self.buffer
-                   self.buffer=bytes(b'')
-                   print("Complete RX")
-                else:
-                   print("Queueing, total: %x of %x" % (len(self.buffer),self.bytestoread))
-                   return
+    def _request_read(self, offset, length):
+        '''
+        Ask the host for the next chunk of the loader image and remember
+        where the incoming data has to be placed
+        '''
+        self.chunk_start = offset
+        self.rx_offset = offset
+        self.bytestoread = length
+        # read the chunk in as few transfers as possible
+        self.ep_out.transfer_size = length
+        if self.read64:
+            packet = READ_DATA_64_PKT.pack(self.SAHARA_64BIT_MEMORY_READ_DATA, READ_DATA_64_PKT.size, self.image_id, offset, length)
+        elif offset + length > 0xFFFFFFFF:
+            raise Exception('Image offset %#x is out of reach of 32-bit READ_DATA' % (offset + length))
+        else:
+            packet = READ_DATA_PKT.pack(self.SAHARA_READ_DATA, READ_DATA_PKT.size, self.image_id, offset, length)
+        self.timeline.record(EVENT_READ_DATA, offset)
+        self.send_data(packet)
+
+    def _request_next_chunk(self):
+        offset = self.curoffset
+        toread = self.planner.plan(offset, self.rangeend)
+        self.curoffset += toread
+        self._request_read(offset, toread)
+        self.debug("Loader to read : %x" % (self.rangeend-self.curoffset))
+
+    def _set_ranges(self, ranges):
+        '''
+        Set the byte ranges of the image that the current phase fetches
+
+        :param ranges: sorted list of disjoint (start, end) tuples
+        '''
+        self.ranges = list(ranges)
+        self.curoffset = self.rangeend = 0
+
+    def _start_transfer(self, image_id, filename=None):
+        '''
+        Open the output file for a new image capture
+
+        :param image_id: id of the image to request
+        :param filename: output file name (default: [hwid].bin for the
+            loader, [hwid]_[image id].bin for other images)
+        '''
+        self.suspend_transfer()
+        if filename is None:
+            if image_id == 0xD:
+                filename = self.profile.hwid_str + ".bin"
             else:
-                data=self.buffer
-                self.buffer=bytes(b'')
-                print("Complete RX")
+                filename = "%s_%02X.bin" % (self.profile.hwid_str, image_id)
+        self.image_id = image_id
+        self.sink = LoaderFileSink(os.path.join(self.output_dir, filename))
+        self.header = LoaderBuffer(0x50)
+        self.phdr_table = None
+        self.elf = None
+        self.elf_fetched = [(0, 0x50)]
+        self.hash_segment = None
+        self.header_hash = None
+        self.verifier = None
+        self.received = []
+        self.resume_key = None
+        self.verify_retries_left = self.verify_retries
+        self._set_ranges([(0, 0x50)])
+        self.reallen = 0x50
 
-        #print("RX: ")
-        #rec=binascii.hexlify(data)
-        #print(rec)
+    def _receive_chunk(self, data):
+        '''
+        Write incoming loader data straight to the output file, keeping a
+        copy of the parts that fall within the headers
+
+        :return: True once the requested chunk is complete
+        '''
+        count = len(data)
+        if count > self.bytestoread:
+            count = self.bytestoread
+            data = memoryview(data)[:count]
+        headlen = len(self.header) - self.rx_offset
+        if headlen > 0:
+            self.header.write(self.rx_offset, memoryview(data)[:headlen])
+        if self.switch==self.STATE_ELF_HEADERS:
+            self.phdr_table.write(self.rx_offset - self.phdr_table_offset, data)
+        elif self.switch==self.STATE_HASH_SEGMENT:
+            self.hash_segment.write(self.rx_offset - self.hash_segment_offset, data)
+        elif self.verifier is not None:
+            self.verifier.update(self.rx_offset, memoryview(data))
+        self.sink.write(self.rx_offset, data)
+        self.rx_offset += count
+        self.bytestoread -= count
+        self.ep_out.transfer_size = self.bytestoread or None
+        return self.bytestoread == 0
+
+    def handle_data_available(self, data):
         if len(data) == 0:
             return
+        if not self.timeline.count:
+            # the first packet may come from the host as well
+            self.timeline.record(EVENT_ENUMERATED)
+        self.state_handlers[self.switch](data)
+
+    def handle_image_data(self, data):
+        if self._is_hello_rsp(data):
+            # the host started over without finishing the transfer
+            self.info("Got SAHARA_HELLO_RSP during a transfer")
+            self.suspend_transfer()
+            self.switch=self.STATE_COMMAND
+            self.bytestoread=0
+            self.ep_out.transfer_size=None
+            self.handle_command(data)
+            return
+        if self._receive_chunk(data):
+            self.handle_loader_chunk()
+
+    def _is_hello_rsp(self, data):
+        '''
+        :return: True if data is a HELLO_RSP packet rather than the start
+            of the requested chunk. A chunk of exactly the size of the
+            packet cannot be told apart and is taken as data.
+        '''
+        if len(data) != HELLO_RSP_SIZE or self.rx_offset != self.chunk_start or self.bytestoread == HELLO_RSP_SIZE:
+            return False
+        command, length = HELLO_RSP_PKT.unpack_from(data)[:2]
+        return command == self.SAHARA_HELLO_RSP and length == HELLO_RSP_SIZE
+
+    def handle_command(self, data):
         opcode=data[0]
-        if (self.switch==0 and opcode==0x3A):
-            print("Got download request.")
-            init= b"\x7E\x02\x6A\xD3\x7E"
-            self.send_data(init)
-        elif (self.switch==0):
-            print ("Opcode : %x" % opcode)
-            if (self.count==0):
-                print("Pre init.")
-                init = b"\x01\x00\x00\x00\x30\x00\x00\x00\x02\x00\x00\x00\x01\x00\x00\x00\x00\x04\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00"
-                self.send_data(init)
-                self.count += 1
-            elif opcode == self.SAHARA_SWITCH_MODE: #0xC
-                print("Got SAHARA_SWITCH_self.")
-                request = struct.Struct('<III')
-                req = request.unpack(bytes(data))
-                '''
-                if (req[2]==self.SAHARA_MODE_IMAGE_TX_PENDING): #0
-                    request=request
-                '''
-                if (req[2]==self.SAHARA_MODE_IMAGE_TX_COMPLETE): #1
-                    print("SAHARA_MODE_IMAGE_TX_COMPLETE")
-                    reply = struct.Struct('<IIIIIIIIIIII')
-                    packet = reply.pack(0x01,0x30,0x02,0x01,0x400,0x1,0x0,0x0,0x0,0x0,0x0,0x0)
-                    self.send_data(packet)
-                elif (req[2]==self.SAHARA_MODE_COMMAND): #3
-                    print("SAHARA_MODE_COMMAND")
-                    init = b"\x01\x00\x00\x00\x30\x00\x00\x00\x02\x00\x00\x00\x01\x00\x00\x00\x00\x04\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00"
-                    self.send_on_endpoint(3, init)
-                    #self.count=0
-                    #self.switch=0
-                '''
-                elif (req[2]==self.SAHARA_MODE_MEMORY_DEBUG): #2
-                    request=request
-                '''
-                print("Done SAHARA_SWITCH_self.")
-
-            elif opcode==self.SAHARA_HELLO_RSP: #02
-                print("Got SAHARA_HELLO_RSP")
-                request = struct.Struct('<IIIIII')
-                req = request.unpack(bytes(data[:24]))
-                if (req[5]==0x3): #mode
-                    packet = struct.pack('<II', 0xB, 0x8)
-                    self.send_data(packet)
-                elif (req[5]==0x0 or req[5]==0x1): #mode, send loader
-                    packet = struct.pack('<IIIII', 0x3, 0x14, 0xD, 0x0, 0x50)
-                    self.send_data(packet)
-                    self.switch=1
-                    self.bytestoread=0x50
-                #elif (req[5]==0x1): #mode
-                #    packet = struct.pack('<II', 0xB, 0x8)
-                #    self.send_data(packet)
-                print("Done SAHARA_HELLO_RSP.")
-                self.count += 1
-            elif opcode == self.SAHARA_EXECUTE_REQ: #0D
-                print("Got SAHARA_EXECUTE_REQ")
-                request = struct.Struct('<III')
-                reply = struct.Struct('<IIII')
-                req = request.unpack(bytes(data))
-                '''
-                if req[2] == self.SAHARA_EXEC_CMD_NOP:
-                    packet = reply.pack(self.SAHARA_EXECUTE_RSP, 0x10, self.SAHARA_EXEC_CMD_NOP, 0x0) #Reply, unk, cmd, replysize
-                '''
-                if req[2] == self.SAHARA_EXEC_CMD_SERIAL_NUM_READ: #1
-                    packet = reply.pack(self.SAHARA_EXECUTE_RSP, 0x10, self.SAHARA_EXEC_CMD_SERIAL_NUM_READ, 0x4) #Reply 0xE, unk, cmd, replysize
-                elif req[2] == self.SAHARA_EXEC_CMD_MSM_HW_ID_READ: #2
-                    packet = reply.pack(self.SAHARA_EXECUTE_RSP, 0x10, self.SAHARA_EXEC_CMD_MSM_HW_ID_READ, 0x18)
-                elif req[2] == self.SAHARA_EXEC_CMD_OEM_PK_HASH_READ: #3
-                    packet = reply.pack(self.SAHARA_EXECUTE_RSP, 0x10, self.SAHARA_EXEC_CMD_OEM_PK_HASH_READ, 0x60)
-                elif req[2] == self.SAHARA_EXEC_CMD_GET_SOFTWARE_VERSION_SBL: #7
-                    packet = reply.pack(self.SAHARA_EXECUTE_RSP, 0x10, self.SAHARA_EXEC_CMD_GET_SOFTWARE_VERSION_SBL, 0x4)
-                '''
-                elif req[2] == self.SAHARA_EXEC_CMD_SWITCH_TO_DMSS_DLOAD: #4
-                    packet = reply.pack(self.SAHARA_EXECUTE_RSP, 0x10, self.SAHARA_EXEC_CMD_SWITCH_TO_DMSS_DLOAD, 0x40)
-                elif req[2] == self.SAHARA_EXEC_CMD_SWITCH_TO_STREAM_DLOAD: #5
-                    packet = reply.pack(self.SAHARA_EXECUTE_RSP, 0x10, self.SAHARA_EXEC_CMD_SWITCH_TO_STREAM_DLOAD, 0x40)
-                elif req[2] == self.SAHARA_EXEC_CMD_READ_DEBUG_DATA: #6
-                    packet = reply.pack(self.SAHARA_EXECUTE_RSP, 0x10, self.SAHARA_EXEC_CMD_READ_DEBUG_DATA, 0x40)
-                '''
-                
-                self.send_data(packet)
-                print("Done SAHARA_EXECUTE_REQ.")
-            elif opcode == self.SAHARA_EXECUTE_DATA: #0xF
-                print("Got SAHARA_EXECUTE_DATA.")
-                request = struct.Struct('<III')
-                req = request.unpack(bytes(data))
-                if req[2] == self.SAHARA_EXEC_CMD_SERIAL_NUM_READ: #1
-                    reply = struct.Struct('<I')
-                    packet = reply.pack(serial)
-                elif req[2] == self.SAHARA_EXEC_CMD_MSM_HW_ID_READ: #2
-                    reply = struct.Struct('8s8s8s')
-                    packet = reply.pack(hwid, hwid, hwid)
-                elif req[2] == self.SAHARA_EXEC_CMD_OEM_PK_HASH_READ: #3
-                    reply = struct.Struct('32s32s32s')
-                    packet = reply.pack(hash, hash, hash)
-                elif req[2] == self.SAHARA_EXEC_CMD_GET_SOFTWARE_VERSION_SBL: #7
-                    reply = struct.Struct('<I')
-                    packet = reply.pack(sblversion)
-                '''
-                elif req[2] == self.SAHARA_EXEC_CMD_SWITCH_TO_DMSS_DLOAD: #4
-                    packet = reply.pack(self.SAHARA_EXECUTE_RSP, 0x10, self.SAHARA_EXEC_CMD_SWITCH_TO_DMSS_DLOAD, 0x40)
-                elif req[2] == self.SAHARA_EXEC_CMD_SWITCH_TO_STREAM_DLOAD: #5
-                    packet = reply.pack(self.SAHARA_EXECUTE_RSP, 0x10, self.SAHARA_EXEC_CMD_SWITCH_TO_STREAM_DLOAD, 0x40)
-                elif req[2] == self.SAHARA_EXEC_CMD_READ_DEBUG_DATA: #6
-                    packet = reply.pack(self.SAHARA_EXECUTE_RSP, 0x10, self.SAHARA_EXEC_CMD_READ_DEBUG_DATA, 0x40)
-                '''
-                self.send_data(packet)
-                print("Done SAHARA_EXECUTE_DATA.")
-        elif (self.switch==1):
-                print("Loader read Init")
-                request = struct.Struct('<IIIIIIII')
-                req = request.unpack(bytes(data[0:32]))
-                if req[0]==0x464c457F:
-                    self.elfstart = struct.Struct('<I').unpack(bytes(data[0x20:0x24]))[0]
-                    self.bytestotal=0x4000
-                    self.switch=2
-                    print("ELF Loader detected, ProgHdr start: %x" % self.elfstart)
+        if (self.count==0 and opcode!=self.DIAG_DLOAD_F):
+            self.debug("Pre init.")
+            self.timeline.record(EVENT_HELLO)
+            self.send_data(self.hello)
+            self.count += 1
+            return
+        handler = self.command_handlers.get(opcode, None)
+        if handler is None:
+            self.warning("Unhandled opcode : %x" % opcode)
+            return
+        handler(data)
+
+    def handle_dload_request(self, data):
+        self.info("Got download request.")
+        self._start_dmss()
+        self.dmss.ack()
+
+    def _start_dmss(self):
+        self.info("Switching to DMSS download")
+        if self.dmss is None:
+            self.dmss=DmssTarget(MemoryImage(), self.send_data, self._dmss_go)
+        self.switch=self.STATE_DMSS
+
+    def handle_dmss_data(self, data):
+        self.dmss.handle_data(data)
+
+    def _dmss_go(self, address):
+        '''
+        Save the programmer the host downloaded and now jumps to
+        '''
+        base, view = self.dmss.memory.written()
+        if not len(view):
+            self.warning("Go to %#x without a download" % address)
+            return
+        filename = os.path.join(self.output_dir, "%s_dload.bin" % self.profile.hwid_str)
+        with open(filename, 'wb') as f:
+            f.write(view)
+        self.info("Saved %#x bytes downloaded to %#x as %s" % (len(view), base, filename))
+        verdict = self.VERDICT_UNVERIFIED
+        if self.store is not None:
+            self.store.add(filename, len(view), None, self.profile, verdict)
+        self.captures.append((filename, len(view), verdict))
+        self.session_done=True
+        if self.storage is not None:
+            self._start_streaming()
+
+    def _start_streaming(self):
+        if self.storage is None:
+            self.warning("No storage image for streaming download")
+            return
+        self.info("Switching to streaming download")
+        if self.streaming is None:
+            self.streaming=StreamingTarget(self.storage, self.send_data)
+        self.switch=self.STATE_STREAMING
+
+    def handle_streaming_data(self, data):
+        self.streaming.handle_data(data)
+
+    def handle_switch_mode(self, data):
+        mode = SWITCH_MODE_PKT.unpack_from(data)[2]
+        self.debug("Got SAHARA_SWITCH_MODE %#x" % mode)
+        self.timeline.record(EVENT_SWITCH_MODE, mode)
+        if (mode==self.SAHARA_MODE_IMAGE_TX_COMPLETE): #1
+            hello = self.HELLO_IMAGE_TX_COMPLETE
+        elif (mode==self.SAHARA_MODE_COMMAND or mode==self.SAHARA_MODE_IMAGE_TX_PENDING): #3, 0
+            hello = self.HELLO_IMAGE_TX_PENDING
+        elif (mode==self.SAHARA_MODE_MEMORY_DEBUG and self.ramdump is not None): #2
+            hello = self.HELLO_MEMORY_DEBUG
+        else:
+            return
+        self.timeline.record(EVENT_HELLO, mode)
+        self.send_data(hello)
+
+    def handle_hello_rsp(self, data):
+        mode = HELLO_RSP_PKT.unpack_from(data)[5]
+        self.debug("Got SAHARA_HELLO_RSP, mode %#x" % mode)
+        self.timeline.record(EVENT_HELLO_RSP, mode)
+        if (mode==self.SAHARA_MODE_COMMAND):
+            self.timeline.record(EVENT_CMD_READY)
+            self.send_data(self.CMD_READY)
+        elif (mode==self.SAHARA_MODE_IMAGE_TX_PENDING or mode==self.SAHARA_MODE_IMAGE_TX_COMPLETE): #send loader
+            self.image_index=0
+            self.session_done=False
+            self._start_next_image()
+        elif (mode==self.SAHARA_MODE_MEMORY_DEBUG and self.ramdump is not None):
+            self._start_memory_debug()
+        self.count += 1
+
+    def _start_next_image(self):
+        image_id, filename = self.images[self.image_index]
+        self.image_index += 1
+        self.info("Requesting image %#x (%d of %d)" % (image_id, self.image_index, len(self.images)))
+        self._start_transfer(image_id, filename)
+        self.switch=self.STATE_IMAGE_HEADER
+        self._advance_transfer()
+
+    def handle_done_req(self, data):
+        self.debug("Got SAHARA_DONE_REQ")
+        self.timeline.record(EVENT_DONE_REQ)
+        if self.image_index < len(self.images):
+            self.timeline.record(EVENT_DONE_RSP, self.SAHARA_MODE_IMAGE_TX_PENDING)
+            self.send_data(self.DONE_RSP_PENDING)
+            self._start_next_image()
+        else:
+            self.timeline.record(EVENT_DONE_RSP, self.SAHARA_MODE_IMAGE_TX_COMPLETE)
+            self.send_data(self.DONE_RSP_COMPLETE)
+            # the session is done once the response went out
+            self.done_rsp_queued=True
+            self.phy.wakeup()
+            if self.firehose is not None:
+                self.info("Session complete, switching to Firehose")
+                self.switch=self.STATE_FIREHOSE
+                self.ep_in.zlp=self.firehose.zlp_aware_host
+
+    def handle_firehose_data(self, data):
+        self.firehose.handle_data(data)
+        # configure tells whether the host expects ZLPs
+        self.ep_in.zlp=self.firehose.zlp_aware_host
+
+    def handle_reset_req(self, data):
+        self.debug("Got SAHARA_RESET_REQ")
+        self.timeline.record(EVENT_RESET)
+        self.send_data(self.RESET_RSP)
+        self.switch=self.STATE_COMMAND
+        self.count=0
+        self.ep_out.transfer_size=None
+
+    def _start_memory_debug(self):
+        '''
+        Advertise the memory debug table of the RAM dump
+        '''
+        table = self.ramdump.table(self.read64)
+        if self.read64:
+            packet = MEMORY_DEBUG_64_PKT.pack(self.SAHARA_64BIT_MEMORY_DEBUG, MEMORY_DEBUG_64_PKT.size, self.ramdump.table_address, len(table))
+        else:
+            packet = MEMORY_DEBUG_PKT.pack(self.SAHARA_MEMORY_DEBUG, MEMORY_DEBUG_PKT.size, self.ramdump.table_address, len(table))
+        self.info("Entering memory debug mode, %d regions" % len(self.ramdump.regions))
+        self.switch=self.STATE_MEMORY_DEBUG
+        self.send_data(packet)
+
+    def handle_memory_debug_command(self, data):
+        handler = self.memory_debug_handlers.get(data[0], None)
+        if handler is None:
+            self.warning("Unhandled memory debug opcode : %x" % data[0])
+            return
+        handler(data)
+
+    def handle_memory_read(self, data):
+        _, _, address, length = MEMORY_READ_PKT.unpack_from(data)
+        self._serve_memory(address, length)
+
+    def handle_memory_read_64(self, data):
+        _, _, address, length = MEMORY_READ_64_PKT.unpack_from(data)
+        self._serve_memory(address, length)
+
+    def _serve_memory(self, address, length):
+        '''
+        Answer a memory read with a slice of the mmap'd region, handed to
+        the IN endpoint without copying it
+        '''
+        self.debug("Memory read %#x + %#x" % (address, length))
+        self.timeline.record(EVENT_MEMORY_READ, address)
+        view = self.ramdump.read(address, length, self.read64)
+        if view is None:
+            self.warning("Invalid memory read %#x + %#x" % (address, length))
+            packet = END_TRANSFER_PKT.pack(self.SAHARA_END_TRANSFER, END_TRANSFER_PKT.size, 0x0, self.SAHARA_NAK_INVALID_MEMORY_READ)
+            self.send_data(packet)
+            return
+        self.send_data(view)
+        self.timeline.record(EVENT_MEMORY_READ_DONE, address)
+
+    def handle_execute_req(self, data):
+        cmd = EXECUTE_PKT.unpack_from(data)[2]
+        self.debug("Got SAHARA_EXECUTE_REQ %#x" % cmd)
+        self.timeline.record(EVENT_EXECUTE_REQ, cmd)
+        packet = self.execute_responses.get(cmd, None)
+        if packet is None:
+            self.warning("Unsupported execute command %#x" % cmd)
+            packet = EXECUTE_RSP_PKT.pack(self.SAHARA_EXECUTE_RSP, EXECUTE_RSP_PKT.size, cmd, 0)
+        self.send_data(packet)
+
+    def handle_execute_data(self, data):
+        cmd = EXECUTE_PKT.unpack_from(data)[2]
+        self.debug("Got SAHARA_EXECUTE_DATA %#x" % cmd)
+        self.timeline.record(EVENT_EXECUTE_DATA, cmd)
+        switch = self.execute_switches.get(cmd, None)
+        if switch is not None:
+            switch()
+            return
+        packet = self.profile.execute_data.get(cmd, None)
+        if packet is None:
+            return
+        self.send_data(packet)
+
+    def handle_loader_chunk(self):
+        '''
+        Called once a requested chunk of the loader has been received
+        '''
+        self.planner.complete()
+        self.timeline.record(EVENT_READ_DONE, self.chunk_start)
+        if self.resume_key is not None:
+            self._mark_received(self.chunk_start, self.rx_offset)
+        self._advance_transfer()
+
+    def _advance_transfer(self):
+        '''
+        Request the rest of the current transfer phase, or move on to the
+        next phase once all of it has been received
+        '''
+        while (self.curoffset>=self.rangeend and self.ranges):
+            self.curoffset, self.rangeend = self.ranges.pop(0)
+        if (self.curoffset<self.rangeend):
+            self._request_next_chunk()
+            return
+        view = self.header.view
+        if (self.switch==self.STATE_IMAGE_HEADER):
+                if is_elf(view):
+                    self.elf = ElfHeaders()
+                    start, end = self.elf.parse_header(view)
+                    # only the program header table is missing, and only
+                    # the part of it beyond what we already have; it is
+                    # kept apart from the header, however far away it is
+                    self.phdr_table = LoaderBuffer(end - start)
+                    self.phdr_table_offset = start
+                    self._copy_held(self.phdr_table, start, end)
+                    self.elf_fetched = merge_ranges([(0, len(self.header)), (start, end)])
+                    self._set_ranges(subtract_ranges([(start, end)], [(0, len(self.header))]))
+                    self.switch=self.STATE_ELF_HEADERS
+                    self.info("ELF%d Loader detected, ProgHdr at: %x, %d entries" % (32 if self.elf.elfclass == ELFCLASS32 else 64, start, self.elf.phnum))
+                    self._advance_transfer()
                 else:
-                    print("QC Loader detected")
-                    self.bytestotal=req[7]
-                    self.reallen=req[7]
-                    self.switch=3
-                print("Reading length: "+hex(self.bytestotal))
-                self.curoffset=0x50
-                self.loader+=bytes(data)
-                packet = struct.pack('<IIIII', 0x3, 0x13, 0xD, self.curoffset, 0x1000)
-                self.bytestoread=0x1000
-                self.send_data(packet)
-        elif (self.switch==2):
-                print("ELF read")
-                x=self.elfstart
-                self.loader+=bytes(data)
-                self.bytestotal=0x0
-                while (1):
-                    start = struct.Struct('<Q').unpack(bytes(self.loader[(x+0x8):(x+0x8+0x8)]))[0]
-                    length = struct.Struct('<Q').unpack(bytes(self.loader[(x+0x20):(x+0x20+0x8)]))[0]
-                    if (start+length)==0:
+                    self.reallen=LOADER_HEADER.unpack_from(view)[7]
+                    self.info("QC Loader detected, reading length: %x" % self.reallen)
+                    self._headers_complete()
+        elif (self.switch==self.STATE_ELF_HEADERS):
+                phdrs = self.elf.parse_program_headers(self.phdr_table.view, self.phdr_table_offset)
+                self.reallen = image_size(phdrs)
+                hashseg = None
+                for phdr in phdrs:
+                    if phdr.is_hash_segment() and phdr.p_filesz:
+                        hashseg = phdr
                         break
-                    self.bytestotal = start+length
-                    #print("start : "+hex(start))
-                    #print("length : "+hex(length))
-                    x+=0x38
-                print("Reading length: "+hex(self.bytestotal))
-                self.reallen=self.bytestotal
-                self.curoffset=0x1050
-                self.bytestotal-=(0x1000-0x50)
-                self.switch=3
-                packet = struct.pack('<IIIII', 0x3, 0x13, 0xD, self.curoffset, 0x1000)
-                self.bytestoread=0x1000
-                self.send_data(packet)
-        elif self.switch==3:
-                print("Loader reading")
-                self.loader+=bytes(data)
-                self.bytestotal-=len(data)
-                if (self.bytestotal<=0):
-                   packet = struct.pack('<IIII', 0x4, 0x10, 0xD, 0x0)
-                   self.send_data(packet)
-                   self.switch=0
-                   self.bytestoread=0
-                   hwidstr=''.join('{:02X}'.format(x) for x in hwid)
-                   with open(hwidstr+".bin","wb") as ft:
-                        ft.write(self.loader[0:self.reallen])
-                        print("We received all loader, stored as: %s" % (hwidstr+".bin"))
-                   print("All loader done.")
+                if hashseg is None:
+                    self._headers_complete()
                 else:
-                   toread=self.bytestotal
-                   if (toread>0x1000):
-                       toread=0x1000
-                   self.curoffset+=toread
-                   packet = struct.pack('<IIIII', 0x3, 0x14, 0xD, self.curoffset, 0x1000)
-                   self.bytestoread=toread
-                   self.send_data(packet)
-                   print("Loader to read : %x" % self.bytestotal)
+                    self._start_hash_segment(hashseg)
+                    self._advance_transfer()
+        elif (self.switch==self.STATE_HASH_SEGMENT):
+                self._headers_complete()
+        elif self.switch==self.STATE_IMAGE_DATA:
+                verdict = self.VERDICT_UNVERIFIED
+                if self.verifier is not None:
+                    bad = self.verifier.finish(self.sink.fd)
+                    if bad and self.verify_retries_left > 0:
+                        self.verify_retries_left -= 1
+                        self.warning("Hash mismatch in %s, fetching again" % ', '.join('%x-%x' % r for r in bad))
+                        self.verifier.retry(bad)
+                        self._set_ranges(bad)
+                        self._advance_transfer()
+                        return
+                    verdict = self.VERDICT_CORRUPT if bad else self.VERDICT_VERIFIED
+                self._end_transfer()
+                self.sink.commit(self.reallen)
+                self._drop_resume_state()
+                self.info("We received all loader, stored as: %s (%s)" % (self.sink.filename, verdict))
+                if self.store is not None and verdict != self.VERDICT_CORRUPT:
+                    entry = self.store.add(self.sink.filename, self.reallen, self.header_hash, self.profile, verdict)
+                    self.info("Loader blob: %s" % entry['sha256'])
+                self.captures.append((self.sink.filename, self.reallen, verdict))
+                self.sink=None
+
+    def _start_hash_segment(self, hashseg):
+        '''
+        Fetch the hash table segment ahead of the rest of the image
+        '''
+        start, end = hashseg.p_offset, hashseg.p_offset + hashseg.p_filesz
+        hash_segment = LoaderBuffer(hashseg.p_filesz)
+        # whatever part of it came in with the headers is not fetched again
+        self._copy_held(hash_segment, start, end)
+        self.hash_segment = hash_segment
+        self.hash_segment_offset = start
+        self._set_ranges(subtract_ranges([(start, end)], self.elf_fetched))
+        self.elf_fetched = merge_ranges(self.elf_fetched + [(start, end)])
+        self.switch=self.STATE_HASH_SEGMENT
+
+    def _held(self):
+        '''
+        :return: list of (offset in the image, LoaderBuffer) of the parts
+            of the image held in memory
+        '''
+        held = [(0, self.header)]
+        if self.phdr_table is not None:
+            held.append((self.phdr_table_offset, self.phdr_table))
+        if self.hash_segment is not None:
+            held.append((self.hash_segment_offset, self.hash_segment))
+        return held
+
+    def _held_data(self, start, end):
+        '''
+        :return: list of (offset, memoryview) of the held data covering
+            the image range start..end, each byte in one of them
+        '''
+        pieces = []
+        pos = start
+        while pos < end:
+            for (offset, buff) in self._held():
+                if offset <= pos < offset + len(buff):
+                    stop = min(end, offset + len(buff))
+                    pieces.append((pos, buff.view[pos - offset:stop - offset]))
+                    pos = stop
+                    break
+            else:
+                raise Exception('Image range %x-%x is not held in memory' % (pos, end))
+        return pieces
+
+    def _copy_held(self, buff, start, end):
+        '''
+        Copy what was fetched of the image range start..end into buff
+        '''
+        for (fstart, fend) in self.elf_fetched:
+            fstart, fend = max(fstart, start), min(fend, end)
+            if fstart < fend:
+                for (offset, data) in self._held_data(fstart, fend):
+                    buff.write(offset - start, data)
+
+    def _headers_complete(self):
+        '''
+        All headers are in hand: identify the image, then skip it if it
+        is known, or fetch whatever of it is still missing
+        '''
+        digest = hashlib.sha256()
+        for (_, buff) in self._held():
+            digest.update(buff.view)
+        self.header_hash = digest.hexdigest()
+        if self.store is not None and self.hash_segment is not None:
+            # only the hash table tells the whole image apart
+            entry = self.store.lookup(self.header_hash)
+            if entry is not None:
+                self._finish_known_transfer(entry)
+                return
+        self._resume_transfer()
+        self._start_image_data()
+        self._advance_transfer()
+
+    def _resume_state_path(self):
+        return os.path.join(self.resume_dir, self.resume_key + '.json')
+
+    def _resume_transfer(self):
+        '''
+        Pick up an interrupted transfer of the same image if there is one,
+        otherwise keep the capture where it can be resumed from
+        '''
+        self.resume_key = '%s-%02x-%s' % (self.profile.hwid_str, self.image_id, self.header_hash)
+        state_path = self._resume_state_path()
+        partname = os.path.join(self.resume_dir, self.resume_key + '.part')
+        self.received = list(self.elf_fetched)
+        if os.path.isfile(state_path) and os.path.isfile(partname):
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+            self.sink.discard()
+            self.sink = LoaderFileSink(self.sink.filename, partname)
+            self.received = merge_ranges([tuple(r) for r in state['received']] + self.received)
+            self.info("Resuming transfer, %x bytes already received" % sum(e - s for (s, e) in self.received))
+        else:
+            if not os.path.isdir(self.resume_dir):
+                os.makedirs(self.resume_dir)
+            self.sink.move(partname)
+        self._save_resume_state()
+
+    def _mark_received(self, start, end):
+        if self.received and self.received[-1][1] == start:
+            self.received[-1] = (self.received[-1][0], end)
+        else:
+            self.received = merge_ranges(self.received + [(start, end)])
+        self.unsaved += end - start
+        if self.unsaved >= self.resume_save_interval:
+            self._save_resume_state()
+
+    def _save_resume_state(self):
+        state = {
+            'hwid': self.profile.hwid_str,
+            'image_id': self.image_id,
+            'header_hash': self.header_hash,
+            'size': self.reallen,
+            'received': self.received,
+        }
+        state_path = self._resume_state_path()
+        with open(state_path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.rename(state_path + '.tmp', state_path)
+        self.unsaved = 0
+
+    def _drop_resume_state(self):
+        if self.resume_key is not None:
+            state_path = self._resume_state_path()
+            if os.path.isfile(state_path):
+                os.unlink(state_path)
+            self.resume_key = None
+
+    def suspend_transfer(self):
+        '''
+        Stop the transfer in progress, keeping what has been received so
+        that it can be resumed later
+        '''
+        if self.sink is None:
+            return
+        if self.resume_key is not None:
+            self._save_resume_state()
+            self.info("Transfer interrupted, %x bytes kept for resuming" % sum(e - s for (s, e) in self.received))
+            self.resume_key = None
+            self.sink.close()
+        else:
+            # still fetching the headers, there is nothing to resume from
+            self.sink.discard()
+        self.sink = None
+
+    def _start_image_data(self):
+        '''
+        Fetch the segments of the image that are still missing
+        '''
+        if self.elf is not None:
+            # only loadable and hash segments are fetched, the gaps
+            # between them stay zero in the output file
+            wanted = fetch_ranges(self.elf.phdrs)
+        else:
+            wanted = [(0, self.reallen)]
+        ranges = subtract_ranges(wanted, self.received)
+        self.info("Reading length: %x, fetching %x bytes" % (self.reallen, sum(e - s for (s, e) in ranges)))
+        self._set_ranges(ranges)
+        self.switch=self.STATE_IMAGE_DATA
+        if self.hash_segment is None:
+            return
+        have = merge_ranges(ranges + self.received)
+        self.verifier = SegmentVerifier.from_hash_segment(self.elf.phdrs, self.hash_segment.view, have)
+        if self.verifier is None:
+            self.warning("Hash table segment not understood, capture will be unverified")
+            return
+        # segments are hashed as they arrive, starting with what is in hand
+        for (start, end) in self.elf_fetched:
+            for (offset, data) in self._held_data(start, end):
+                self.verifier.update(offset, data)
+
+    def _end_transfer(self):
+        packet = END_TRANSFER_PKT.pack(self.SAHARA_END_TRANSFER, END_TRANSFER_PKT.size, self.image_id, self.SAHARA_STATUS_SUCCESS)
+        self.timeline.record(EVENT_END_TRANSFER, self.image_id)
+        self.send_data(packet)
+        self.switch=self.STATE_COMMAND
+        self.bytestoread=0
+        self.ep_out.transfer_size=None
+
+    def _finish_known_transfer(self, entry):
+        '''
+        End the transfer of an image the store already holds and link the
+        stored blob in place of the capture
+        '''
+        self.info("Loader already stored as blob %s, skipping the remaining %x bytes" % (entry['sha256'], self.reallen - sum(e - s for (s, e) in self.elf_fetched)))
+        self._end_transfer()
+        self.sink.discard()
+        self._drop_resume_state()
+        self.store.link(entry, self.sink.filename)
+        verdict = entry.get('verdict', self.VERDICT_UNVERIFIED)
+        self.store.record(entry['sha256'], entry['size'], self.header_hash, self.profile, verdict)
+        self.captures.append((self.sink.filename, entry['size'], verdict))
+        self.sink=None
 
     def handle_buffer_available(self):
-             if self.count==0:
-                print("Buffer got called")
-                init = b"\x01\x00\x00\x00\x30\x00\x00\x00\x02\x00\x00\x00\x01\x00\x00\x00\x00\x04\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00"
-                self.send_on_endpoint(3,init)
-                self.count += 1
+        if self.done_rsp_queued:
+            self.done_rsp_queued=False
+            self.session_done=True
+        if self.count==0:
+            self.debug("Buffer got called")
+            if not self.timeline.count:
+                self.timeline.record(EVENT_ENUMERATED)
+            self.timeline.record(EVENT_HELLO)
+            self.send_data(self.hello)
+            self.count += 1
 
 
+def parse_images(spec):
+    '''
+    :param spec: comma separated image ids, each optionally followed by
+        ':' and an output file name, e.g. "0x15:sbl1.mbn,0xD"
+    :return: list of (image id, filename or None)
+    '''
+    images = []
+    for item in spec.split(','):
+        image_id, _, filename = item.strip().partition(':')
+        images.append((int(image_id, 0), filename or None))
+    return images
 
 
 class USBSaharaDevice(USBDevice):
     name = 'SaharaDevice'
 
-    def __init__(self, app, phy, vid=0x05C6, pid=0x9008, rev=0x0100, **kwargs):
+    def __init__(self, app, phy, vid=0x05C6, pid=0x9008, rev=0x0100, profile=None, profiles=None, chunk_size=None, adaptive=False, ramdump=None, output_dir='.', store=None, images=None, storage=None, timeline=None, **kwargs):
+        if isinstance(profile, DeviceProfile):
+            self.profile = profile
+        else:
+            profile_store = ProfileStore(profiles or DEFAULT_PROFILES)
+            self.profile = profile_store.find(profile if profile is not None else 0)
+            profile_store.close()
+        if store is not None and not isinstance(store, LoaderStore):
+            store = LoaderStore(store)
+        self.ramdump = RamDump(ramdump) if ramdump else None
+        self.storage = FirehoseStorage(storage) if storage else None
+        # file the session timeline is saved to on disconnect
+        self.timeline = timeline
+        self.sahara = USBSaharaInterface(app, phy, 0, profile=self.profile, chunk_size=chunk_size, adaptive=adaptive, ramdump=self.ramdump, output_dir=output_dir, store=store, images=parse_images(images) if images else None, storage=self.storage)
         super(USBSaharaDevice, self).__init__(
             app=app,
             phy=phy,
@@ -437,7 +1332,7 @@ class USBSaharaDevice(USBDevice):
                     index=1,
                     string='Sahara',
                     interfaces=[
-                        USBSaharaInterface(app, phy, 0)
+                        self.sahara
                     ],
                     attributes=USBConfiguration.ATTR_SELF_POWERED,
                 )
@@ -445,5 +1340,15 @@ class USBSaharaDevice(USBDevice):
             usb_vendor=USBSaharaVendor(app=app, phy=phy)
         )
 
+    def disconnect(self):
+        super(USBSaharaDevice, self).disconnect()
+        self.sahara.suspend_transfer()
+        if self.timeline:
+            self.sahara.timeline.save(self.timeline)
+        if self.ramdump is not None:
+            self.ramdump.close()
+        if self.storage is not None:
+            self.storage.close()
+
 
 usb_device = USBSaharaDevice
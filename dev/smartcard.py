@@ -450,8 +450,6 @@ class USBSmartcardInterface(USBInterface):
             buff = self.int_q.get()
             self.debug('Sending data to host: %s' % (hexlify(buff)))
             self.send_on_endpoint(3, buff)
-        else:
-            self.send_on_endpoint(3, b'')
 
 
 class USBSmartcardDevice(USBDevice):
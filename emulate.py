@@ -3,7 +3,7 @@
 Emulate a USB device
 
 Usage:
-    umap2emulate -C DEVICE_CLASS [-q] [--vid VID] [--pid PID] [-v ...]
+    umap2emulate -C DEVICE_CLASS [-q] [--vid VID] [--pid PID] [--chunk-size SIZE] [--adaptive] [--ramdump DIR] [--profile PROFILE] [--profiles FILE] [--store DIR] [--images LIST] [--storage FILE] [--timeline FILE] [--phy PHY] [-v ...]
 
 Options:
     -C --class DEVICE_CLASS     class of the device or path to python file with device class
@@ -11,6 +11,16 @@ Options:
     -q --quiet                  quiet mode. only print warning/error messages
     --vid VID                   override vendor ID
     --pid PID                   override product ID
+    --chunk-size SIZE           size of sahara READ_DATA requests, up to 0x100000 (0x1000000 with read64)
+    --adaptive                  grow sahara READ_DATA requests while the host keeps up
+    --ramdump DIR               serve the region files in DIR in sahara memory debug mode
+    --profile PROFILE           sahara device profile, by index, name, hwid, pkhash or msm id (default: 0)
+    --profiles FILE             sahara device profile store, JSON or SQLite (default: qcom/profiles.json)
+    --store DIR                 keep sahara loaders in a content-addressed store in DIR
+    --images LIST               sahara image ids to request in one session, as ID[:FILE],... (default: 0xD)
+    --storage FILE              storage image served over firehose after the sahara session, or over streaming download
+    --timeline FILE             save the timeline of the sahara session as JSON on disconnect
+    --phy PHY                   physical layer, gadgetfs or gadgetfs-async (one event loop for all endpoints) [default: gadgetfs]
 
 Examples:
     emulate keyboard:
@@ -27,7 +37,7 @@ class Umap2EmulationApp(Umap2App):
 
     def run(self):
         self.fuzzer = self.get_fuzzer()
-        self.phy = self.load_phy("gadgetfs")
+        self.phy = self.load_phy(self.options.get('--phy') or 'gadgetfs')
         self.dev = self.load_device(self.options['--class'], self.phy)
         try:
             self.dev.connect()
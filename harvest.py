@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+'''
+Harvest Sahara loaders for many device profiles in one run
+
+Each queued profile is emulated until the host has downloaded every
+requested image from it or the per-profile timeout expires. The device is then
+disconnected, the next profile is swapped in and the device
+re-enumerates. Outcomes are recorded in index.json in the output
+directory: captured, corrupt (a capture failed hash verification),
+timeout or error.
+
+Usage:
+    umap2harvest [-q] [--profiles FILE] [--output DIR] [--timeout SEC] [--retries N] [--store DIR] [--images LIST] [--chunk-size SIZE] [--adaptive] [-v ...] [PROFILE ...]
+
+Options:
+    -v --verbose                verbosity level
+    -q --quiet                  quiet mode. only print warning/error messages
+    --profiles FILE             device profile store, JSON or SQLite (default: qcom/profiles.json)
+    --output DIR                directory for captured loaders and the results index [default: harvest]
+    --timeout SEC               give up on a profile after SEC seconds [default: 120]
+    --retries N                 queue a profile that timed out or was captured corrupt again, up to N times [default: 0]
+    --store DIR                 keep loaders in a content-addressed store in DIR, known images are skipped early
+    --images LIST               image ids to request in one session, as ID[:FILE],... (default: 0xD)
+    --chunk-size SIZE           size of sahara READ_DATA requests, up to 0x100000 (0x1000000 with read64)
+    --adaptive                  grow sahara READ_DATA requests while the host keeps up
+
+Examples:
+    harvest every profile of the default store:
+        umap2harvest
+    harvest two profiles by name and MSM id:
+        umap2harvest --timeout 60 "oneplus 3t" 0x007b00e1
+'''
+import os
+import json
+import time
+import traceback
+from collections import deque
+
+from emulate import Umap2EmulationApp
+from qcom.profiles import ProfileStore, DEFAULT_PROFILES
+from qcom.store import LoaderStore
+
+SAHARA_DEVICE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dev', 'sahara.py')
+# capture verdicts of a successful harvest, images without a hash table
+# cannot be verified
+ACCEPTED_VERDICTS = ('verified', 'unverified')
+
+
+class HarvestJob(object):
+    '''
+    A profile waiting in the harvest queue
+    '''
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.attempts = 0
+
+
+class Umap2HarvestApp(Umap2EmulationApp):
+
+    # time the host gets to notice the disconnect before re-enumerating
+    reenumerate_delay = 1.0
+
+    def __init__(self, docstring=None):
+        super(Umap2HarvestApp, self).__init__(docstring)
+        self.output_dir = self.options.get('--output') or 'harvest'
+        self.timeout = float(self.options.get('--timeout') or 120)
+        self.retries = int(self.options.get('--retries') or 0)
+        self.index_filename = os.path.join(self.output_dir, 'index.json')
+        self.results = []
+        self.queue = deque()
+        self.job = None
+        self.deadline = None
+        self.dev = None
+        store = self.options.get('--store')
+        self.store = LoaderStore(store) if store else None
+
+    def get_user_device_kwargs(self):
+        kwargs = super(Umap2HarvestApp, self).get_user_device_kwargs()
+        kwargs['profile'] = self.job.profile
+        kwargs['output_dir'] = self.output_dir
+        if self.store is not None:
+            kwargs['store'] = self.store
+        return kwargs
+
+    def should_stop_phy(self):
+        if self.dev is not None and self.dev.sahara.session_done:
+            return True
+        return time.time() > self.deadline
+
+    def load_jobs(self):
+        store = ProfileStore(self.options.get('--profiles') or DEFAULT_PROFILES)
+        keys = self.options.get('PROFILE') or []
+        if keys:
+            profiles = [store.find(key) for key in keys]
+        else:
+            profiles = list(store)
+        store.close()
+        self.queue.extend(HarvestJob(profile) for profile in profiles)
+        self.logger.info('Queued %d profiles' % len(self.queue))
+
+    def harvest(self, job):
+        '''
+        Emulate the profile of a job until a loader is captured or the
+        timeout expires
+
+        :return: result record for the index
+        '''
+        profile = job.profile
+        job.attempts += 1
+        self.job = job
+        self.dev = None
+        self.deadline = time.time() + self.timeout
+        self.logger.info('Harvesting %s (attempt %d)' % (profile, job.attempts))
+        result = {
+            'profile': profile.name,
+            'hwid': profile.hwid_str,
+            'pkhash': profile.pkhash_str,
+            'msm_id': '%#010x' % profile.msm_id,
+            'attempt': job.attempts,
+            'status': 'timeout',
+        }
+        start = time.time()
+        try:
+            self.dev = self.load_device(SAHARA_DEVICE, self.phy)
+            self.dev.connect()
+            self.dev.run()
+        except KeyboardInterrupt:
+            raise
+        except:
+            self.logger.error('Got exception while harvesting %s' % profile.name)
+            self.logger.error(traceback.format_exc())
+            result['status'] = 'error'
+        finally:
+            if self.dev is not None:
+                self.dev.disconnect()
+        result['elapsed'] = round(time.time() - start, 3)
+        if self.dev is not None and self.dev.sahara.captures:
+            captures = self.dev.sahara.captures
+            if all(verdict in ACCEPTED_VERDICTS for (_, _, verdict) in captures):
+                result['status'] = 'captured'
+            else:
+                result['status'] = 'corrupt'
+            result['captures'] = [
+                {'file': os.path.basename(filename), 'size': size, 'verdict': verdict}
+                for (filename, size, verdict) in captures
+            ]
+        return result
+
+    def write_index(self):
+        tmpname = self.index_filename + '.part'
+        with open(tmpname, 'w') as f:
+            json.dump(self.results, f, indent=4)
+        os.rename(tmpname, self.index_filename)
+
+    def run(self):
+        self.fuzzer = self.get_fuzzer()
+        self.phy = self.load_phy("gadgetfs")
+        self.dev = None
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        self.load_jobs()
+        start = time.time()
+        try:
+            while self.queue:
+                job = self.queue.popleft()
+                result = self.harvest(job)
+                self.results.append(result)
+                self.write_index()
+                self.logger.info('%s: %s in %.1f s' % (job.profile.name, result['status'], result['elapsed']))
+                if result['status'] in ('timeout', 'corrupt') and job.attempts <= self.retries:
+                    self.queue.append(job)
+                if self.queue:
+                    time.sleep(self.reenumerate_delay)
+        except KeyboardInterrupt:
+            self.logger.info('user terminated the run')
+        self.report(time.time() - start)
+
+    def report(self, elapsed):
+        captured = sum(1 for r in self.results if r['status'] == 'captured')
+        self.logger.info('Harvested %d loaders from %d attempts in %.1f s (%.1f loaders/hour)' % (
+            captured, len(self.results), elapsed, captured * 3600.0 / elapsed if elapsed else 0.0
+        ))
+        self.logger.info('Results index: %s' % self.index_filename)
+
+
+def main():
+    app = Umap2HarvestApp(__doc__)
+    app.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,491 @@
+'''
+Emulate a USB device via GadgetFS, driven by a single asyncio event loop
+
+Instead of a thread per endpoint, EP0 and all endpoint files are
+served from one event loop: readers and writers are registered on the
+non-blocking file descriptors, OUT data is handed to the device as it
+arrives and queued IN data is written whenever the endpoint accepts it.
+IN endpoints are offered to the device on the idle timeout, and on
+:meth:`AsyncGadgetFsPhy.wakeup` right away or once they drained.
+
+Each IN endpoint holds up to ``tx_limit`` bytes, pieces of transfers
+sent with ``more`` included: it is not offered to the device while
+full or while it has whole packets to write, and
+:meth:`AsyncGadgetFsPhy.send` waits for room. The pieces are written
+as lists of buffers, in requests of up to ``coalesce_limit`` bytes.
+
+Device handlers may stay synchronous, or be coroutines that await
+:meth:`AsyncGadgetFsPhy.send` and :meth:`AsyncGadgetFsPhy.receive`.
+OUT data goes to a pending receive() first, then to the endpoint
+handler. Data of endpoints without a handler waits for receive().
+Handlers of endpoints with a ``transfer_size`` get memoryviews valid
+until they return, receive() always returns a copy.
+
+.. note::
+
+    The GadgetFS endpoint files of most kernels do not implement poll,
+    and a read or write on them blocks until the host completes the
+    transfer. With ``pollable_endpoints`` off (the default) endpoint
+    I/O is therefore run in the loop's executor, keeping the same
+    awaitable API. Endpoint files that do poll (or stand-ins like pipes
+    and sockets) are served by the loop itself.
+'''
+import os
+import errno
+import struct
+import asyncio
+import inspect
+from collections import deque
+
+from usb.usb import DescriptorType
+from usb.usb_endpoint import USBEndpoint
+from phy.gadgetfs_phy import GadgetFsPhy, GFS_CMD_INIT_EP, IOV_MAX, TRANSFER_BUFFER_SIZE
+from phy.gadgetfs_phy import filter_descriptors, read_transfer, take_buffers, write_buffers
+
+
+class AsyncEndpoint(object):
+    '''
+    I/O state of one endpoint in the event loop
+    '''
+
+    # most bytes written at once, a multiple of any packet size
+    coalesce_limit = TRANSFER_BUFFER_SIZE
+
+    def __init__(self, phy, ep):
+        self.phy = phy
+        self.ep = ep
+        self.loop = phy.loop
+        self.fd = ep.fd
+        self.max_packet_size = ep._get_max_packet_size('highspeed')
+        # IN: pieces of the transfer in progress, not written yet
+        self.partial = deque()
+        self.partial_size = 0
+        # bytes of the transfer in progress already moved to pending
+        self.transfer_written = 0
+        # IN: (buffers, size, future or None, result) written as one request each
+        self.pending = deque()
+        # bytes in partial and pending, and senders waiting for room
+        self.queued = 0
+        self.limit = phy.tx_limit
+        self.room_waiters = deque()
+        self.writing = False
+        self.waiting_writer = False
+        # offer the endpoint again once drained, set by wakeup()
+        self.wanted = False
+        # OUT: data read but not received yet, and receivers waiting for it
+        self.received = deque()
+        self.receivers = deque()
+        self.reader = None
+
+    @property
+    def is_in(self):
+        return self.ep.direction == USBEndpoint.direction_in
+
+    def start(self):
+        if not self.is_in:
+            self.reader = asyncio.ensure_future(self._read_loop(), loop=self.loop)
+
+    def close(self):
+        '''
+        :return: the cancelled reader task, or None
+        '''
+        reader, self.reader = self.reader, None
+        if reader is not None:
+            reader.cancel()
+        if self.phy.pollable_endpoints:
+            self.loop.remove_reader(self.fd)
+            self.loop.remove_writer(self.fd)
+        self.wanted = False
+        self._drop_pending(None)
+        while self.receivers:
+            self.receivers.popleft().cancel()
+        return reader
+
+    def handling_write(self):
+        '''
+        :return: True while there are whole packets to write or the
+            endpoint is full. A shorter tail of a transfer only goes out
+            with the rest of it, so it does not keep the device from
+            sending that.
+        '''
+        return (
+            self.writing or bool(self.pending) or
+            self.partial_size >= self.max_packet_size or self.queued >= self.limit
+        )
+
+    # IN endpoints
+
+    def has_room(self, size):
+        return not self.queued or self.queued + size <= self.limit
+
+    async def wait_for_room(self, size):
+        '''
+        Wait until size more bytes fit in the endpoint's limit
+        '''
+        while not self.has_room(size):
+            waiter = self.loop.create_future()
+            self.room_waiters.append(waiter)
+            await waiter
+
+    def send(self, data, future=None, more=False):
+        '''
+        Queue data. Whole packets are written once the endpoint is free,
+        pieces of a transfer queued meanwhile are written together.
+
+        :param data: data to send
+        :param future: future set to the length of the transfer once it
+            is written (default: None)
+        :param more: more data of the same transfer follows (default: False)
+        '''
+        if len(data):
+            self.partial.append(memoryview(data))
+            self.partial_size += len(data)
+            self.queued += len(data)
+        if not more:
+            self._take_packets(True, future)
+        elif self.partial_size >= self.coalesce_limit:
+            self._take_packets(False)
+        if not self.writing and (self.pending or self.partial_size >= self.max_packet_size):
+            self.writing = True
+            # pieces sent by the same handler call are merged
+            self.loop.call_soon(self._start)
+
+    def _take_packets(self, end, future=None):
+        '''
+        Move the whole packets of partial to pending
+
+        :param end: partial ends the transfer, move all of it
+        :param future: future to set once the transfer is written (default: None)
+        '''
+        mps = self.max_packet_size
+        size = self.partial_size
+        if not end:
+            size -= size % mps
+        while size:
+            count = min(size, self.coalesce_limit)
+            self.partial_size -= count
+            buffers = take_buffers(self.partial, count)
+            if len(buffers) > IOV_MAX:
+                buffers = [memoryview(b''.join(buffers))]
+            self.pending.append((buffers, count, None, None))
+            self.transfer_written += count
+            size -= count
+        if not end:
+            return
+        length = self.transfer_written
+        if not length or (self.ep.zlp and length % mps == 0):
+            # an empty transfer, or the zero length packet ending one
+            self.pending.append(([], 0, None, None))
+        self.transfer_written = 0
+        if future is None:
+            return
+        if self.pending:
+            buffers, count, _, _ = self.pending[-1]
+            self.pending[-1] = (buffers, count, future, length)
+        elif not future.done():
+            future.set_result(length)
+
+    def _start(self):
+        if self.phy.pollable_endpoints:
+            self._flush()
+        else:
+            asyncio.ensure_future(self._write_blocking(), loop=self.loop)
+
+    def _next(self):
+        '''
+        :return: the next request to write, or None
+        '''
+        if not self.pending and self.partial_size >= self.max_packet_size:
+            self._take_packets(False)
+        return self.pending[0] if self.pending else None
+
+    def _flush(self):
+        '''
+        Write queued IN data until the endpoint would block
+        '''
+        while True:
+            request = self._next()
+            if request is None:
+                break
+            buffers, count, future, result = request
+            try:
+                if buffers:
+                    written = os.writev(self.fd, buffers)
+                else:
+                    written = os.write(self.fd, b'')
+            except OSError as err:
+                if err.errno != errno.EAGAIN:
+                    self._fail(err)
+                    return
+                written = None
+            if written is None or written < sum(len(b) for b in buffers):
+                if written:
+                    rest = deque(buffers)
+                    take_buffers(rest, written)
+                    self.pending[0] = (list(rest), count, future, result)
+                if not self.waiting_writer:
+                    self.loop.add_writer(self.fd, self._flush)
+                    self.waiting_writer = True
+                return
+            self._written()
+        if self.waiting_writer:
+            self.loop.remove_writer(self.fd)
+            self.waiting_writer = False
+        self._drained()
+
+    async def _write_blocking(self):
+        while True:
+            request = self._next()
+            if request is None:
+                break
+            try:
+                await self.loop.run_in_executor(None, write_buffers, self.fd, request[0])
+            except OSError as err:
+                self._fail(err)
+                return
+            self._written()
+        self._drained()
+
+    def _written(self):
+        _, count, future, result = self.pending.popleft()
+        self.queued -= count
+        if future is not None and not future.done():
+            future.set_result(result)
+        while self.room_waiters:
+            waiter = self.room_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _drained(self):
+        self.writing = False
+        if self.wanted:
+            self.phy.offer(self)
+
+    def _fail(self, err):
+        self.writing = False
+        self.phy.error('Error writing to EP%d: %s' % (self.ep.number, err))
+        self._drop_pending(err)
+
+    def _drop_pending(self, err):
+        '''
+        Drop the queued IN data, failing its senders with err, or
+        cancelling them if err is None
+        '''
+        while self.pending:
+            _, _, future, _ = self.pending.popleft()
+            if future is not None and not future.done():
+                if err is None:
+                    future.cancel()
+                else:
+                    future.set_exception(err)
+        self.partial.clear()
+        self.partial_size = 0
+        self.transfer_written = 0
+        self.queued = 0
+        while self.room_waiters:
+            waiter = self.room_waiters.popleft()
+            if not waiter.done():
+                waiter.cancel()
+
+    # OUT endpoints
+
+    async def read(self, buff):
+        '''
+        :param buff: buffer from the phy's pool to read into
+        :return: the next transfer read from the endpoint file
+        '''
+        pool = self.phy.buffer_pool
+        if not self.phy.pollable_endpoints:
+            return await self.loop.run_in_executor(None, read_transfer, self.fd, self.ep, pool, buff)
+        while True:
+            try:
+                return read_transfer(self.fd, self.ep, pool, buff)
+            except OSError as err:
+                if err.errno != errno.EAGAIN:
+                    raise
+            ready = self.loop.create_future()
+            self.loop.add_reader(self.fd, ready.set_result, None)
+            try:
+                await ready
+            finally:
+                self.loop.remove_reader(self.fd)
+
+    async def _read_loop(self):
+        pool = self.phy.buffer_pool
+        while True:
+            buff = pool.get()
+            try:
+                data = await self.read(buff)
+            except asyncio.CancelledError:
+                # an executor read may still fill the buffer, do not recycle it
+                raise
+            except OSError as err:
+                # the fd is closed on disconnect
+                if err.errno not in (errno.EBADF, errno.ESHUTDOWN):
+                    self.phy.error('Error reading from EP%d: %s' % (self.ep.number, err))
+                return
+            try:
+                if not data:
+                    # end of file of a stand-in endpoint
+                    return
+                if self.receivers:
+                    self.receivers.popleft().set_result(bytes(data))
+                elif callable(self.ep.handler):
+                    await self.phy.data_available(self.ep.number, data)
+                else:
+                    self.received.append(bytes(data))
+            finally:
+                pool.put(buff)
+
+    def receive(self):
+        future = self.loop.create_future()
+        if self.received:
+            future.set_result(self.received.popleft())
+        else:
+            self.receivers.append(future)
+        return future
+
+
+class AsyncGadgetFsPhy(GadgetFsPhy):
+    '''
+    Physical layer based on GadgetFS, with all endpoints served from one
+    asyncio event loop
+    '''
+
+    # endpoint files support poll, serve them without the executor
+    pollable_endpoints = False
+
+    def __init__(self, app, gadgetfs_dir='/dev/gadget', loop=None):
+        super(AsyncGadgetFsPhy, self).__init__(app, gadgetfs_dir)
+        self.name = 'AsyncGadgetFsPhy'
+        self.loop = loop or asyncio.new_event_loop()
+        self.endpoints = {}
+
+    def _create_wakeup_fd(self):
+        # wakeup() goes through the event loop
+        return None
+
+    def disconnect(self):
+        readers = []
+        for endpoint in self.endpoints.values():
+            reader = endpoint.close()
+            if reader is not None:
+                readers.append(reader)
+            os.close(endpoint.fd)
+            self.verbose('Closed fd: %d' % (endpoint.fd))
+        self.endpoints = {}
+        if readers and not self.loop.is_running():
+            # let the readers see their cancellation
+            self.loop.run_until_complete(asyncio.gather(*readers, return_exceptions=True))
+        if self.control_fd:
+            self.loop.remove_reader(self.control_fd)
+        return super(AsyncGadgetFsPhy, self).disconnect()
+
+    def run(self):
+        '''
+        run the event loop until the application says to stop
+        '''
+        self.loop.run_until_complete(self.serve())
+
+    async def serve(self):
+        self.debug('Started event loop')
+        self.stop = False
+        self.loop.add_reader(self.control_fd, self._handle_ep0)
+        try:
+            while not self.stop:
+                await asyncio.sleep(self.idle_timeout)
+                if self.app.should_stop_phy():
+                    self.stop = True
+                for endpoint in list(self.endpoints.values()):
+                    if endpoint.is_in and not endpoint.handling_write():
+                        self.offer(endpoint)
+        finally:
+            self.loop.remove_reader(self.control_fd)
+        self.debug('Done with event loop')
+
+    def offer(self, endpoint):
+        endpoint.wanted = False
+        self.buffer_available(endpoint.ep.number)
+
+    def buffer_available(self, ep_num):
+        if self.connected_device is not None:
+            self.connected_device.handle_buffer_available(ep_num)
+
+    async def data_available(self, ep_num, data):
+        result = self.connected_device.handle_data_available(ep_num, data)
+        if inspect.isawaitable(result):
+            await result
+
+    def _in_endpoint(self, ep_num):
+        endpoint = self.endpoints.get(ep_num | 0x80, None)
+        if endpoint is None:
+            raise Exception('No IN endpoint %#x (address %#x)' % (ep_num, ep_num | 0x80))
+        return endpoint
+
+    def send_on_endpoint(self, ep_num, data, more=False):
+        if ep_num == 0:
+            self.send_on_ep0(data)
+            return
+        self._in_endpoint(ep_num).send(data, more=more)
+
+    async def send(self, ep_num, data, more=False):
+        '''
+        Send data on an IN endpoint, waiting for room first if the
+        endpoint holds tx_limit bytes already
+
+        :param more: more data of the same transfer follows, return once
+            data is queued (default: False)
+        :return: length of the transfer once it is written, or of data
+            once queued with more
+        '''
+        if ep_num == 0:
+            self.send_on_ep0(data)
+            return len(data)
+        endpoint = self._in_endpoint(ep_num)
+        await endpoint.wait_for_room(len(data))
+        if more:
+            endpoint.send(data, more=True)
+            return len(data)
+        future = self.loop.create_future()
+        endpoint.send(data, future)
+        return await future
+
+    async def receive(self, ep_num):
+        '''
+        :return: the next buffer received on an OUT endpoint
+        '''
+        endpoint = self.endpoints.get(ep_num, None)
+        if endpoint is None:
+            raise Exception('No OUT endpoint %#x' % ep_num)
+        return await endpoint.receive()
+
+    def wakeup(self):
+        self.loop.call_soon_threadsafe(self._offer_buffers)
+
+    def _offer_buffers(self):
+        for endpoint in list(self.endpoints.values()):
+            if endpoint.is_in:
+                endpoint.wanted = True
+                if not endpoint.handling_write():
+                    self.offer(endpoint)
+
+    def _ep_already_opened(self, ep):
+        return ep.address in self.endpoints
+
+    def _update_ep(self, ep):
+        self.endpoints[ep.address].ep = ep
+
+    def _setup_endpoint(self, ep):
+        if self._ep_already_opened(ep):
+            self._update_ep(ep)
+            return
+        self._open_endpoint_fd(ep)
+        buff = struct.pack('I', GFS_CMD_INIT_EP)
+        descs = ep.get_descriptor(usb_type='fullspeed', valid=True)
+        if self._is_high_speed():
+            descs += ep.get_descriptor(usb_type='highspeed', valid=True)
+        buff += filter_descriptors(descs, DescriptorType.endpoint)
+        os.write(ep.fd, buff)
+        endpoint = AsyncEndpoint(self, ep)
+        self.endpoints[ep.address] = endpoint
+        endpoint.start()
@@ -9,6 +9,27 @@ Due to the blocking nature of the endpoint files, and since there is no
 implementation for poll/select for the endpoints, we create a separate thread
 for each endpoint when a USB host is connected to the device.
 
+The run loop sleeps until EP0 has an event or the device calls
+:meth:`GadgetFsPhy.wakeup`, and only then offers the IN endpoints to the
+device. An endpoint busy at that time is offered again once its queue
+drained; a drain alone does not offer it, so a device with nothing to
+send is not polled at the rate the host reads. A coarse idle timeout
+keeps time based devices going.
+
+OUT endpoints with a ``transfer_size`` are read a whole transfer at a
+time into recycled buffers. A read only completes once it is full or on
+a short packet, so the size must not exceed what the host sends next.
+
+IN queues are bounded by ``tx_limit`` bytes: a device sending faster
+than the host reads blocks until there is room again. Queue depth and
+producer wait counters are logged on disconnect, see
+:meth:`GadgetFsPhy.queue_stats`.
+
+Pieces of an IN transfer queued with ``more`` are merged into large
+writes. Each write is submitted as its own request, so a transfer is
+only split at whole packets, and ends with a zero length packet on
+endpoints with ``zlp`` if its length is a multiple of the packet size.
+
 .. note::
 
     Before kernel v4.8, there was a bug in the sync i/o mechanism of the
@@ -27,15 +48,20 @@ import time
 import struct
 import select
 import os
+import errno
+import fcntl
+import logging
 from binascii import hexlify
+from collections import deque
 import threading
 
-from six.moves.queue import Queue, Empty
+from six.moves.queue import Empty
 
 from usb.usb import Request, DescriptorType
 from usb.usb_device import USBDeviceRequest
 from usb.usb_endpoint import USBEndpoint
 from phy.iphy import PhyInterface
+from phy.tx_queue import TxQueue, DEFAULT_TX_LIMIT
 
 
 GFS_CMD_INIT_DEVICE = 0
@@ -51,6 +77,142 @@ GFS_EVENT_SIZE = 12
 
 GFS_EVENT_TYPE_OFFSET = 8
 
+# largest OUT transfer read at once, and largest IN write
+TRANSFER_BUFFER_SIZE = 0x10000
+
+# most buffers passed to a single writev
+IOV_MAX = 1024
+
+
+class WakeupFd(object):
+    '''
+    File descriptor other threads make readable to wake up a select
+    loop: an eventfd where available, a pipe otherwise
+    '''
+
+    def __init__(self):
+        if hasattr(os, 'eventfd'):
+            self.rfd = self.wfd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+            self.is_eventfd = True
+        else:
+            self.rfd, self.wfd = os.pipe()
+            for fd in (self.rfd, self.wfd):
+                fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            self.is_eventfd = False
+
+    def fileno(self):
+        return self.rfd
+
+    def notify(self):
+        try:
+            if self.is_eventfd:
+                os.eventfd_write(self.wfd, 1)
+            else:
+                os.write(self.wfd, b'\x01')
+        except OSError as err:
+            # already pending
+            if err.errno != errno.EAGAIN:
+                raise
+
+    def drain(self):
+        try:
+            if self.is_eventfd:
+                os.eventfd_read(self.rfd)
+            else:
+                while os.read(self.rfd, 0x100):
+                    pass
+        except OSError as err:
+            if err.errno != errno.EAGAIN:
+                raise
+
+    def close(self):
+        os.close(self.rfd)
+        if self.wfd != self.rfd:
+            os.close(self.wfd)
+
+
+class BufferPool(object):
+    '''
+    Recycled receive buffers, so that large OUT reads do not allocate
+    '''
+
+    def __init__(self, size=TRANSFER_BUFFER_SIZE, count=4):
+        '''
+        :param size: size of each buffer (default: TRANSFER_BUFFER_SIZE)
+        :param count: number of buffers allocated up front (default: 4)
+        '''
+        self.size = size
+        self.free = [bytearray(size) for _ in range(count)]
+
+    def get(self):
+        try:
+            return self.free.pop()
+        except IndexError:
+            return bytearray(self.size)
+
+    def put(self, buff):
+        self.free.append(buff)
+
+
+def read_transfer(fd, ep, pool, buff):
+    '''
+    Read the next OUT transfer of an endpoint
+
+    :param buff: buffer from pool, used if the endpoint has a transfer size
+    :return: the data read, a memoryview into buff for endpoints with a
+        transfer size, bytes otherwise
+    '''
+    size = ep.transfer_size
+    if not size:
+        return os.read(fd, ep._get_max_packet_size('highspeed'))
+    if size < pool.size:
+        count = os.readv(fd, [memoryview(buff)[:size]])
+    else:
+        count = os.readv(fd, [buff])
+    return memoryview(buff)[:count]
+
+
+def take_buffers(pieces, count):
+    '''
+    :param pieces: deque of memoryviews, the taken bytes are removed
+    :param count: number of bytes to take
+    :return: list of buffers holding the next count bytes of the pieces
+    '''
+    buffers = []
+    while count:
+        piece = pieces[0]
+        if len(piece) <= count:
+            pieces.popleft()
+        else:
+            pieces[0] = piece[count:]
+            piece = piece[:count]
+        buffers.append(piece)
+        count -= len(piece)
+    return buffers
+
+
+def write_buffers(fd, buffers):
+    '''
+    Write buffers to a blocking endpoint file as a single request, no
+    buffers at all are written as a zero length packet
+    '''
+    if not buffers:
+        os.write(fd, b'')
+        return
+    if len(buffers) == 1:
+        data = buffers[0]
+    elif len(buffers) <= IOV_MAX:
+        total = sum(len(b) for b in buffers)
+        written = os.writev(fd, buffers)
+        if written == total:
+            return
+        data = memoryview(b''.join(buffers))[written:]
+    else:
+        data = memoryview(b''.join(buffers))
+    while len(data):
+        data = data[os.write(fd, data):]
+
+
 def filter_descriptors(data, keep_dt):
     '''
     Keep only descriptors with given descriptor type
@@ -102,7 +264,15 @@ class GadgetFsPhy(PhyInterface):
         '20980000.usb'
     ]
 
-    def __init__(self, app, gadgetfs_dir='/dev/gadget'):
+    # seconds the run loop sleeps at most when nothing happens
+    idle_timeout = 0.1
+
+    def __init__(self, app, gadgetfs_dir='/dev/gadget', tx_limit=DEFAULT_TX_LIMIT):
+        '''
+        :param app: Umap2 application
+        :param gadgetfs_dir: GadgetFS mount point (default: /dev/gadget)
+        :param tx_limit: most bytes queued on each IN endpoint (default: 1 MB)
+        '''
         super(GadgetFsPhy, self).__init__(app, 'GadgetFsPhy')
         if platform.system() != 'Linux':
             raise Exception('GadgetFsPhy is only supported on Linux')
@@ -113,7 +283,15 @@ class GadgetFsPhy(PhyInterface):
         # we need to use separate thread for each endpoint ...
         self.ep_threads = {}
         self.in_ep_threads = []
+        self.wakeup_fd = self._create_wakeup_fd()
+        self.buffer_pool = BufferPool()
+        self.tx_limit = tx_limit
 
+    def _create_wakeup_fd(self):
+        '''
+        :return: the fd other threads wake the run loop with
+        '''
+        return WakeupFd()
 
     def _get_control_filename(self):
         '''
@@ -158,6 +336,10 @@ class GadgetFsPhy(PhyInterface):
         # signal threads to stop the loop
         for _, t in self.ep_threads.items():
             t.stop_evt.set()
+        for ept in self.in_ep_threads:
+            self.info('EP%d queue: %s' % (ept.ep.number, ept.queue.stats()))
+            # release handlers blocked on a full queue
+            ept.queue.clear()
         # close all file descriptors
         fds = [t.ep.fd for (_, t) in self.ep_threads.items()]
         for fd in fds:
@@ -180,24 +362,45 @@ class GadgetFsPhy(PhyInterface):
         '''
         self.debug('Started run loop')
         self.stop = False
+        fds = [self.control_fd, self.wakeup_fd]
         while not self.stop:
-            ready_eps, _, _ = select.select([self.control_fd], [], [], 0.001)
-            if ready_eps:
+            ready, _, _ = select.select(fds, [], [], self.idle_timeout)
+            if self.wakeup_fd in ready:
+                self.wakeup_fd.drain()
+            if self.control_fd in ready:
                 self._handle_ep0()
             if self.app.should_stop_phy():
                 self.stop = True
             for ept in self.in_ep_threads:
                 if not ept.handling_write():
+                    ept.wanted = False
                     self.connected_device.handle_buffer_available(ept.ep.number)
         self.debug('Done with run loop')
 
-    def send_on_endpoint(self, ep_num, data):
-        self.debug('send_on_endpoint %d(%d): %s' % (ep_num, len(data), hexlify(data)))
+    def wakeup(self):
+        '''
+        Have the run loop offer the IN endpoints to the device now, and
+        again to those still busy once they drained
+        '''
+        for ept in self.in_ep_threads:
+            ept.wanted = True
+        self.wakeup_fd.notify()
+
+    def queue_stats(self):
+        '''
+        :return: dict of IN endpoint number -> queue depth and wait counters
+        '''
+        return dict((ept.ep.number, ept.queue.stats()) for ept in self.in_ep_threads)
+
+    def send_on_endpoint(self, ep_num, data, more=False):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            # don't hexlify (and copy) bulk data nobody is going to see
+            self.debug('send_on_endpoint %d(%d): %s' % (ep_num, len(data), hexlify(data)))
         address = ep_num | 0x80
         if ep_num == 0:
             self.send_on_ep0(data)
         elif address in self.ep_threads:
-            self.ep_threads[address].send(data)
+            self.ep_threads[address].send(data, more)
         else:
             raise Exception('No IN endpoint %#x (address %#x)' % (ep_num, address))
 
@@ -362,44 +565,105 @@ class EndpointThread(threading.Thread):
 
 class InEpThread(EndpointThread):
 
+    # most bytes written at once, a multiple of any packet size
+    coalesce_limit = TRANSFER_BUFFER_SIZE
+
     def __init__(self, phy, ep):
         super(InEpThread, self).__init__(phy, ep)
-        self.queue = Queue()
+        self.queue = TxQueue(phy.tx_limit)
+        self.writing = False
+        # the device asked for an offer with wakeup(), a drain alone does
+        # not offer the endpoint again so devices with nothing to say
+        # are not polled at the rate the host reads
+        self.wanted = False
+        self.max_packet_size = ep._get_max_packet_size('highspeed')
+        # queued data of the transfer in progress, not written yet
+        self.pieces = deque()
+        self.pieces_size = 0
+        # bytes of the transfer in progress already written
+        self.transfer_written = 0
+
+    def send(self, data, more=False):
+        '''
+        Queue data, waiting for room if the queue is full
 
-    def send(self, data):
-        #print("Queued TX: ")
-        #print(data)
-        self.queue.put(data)
-        #os.write(self.ep.fd, data)
+        :param data: data to send
+        :param more: more data of the same transfer follows (default: False)
+        '''
+        self.queue.put(data, more)
 
     def handling_write(self):
-        return not self.queue.empty()
+        return self.writing or not self.queue.empty()
 
     def io_op(self):
-        #print("Send queue: ")
         '''
-         Fetch data from send queue and write to endpoint
+        Fetch data from send queue and write to endpoint, merging the
+        queued pieces of a transfer
         '''
         try:
-            data = self.queue.get(True, 0.1)
-            os.write(self.ep.fd, data)
+            data, more = self.queue.get(True, 0.1)
         except Empty:
-            pass
+            return
+        self.writing = True
+        try:
+            self._add_piece(data)
+            while more and self.pieces_size < self.coalesce_limit:
+                try:
+                    data, more = self.queue.get_nowait()
+                except Empty:
+                    break
+                self._add_piece(data)
+            self._write_pieces(not more)
+        finally:
+            self.writing = False
+            if self.wanted and self.queue.empty():
+                self.phy.wakeup_fd.notify()
+
+    def _add_piece(self, data):
+        if len(data):
+            self.pieces.append(memoryview(data))
+            self.pieces_size += len(data)
+
+    def _write_pieces(self, end):
+        '''
+        :param end: the pieces end the transfer, otherwise only whole
+            packets are written and the rest waits for more data
+        '''
+        mps = self.max_packet_size
+        size = self.pieces_size
+        if not end:
+            size -= size % mps
+        while size:
+            count = min(size, self.coalesce_limit)
+            self._write(self._take(count))
+            size -= count
+            self.transfer_written += count
+        if end:
+            if not self.transfer_written or (self.ep.zlp and self.transfer_written % mps == 0):
+                # an empty transfer, or the zero length packet ending one
+                os.write(self.ep.fd, b'')
+            self.transfer_written = 0
+
+    def _take(self, count):
+        self.pieces_size -= count
+        return take_buffers(self.pieces, count)
+
+    def _write(self, buffers):
+        write_buffers(self.ep.fd, buffers)
 #	print(data)
 
 
 class OutEpThread(EndpointThread):
 
-    def __init__(self, phy, ep):
-        super(OutEpThread, self).__init__(phy, ep)
-        self.read_size = self.ep._get_max_packet_size('highspeed')
-
     def io_op(self):
         '''
         read data from endpoint fd and let the endpoint handle it
         '''
-        self.phy.debug('About to read from EP%d' % (self.ep.number))
-        buff = os.read(self.ep.fd, self.read_size)
-        self.phy.debug('Done reading from EP%d' % (self.ep.number))
-        self.phy.connected_device.handle_data_available(self.ep.number, buff)
+        pool = self.phy.buffer_pool
+        buff = pool.get()
+        try:
+            data = read_transfer(self.ep.fd, self.ep, pool, buff)
+            self.phy.connected_device.handle_data_available(self.ep.number, data)
+        finally:
+            pool.put(buff)
 
@@ -48,15 +48,24 @@ class PhyInterface(object):
     def is_connected(self):
         return self.connected_device is not None
 
-    def send_on_endpoint(self, ep_num, data):
+    def send_on_endpoint(self, ep_num, data, more=False):
         '''
         Send data on a specific endpoint
 
         :param ep_num: number of endpoint
         :param data: data to send
+        :param more: data is not the end of the transfer, more of it
+            follows with the next call (default: False)
         '''
         raise NotImplementedError('should be implemented in subclass')
 
+    def wakeup(self):
+        '''
+        Ask the phy to offer its IN endpoints to the device soon, for
+        devices that produce IN data outside of the phy's callbacks
+        '''
+        pass
+
     def stall_ep0(self):
         '''
         Stalls control endpoint (0)
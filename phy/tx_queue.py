@@ -0,0 +1,142 @@
+'''
+Queue of data waiting to be sent to the host, bounded by the number of
+bytes it holds.
+
+A host that reads slower than a device produces would otherwise let the
+queue grow without limit. Producers block in :meth:`TxQueue.put` while
+the queue is full, or get :class:`Full` right away with ``block=False``
+and can try again once the consumer took data. The time producers spend
+waiting is counted, so a slow host shows up in :meth:`TxQueue.stats`.
+'''
+import time
+import threading
+from collections import deque
+
+from six.moves.queue import Empty, Full
+
+# bytes queued at most by default
+DEFAULT_TX_LIMIT = 0x100000
+
+
+class TxQueue(object):
+    '''
+    Queue of (data, more) pieces of IN transfers
+    '''
+
+    def __init__(self, limit=DEFAULT_TX_LIMIT):
+        '''
+        :param limit: most bytes queued, a single piece larger than that
+            is still accepted by an empty queue (default: 1 MB)
+        '''
+        self.limit = limit
+        self.items = deque()
+        self.size = 0
+        self.cond = threading.Condition()
+        # bumped by clear(), to tell waiting producers their data is stale
+        self.generation = 0
+        self.max_size = 0
+        self.puts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.dropped = 0
+
+    def _has_room(self, size):
+        return not self.items or self.size + size <= self.limit
+
+    def put(self, data, more=False, block=True, timeout=None):
+        '''
+        :param data: data to queue
+        :param more: more data of the same transfer follows (default: False)
+        :param block: wait for room if the queue is full (default: True)
+        :param timeout: most seconds to wait, None to wait as long as it
+            takes (default: None)
+        :raises Full: if there is no room and block is False, or timeout
+            expired
+        :return: True if queued, False if the queue was cleared while
+            waiting for room and the data dropped
+        '''
+        size = len(data)
+        with self.cond:
+            if not self._has_room(size):
+                if not block:
+                    raise Full()
+                generation = self.generation
+                start = time.time()
+                deadline = None if timeout is None else start + timeout
+                while not self._has_room(size) and generation == self.generation:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                waited = time.time() - start
+                self.waits += 1
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+                if generation != self.generation:
+                    self.dropped += 1
+                    return False
+                if not self._has_room(size):
+                    raise Full()
+            self.items.append((data, more))
+            self.size += size
+            self.max_size = max(self.max_size, self.size)
+            self.puts += 1
+            self.cond.notify_all()
+        return True
+
+    def get(self, block=True, timeout=None):
+        '''
+        :param block: wait for data if the queue is empty (default: True)
+        :param timeout: most seconds to wait, None to wait as long as it
+            takes (default: None)
+        :raises Empty: if there is no data
+        :return: (data, more)
+        '''
+        with self.cond:
+            if not self.items:
+                if not block:
+                    raise Empty()
+                self.cond.wait_for(lambda: self.items, timeout)
+                if not self.items:
+                    raise Empty()
+            data, more = self.items.popleft()
+            self.size -= len(data)
+            self.cond.notify_all()
+        return data, more
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def empty(self):
+        return not self.items
+
+    def qsize(self):
+        return len(self.items)
+
+    def clear(self):
+        '''
+        Drop the queued data, and the data of producers waiting for room
+        '''
+        with self.cond:
+            self.dropped += len(self.items)
+            self.items.clear()
+            self.size = 0
+            self.generation += 1
+            self.cond.notify_all()
+
+    def stats(self):
+        '''
+        :return: dict of queue depth and producer wait counters
+        '''
+        return {
+            'bytes': self.size,
+            'items': len(self.items),
+            'limit': self.limit,
+            'max_bytes': self.max_size,
+            'puts': self.puts,
+            'waits': self.waits,
+            'wait_time': round(self.wait_time, 6),
+            'max_wait': round(self.max_wait, 6),
+            'dropped': self.dropped,
+        }
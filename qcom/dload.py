@@ -0,0 +1,358 @@
+'''
+DMSS download protocol emulation.
+
+Legacy tools put a phone in download mode with the DIAG command 0x3A
+and then talk DMSS download to its boot ROM: HDLC framed packets, each
+a command byte followed by big endian arguments and protected by a
+CRC-16/CCITT, as in::
+
+    7E 02 6A D3 7E      ACK
+
+The host writes a programmer to memory with write commands, asks the
+target to run it with go and queries the target with nop and parameter
+requests. The memory written to is kept in a :class:`MemoryImage`, so
+the programmer can be saved once the host hands control to it.
+'''
+import struct
+import binascii
+
+from qcom.target import QcomTarget
+
+HDLC_FLAG = b'\x7e'
+HDLC_ESCAPE = b'\x7d'
+HDLC_ESCAPE_MASK = 0x20
+
+CRC_INIT = 0xFFFF
+# CRC over a packet followed by its own (inverted) CRC
+CRC_GOOD = 0xF0B8
+
+# bit reversed bytes: HDLC sends the least significant bit first
+REVERSE_TABLE = bytes(bytearray(int('{:08b}'.format(i)[::-1], 2) for i in range(256)))
+REVERSE_BYTES = bytearray(REVERSE_TABLE)
+
+
+def _reverse16(value):
+    return (REVERSE_BYTES[value & 0xFF] << 8) | REVERSE_BYTES[value >> 8]
+
+
+def crc16(data, crc=CRC_INIT):
+    '''
+    The table driven CRC-16/CCITT of binascii works most significant bit
+    first, on bit reversed data it gives the bit reversed HDLC CRC.
+
+    :param data: bytes to checksum
+    :param crc: initial value, to continue a previous computation
+    :return: CRC-16/CCITT of data, as used by HDLC (not inverted)
+    '''
+    return _reverse16(binascii.crc_hqx(data.translate(REVERSE_TABLE), _reverse16(crc)))
+
+
+def hdlc_escape(data):
+    return data.replace(HDLC_ESCAPE, b'\x7d\x5d').replace(HDLC_FLAG, b'\x7d\x5e')
+
+
+def hdlc_unescape(data):
+    '''
+    :raises: Exception if an escape byte is not followed by another byte
+    '''
+    if HDLC_ESCAPE not in data:
+        return data
+    parts = data.split(HDLC_ESCAPE)
+    if not all(parts[1:]):
+        raise Exception('Bad HDLC escape sequence')
+    return parts[0] + b''.join(
+        struct.pack('B', part[0] ^ HDLC_ESCAPE_MASK) + part[1:] for part in (bytearray(p) for p in parts[1:])
+    )
+
+
+def hdlc_frame(payload):
+    '''
+    :param payload: packet to send
+    :return: the packet with its CRC, escaped and enclosed in flags
+    '''
+    crc = crc16(payload) ^ 0xFFFF
+    return HDLC_FLAG + hdlc_escape(payload + struct.pack('<H', crc)) + HDLC_FLAG
+
+
+class HdlcDecoder(object):
+    '''
+    Splits a byte stream into HDLC packets. As with Firehose framing,
+    each byte is scanned for the closing flag only once.
+    '''
+
+    def __init__(self):
+        self.buff = bytearray()
+        self.scanned = 0
+
+    def feed(self, data):
+        self.buff += data
+
+    def next_frame(self):
+        '''
+        :return: the next unescaped frame with its CRC, or None
+        '''
+        while True:
+            end = self.buff.find(HDLC_FLAG, self.scanned)
+            if end < 0:
+                self.scanned = len(self.buff)
+                return None
+            frame = bytes(self.buff[:end])
+            del self.buff[:end + 1]
+            self.scanned = 0
+            if frame:
+                # empty frames are opening flags
+                return hdlc_unescape(frame)
+
+    def pending(self):
+        return len(self.buff)
+
+    def reset(self):
+        self.buff = bytearray()
+        self.scanned = 0
+
+
+class HdlcTarget(QcomTarget):
+    '''
+    Base of the targets speaking HDLC framed packets. Subclasses handle
+    packets in :meth:`handle_packet` and report framing errors to the
+    host in :meth:`bad_frame` and :meth:`frame_too_long`.
+
+    :param send: callable sending data on the IN endpoint
+    '''
+
+    # buffered bytes without a closing flag before a frame is dropped
+    MAX_FRAME_SIZE = 0x820
+
+    def __init__(self, send):
+        super(HdlcTarget, self).__init__(send)
+        self.decoder = HdlcDecoder()
+
+    def receive_frames(self, data):
+        '''
+        Handle the complete frames in data, keep the rest for later
+
+        :param data: HDLC framed data received on the OUT endpoint
+        '''
+        decoder = self.decoder
+        decoder.feed(data)
+        while True:
+            try:
+                frame = decoder.next_frame()
+            except Exception as err:
+                self.bad_frame(str(err))
+                continue
+            if frame is None:
+                break
+            if len(frame) < 3 or crc16(frame) != CRC_GOOD:
+                self.bad_frame('Bad frame CRC')
+                continue
+            self.handle_packet(frame[:-2])
+        if decoder.pending() > self.MAX_FRAME_SIZE:
+            decoder.reset()
+            self.frame_too_long()
+
+    def handle_packet(self, packet):
+        '''
+        :param packet: unescaped packet, without its CRC
+        '''
+        raise NotImplementedError('should be implemented in subclass')
+
+    def bad_frame(self, reason):
+        '''
+        :param reason: why the frame was dropped
+        '''
+        raise NotImplementedError('should be implemented in subclass')
+
+    def frame_too_long(self):
+        raise NotImplementedError('should be implemented in subclass')
+
+
+class MemoryImage(object):
+    '''
+    Target memory the host downloads to. Only a window of size bytes is
+    backed, placed at the first address written to.
+    '''
+
+    def __init__(self, size=0x1000000, alignment=0x100000):
+        '''
+        :param size: size of the window (default: 16 MB)
+        :param alignment: alignment of the window base (default: 1 MB)
+        '''
+        self.size = size
+        self.alignment = alignment
+        self.base = None
+        self.data = bytearray(size)
+        # extent of the memory written so far
+        self.low = None
+        self.high = None
+
+    def write(self, address, data):
+        '''
+        :return: False if the data falls outside the window
+        '''
+        if self.base is None:
+            self.base = address - address % self.alignment
+        offset = address - self.base
+        if offset < 0 or offset + len(data) > self.size:
+            return False
+        self.data[offset:offset + len(data)] = data
+        if self.low is None:
+            self.low, self.high = address, address + len(data)
+        else:
+            self.low = min(self.low, address)
+            self.high = max(self.high, address + len(data))
+        return True
+
+    def written(self):
+        '''
+        :return: (address, memoryview) of the memory written so far
+        '''
+        if self.low is None:
+            return None, memoryview(b'')
+        return self.low, memoryview(self.data)[self.low - self.base:self.high - self.base]
+
+
+class DmssTarget(HdlcTarget):
+    '''
+    The boot ROM side of the DMSS download protocol
+
+    :param memory: :class:`MemoryImage` to write to
+    :param send: callable sending data on the IN endpoint
+    :param go: callable invoked with the address the host jumps to
+        (default: None)
+    '''
+
+    name = 'DMSS'
+
+    CMD_WRITE = 0x01
+    CMD_ACK = 0x02
+    CMD_NAK = 0x03
+    CMD_ERASE = 0x04
+    CMD_GO = 0x05
+    CMD_NOP = 0x06
+    CMD_PARAM_REQ = 0x07
+    CMD_PARAM_RSP = 0x08
+    CMD_RESET = 0x0A
+    CMD_VERSION_REQ = 0x0C
+    CMD_VERSION_RSP = 0x0D
+    CMD_POWER_OFF = 0x0E
+    CMD_WRITE_32BIT = 0x0F
+
+    NAK_INVALID_FCS = 0x01
+    NAK_INVALID_DEST = 0x02
+    NAK_INVALID_LEN = 0x03
+    NAK_EARLY_END = 0x04
+    NAK_TOO_LARGE = 0x05
+    NAK_INVALID_CMD = 0x06
+
+    PROTOCOL_VERSION = 8
+    MIN_PROTOCOL_VERSION = 2
+    MAX_WRITE_SIZE = 0x400
+    MAX_FRAME_SIZE = 2 * MAX_WRITE_SIZE + 0x20
+    VERSION = b'Emulated DMSS boot ROM'
+
+    WRITE_HEADER = struct.Struct('>BBHH')
+    WRITE_32BIT_HEADER = struct.Struct('>BIH')
+    GO_PKT = struct.Struct('>BHH')
+    PARAM_RSP_PKT = struct.Struct('>BBBHBBB')
+
+    ACK = hdlc_frame(struct.pack('B', CMD_ACK))
+
+    def __init__(self, memory, send, go=None):
+        super(DmssTarget, self).__init__(send)
+        self.memory = memory
+        self.go = go
+        self.handlers = {
+            self.CMD_WRITE: self.handle_write,
+            self.CMD_WRITE_32BIT: self.handle_write_32bit,
+            self.CMD_GO: self.handle_go,
+            self.CMD_NOP: self.handle_nop,
+            self.CMD_PARAM_REQ: self.handle_param_req,
+            self.CMD_VERSION_REQ: self.handle_version_req,
+            self.CMD_RESET: self.handle_reset,
+            self.CMD_POWER_OFF: self.handle_reset,
+        }
+        self.param_rsp = hdlc_frame(self.PARAM_RSP_PKT.pack(
+            self.CMD_PARAM_RSP, self.PROTOCOL_VERSION, self.MIN_PROTOCOL_VERSION, self.MAX_WRITE_SIZE, 0, 0, 0
+        ))
+        self.naks = {}
+
+    def ack(self):
+        self.send(self.ACK)
+
+    def nak(self, reason):
+        packet = self.naks.get(reason, None)
+        if packet is None:
+            packet = self.naks[reason] = hdlc_frame(struct.pack('>BH', self.CMD_NAK, reason))
+        self.send(packet)
+
+    def handle_data(self, data):
+        '''
+        :param data: data received on the OUT endpoint
+        '''
+        self.receive_frames(data)
+
+    def bad_frame(self, reason):
+        self.warning(reason)
+        self.nak(self.NAK_INVALID_FCS)
+
+    def frame_too_long(self):
+        self.nak(self.NAK_TOO_LARGE)
+
+    def handle_packet(self, packet):
+        cmd = bytearray(packet)[0]
+        handler = self.handlers.get(cmd, None)
+        if handler is None:
+            self.warning('Unsupported command %#x' % cmd)
+            self.nak(self.NAK_INVALID_CMD)
+            return
+        handler(packet)
+
+    def _write(self, address, length, data):
+        if len(data) != length:
+            self.nak(self.NAK_INVALID_LEN)
+        elif length > self.MAX_WRITE_SIZE:
+            self.nak(self.NAK_TOO_LARGE)
+        elif not self.memory.write(address, data):
+            self.warning('Write to %#x out of range' % address)
+            self.nak(self.NAK_INVALID_DEST)
+        else:
+            self.ack()
+
+    def handle_write(self, packet):
+        if len(packet) < self.WRITE_HEADER.size:
+            self.nak(self.NAK_EARLY_END)
+            return
+        _, high, low, length = self.WRITE_HEADER.unpack_from(packet)
+        self._write((high << 16) | low, length, packet[self.WRITE_HEADER.size:])
+
+    def handle_write_32bit(self, packet):
+        if len(packet) < self.WRITE_32BIT_HEADER.size:
+            self.nak(self.NAK_EARLY_END)
+            return
+        _, address, length = self.WRITE_32BIT_HEADER.unpack_from(packet)
+        self._write(address, length, packet[self.WRITE_32BIT_HEADER.size:])
+
+    def handle_go(self, packet):
+        if len(packet) < self.GO_PKT.size:
+            self.nak(self.NAK_EARLY_END)
+            return
+        _, high, low = self.GO_PKT.unpack_from(packet)
+        address = (high << 16) | low
+        self.info('Go to %#x' % address)
+        self.ack()
+        if self.go is not None:
+            self.go(address)
+
+    def handle_nop(self, packet):
+        self.ack()
+
+    def handle_param_req(self, packet):
+        self.send(self.param_rsp)
+
+    def handle_version_req(self, packet):
+        self.send(hdlc_frame(struct.pack('BB', self.CMD_VERSION_RSP, len(self.VERSION)) + self.VERSION))
+
+    def handle_reset(self, packet):
+        self.info('Reset')
+        self.ack()
@@ -0,0 +1,372 @@
+'''
+ELF helpers for Qualcomm signed images (loaders, SBLs, ...)
+
+Qualcomm images keep their own segment type in bits 24-26 of p_flags,
+which tells the hash table segment apart from the program header
+segment and from plain padding. The hash table segment carries a
+digest of every other segment, which :class:`SegmentVerifier` checks
+while the image is being received.
+'''
+import os
+import struct
+import hashlib
+
+ELFMAG = b'\x7fELF'
+EI_CLASS = 4
+EI_DATA = 5
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+PN_XNUM = 0xffff
+
+# the ELF header of either class fits in this many bytes
+ELF_HEADER_MAX_SIZE = 0x40
+
+PT_NULL = 0
+PT_LOAD = 1
+
+MI_PBT_SEGMENT_TYPE_SHIFT = 24
+MI_PBT_SEGMENT_TYPE_MASK = 0x7
+MI_PBT_HASH_SEGMENT = 0x2
+
+
+class ProgramHeader(object):
+    '''
+    The parts of an ELF program header needed to fetch a segment
+    '''
+
+    def __init__(self, p_type, p_flags, p_offset, p_filesz):
+        self.p_type = p_type
+        self.p_flags = p_flags
+        self.p_offset = p_offset
+        self.p_filesz = p_filesz
+
+    def qc_segment_type(self):
+        return (self.p_flags >> MI_PBT_SEGMENT_TYPE_SHIFT) & MI_PBT_SEGMENT_TYPE_MASK
+
+    def is_hash_segment(self):
+        return self.p_type == PT_NULL and self.qc_segment_type() == MI_PBT_HASH_SEGMENT
+
+    def is_fetched(self):
+        '''
+        :return: whether the segment carries data that has to be captured
+        '''
+        return self.p_filesz > 0 and (self.p_type == PT_LOAD or self.is_hash_segment())
+
+    def __repr__(self):
+        return 'ProgramHeader(type=%#x, flags=%#x, offset=%#x, filesz=%#x)' % (
+            self.p_type, self.p_flags, self.p_offset, self.p_filesz
+        )
+
+
+_ELF_STRUCTS = {}
+for _data, _order in ((ELFDATA2LSB, '<'), (ELFDATA2MSB, '>')):
+    _ELF_STRUCTS[(ELFCLASS32, _data)] = (
+        # e_ident .. e_shstrndx
+        struct.Struct(_order + '16sHHIIIIIHHHHHH'),
+        # p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_flags, p_align
+        struct.Struct(_order + 'IIIIIIII'),
+    )
+    _ELF_STRUCTS[(ELFCLASS64, _data)] = (
+        struct.Struct(_order + '16sHHIQQQIHHHHHH'),
+        # p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_align
+        struct.Struct(_order + 'IIQQQQQQ'),
+    )
+
+
+def is_elf(data):
+    return bytes(data[:4]) == ELFMAG
+
+
+class ElfHeaders(object):
+    '''
+    Parser for the ELF header and program header table of an image that
+    is still being received.
+
+    The ELF header always fits in the first ELF_HEADER_MAX_SIZE bytes;
+    parsing it tells where the program header table is, so the caller
+    can fetch exactly that range before calling
+    :meth:`parse_program_headers`.
+    Both ELFCLASS32 and ELFCLASS64 are supported, in either byte order.
+    '''
+
+    def __init__(self):
+        self.elfclass = None
+        self.byteorder = None
+        self.phoff = 0
+        self.phentsize = 0
+        self.phnum = 0
+        self.phdrs = []
+        self._phdr_struct = None
+
+    def parse_header(self, data):
+        '''
+        :param data: the start of the image, at least ELF_HEADER_MAX_SIZE bytes
+        :return: (start, end) of the program header table in the image
+        '''
+        if not is_elf(data):
+            raise Exception('Not an ELF image')
+        self.elfclass = data[EI_CLASS]
+        self.byteorder = data[EI_DATA]
+        if (self.elfclass, self.byteorder) not in _ELF_STRUCTS:
+            raise Exception('Unsupported ELF class %d / data encoding %d' % (self.elfclass, self.byteorder))
+        ehdr_struct, self._phdr_struct = _ELF_STRUCTS[(self.elfclass, self.byteorder)]
+        ehdr = ehdr_struct.unpack_from(data)
+        self.phoff = ehdr[5]
+        self.phentsize = ehdr[9]
+        self.phnum = ehdr[10]
+        if self.phnum == PN_XNUM:
+            raise Exception('Extended program header numbering is not supported')
+        if self.phnum and self.phentsize < self._phdr_struct.size:
+            raise Exception('Program header entry size %#x is too small' % self.phentsize)
+        return (self.phoff, self.phoff + self.phnum * self.phentsize)
+
+    def parse_program_headers(self, data, base=0):
+        '''
+        :param data: image data holding at least the program header table
+        :param base: offset of data in the image (default: 0)
+        :return: list of :class:`ProgramHeader`
+        '''
+        unpack_from = self._phdr_struct.unpack_from
+        is64 = self.elfclass == ELFCLASS64
+        self.phdrs = []
+        for i in range(self.phnum):
+            fields = unpack_from(data, self.phoff - base + i * self.phentsize)
+            if is64:
+                p_type, p_flags, p_offset, _, _, p_filesz, _, _ = fields
+            else:
+                p_type, p_offset, _, _, p_filesz, _, p_flags, _ = fields
+            self.phdrs.append(ProgramHeader(p_type, p_flags, p_offset, p_filesz))
+        return self.phdrs
+
+
+def image_size(phdrs):
+    '''
+    :param phdrs: list of :class:`ProgramHeader`
+    :return: size of the image file described by the program headers
+    '''
+    size = 0
+    for phdr in phdrs:
+        if phdr.p_filesz:
+            size = max(size, phdr.p_offset + phdr.p_filesz)
+    return size
+
+
+def merge_ranges(ranges):
+    '''
+    Sort byte ranges and merge the ones that overlap or touch
+
+    :param ranges: iterable of (start, end) tuples
+    :return: sorted list of disjoint (start, end) tuples
+    '''
+    merged = []
+    for start, end in sorted(ranges):
+        if start >= end:
+            continue
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def subtract_ranges(ranges, have):
+    '''
+    Remove the ranges that are already in hand from a list of ranges
+
+    :param ranges: sorted list of disjoint (start, end) tuples
+    :param have: sorted list of disjoint (start, end) tuples to remove
+    :return: sorted list of the remaining (start, end) tuples
+    '''
+    result = []
+    for start, end in ranges:
+        for hstart, hend in have:
+            if hend <= start or hstart >= end:
+                continue
+            if hstart > start:
+                result.append((start, hstart))
+            start = max(start, hend)
+            if start >= end:
+                break
+        if start < end:
+            result.append((start, end))
+    return result
+
+
+def fetch_ranges(phdrs):
+    '''
+    Turn a program header table into the byte ranges worth fetching.
+    Only loadable and hash segments are included, so alignment holes
+    between segments are skipped.
+
+    :param phdrs: list of :class:`ProgramHeader`
+    :return: sorted list of disjoint (start, end) tuples
+    '''
+    return merge_ranges(
+        (phdr.p_offset, phdr.p_offset + phdr.p_filesz) for phdr in phdrs if phdr.is_fetched()
+    )
+
+
+# MBN header versions that put the hash table right after a 40 byte header
+MBN_V3_VERSIONS = (3, 5)
+# MBN header versions with a 36 byte header followed by metadata
+MBN_V6_VERSIONS = (6, 7, 8)
+MBN_V3_HEADER = struct.Struct('<10I')
+MBN_V6_HEADER = struct.Struct('<9I')
+HASH_ALGORITHMS = {32: 'sha256', 48: 'sha384'}
+
+
+def parse_hash_table(data, phnum):
+    '''
+    Find the per segment digests in the hash table segment of a signed
+    image
+
+    :param data: the hash table segment
+    :param phnum: number of program headers of the image
+    :return: (hashlib algorithm name, list of phnum digests), or None if
+        the segment does not hold a hash table we know
+    '''
+    if not phnum or len(data) < MBN_V3_HEADER.size:
+        return None
+    words = MBN_V3_HEADER.unpack_from(data)
+    if words[0] in MBN_V6_VERSIONS:
+        offset = MBN_V6_HEADER.size + words[1] + words[2] + words[3]
+        size = words[4]
+    elif words[1] in MBN_V3_VERSIONS:
+        offset = MBN_V3_HEADER.size
+        size = words[5]
+    else:
+        return None
+    digest_size = size // phnum
+    if digest_size not in HASH_ALGORITHMS or digest_size * phnum != size or offset + size > len(data):
+        return None
+    data = bytes(data[offset:offset + size])
+    return HASH_ALGORITHMS[digest_size], [data[i:i + digest_size] for i in range(0, size, digest_size)]
+
+
+class SegmentHash(object):
+    '''
+    Running digest of one segment, fed in offset order
+    '''
+
+    def __init__(self, algorithm, phdr, expected):
+        self.algorithm = algorithm
+        self.start = phdr.p_offset
+        self.end = phdr.p_offset + phdr.p_filesz
+        self.expected = expected
+        self.reset()
+
+    def reset(self):
+        self.digest = hashlib.new(self.algorithm)
+        self.next = self.start
+
+    def matches(self):
+        return self.digest.digest() == self.expected
+
+
+class SegmentVerifier(object):
+    '''
+    Verifies the segments of an image against its hash table while the
+    image is being received.
+
+    Data has to arrive in ascending offset order for a segment to be
+    hashed on the fly; a segment that sees a gap is hashed from the
+    output file once the transfer is complete instead.
+    '''
+
+    def __init__(self, algorithm, segments):
+        self.algorithm = algorithm
+        self.segments = segments
+        self.pending = sorted(segments, key=lambda seg: seg.start)
+        self.stalled = []
+
+    @classmethod
+    def from_hash_segment(cls, phdrs, data, have):
+        '''
+        :param phdrs: program headers of the image
+        :param data: the hash table segment
+        :param have: sorted list of (start, end) ranges of the image that
+            will have been received once the transfer completes
+        :return: a :class:`SegmentVerifier`, or None if the hash table is
+            not understood
+        '''
+        table = parse_hash_table(data, len(phdrs))
+        if table is None:
+            return None
+        algorithm, digests = table
+        empty = b'\x00' * len(digests[0])
+        segments = []
+        for phdr, expected in zip(phdrs, digests):
+            # the hash segment itself and unhashed segments have no digest
+            if not phdr.p_filesz or expected == empty:
+                continue
+            if subtract_ranges([(phdr.p_offset, phdr.p_offset + phdr.p_filesz)], have):
+                continue
+            segments.append(SegmentHash(algorithm, phdr, expected))
+        return cls(algorithm, segments)
+
+    def update(self, offset, data):
+        '''
+        :param offset: offset of data in the image
+        :param data: memoryview of received image data
+        '''
+        end = offset + len(data)
+        pending = self.pending
+        if pending:
+            # most data lands in the middle of the segment being received
+            seg = pending[0]
+            if seg.next == offset and end < seg.end and (len(pending) == 1 or pending[1].start >= end):
+                seg.digest.update(data)
+                seg.next = end
+                return
+        i = 0
+        while i < len(pending):
+            seg = pending[i]
+            if seg.start >= end:
+                break
+            if seg.next < offset:
+                # part of the segment never came in order
+                self.stalled.append(pending.pop(i))
+                continue
+            if seg.next < end:
+                stop = min(end, seg.end)
+                seg.digest.update(data[seg.next - offset:stop - offset])
+                seg.next = stop
+            if seg.next == seg.end:
+                pending.pop(i)
+                continue
+            i += 1
+
+    def finish(self, fd):
+        '''
+        Hash whatever could not be hashed on the fly and check every
+        segment against its digest
+
+        :param fd: file descriptor of the received image, readable
+        :return: list of (start, end) ranges of the segments that failed
+        '''
+        for seg in self.stalled + self.pending:
+            seg.reset()
+            pos = seg.start
+            while pos < seg.end:
+                buff = os.pread(fd, min(0x100000, seg.end - pos), pos)
+                if not buff:
+                    break
+                seg.digest.update(buff)
+                pos += len(buff)
+            seg.next = pos
+        self.stalled = []
+        self.pending = []
+        return [(seg.start, seg.end) for seg in self.segments if not seg.matches()]
+
+    def retry(self, ranges):
+        '''
+        Start over hashing the segments in ranges, which are fetched again
+        '''
+        for seg in self.segments:
+            if (seg.start, seg.end) in ranges:
+                seg.reset()
+                self.pending.append(seg)
+        self.pending.sort(key=lambda seg: seg.start)
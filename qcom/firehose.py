@@ -0,0 +1,365 @@
+'''
+Firehose target emulation.
+
+Once a programmer has been downloaded over Sahara, the host talks
+Firehose on the same bulk endpoints: XML commands wrapped in
+<data>...</data>, answered with <log/> and <response/> elements, with
+raw sector data in between for read and program. The storage behind
+it is an image file, mmap'd so sector data moves between the endpoints
+and the image without intermediate copies.
+
+Commands are framed incrementally as packets arrive, parsed with a
+regular expression fast path for the flat documents hosts send, and
+answered from a cache of serialized responses.
+'''
+import os
+import re
+import json
+from mmap import mmap, ACCESS_WRITE
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, unescape
+
+from qcom.target import QcomTarget
+
+FIREHOSE_MAX_PAYLOAD_SIZE = 0x100000
+FIREHOSE_DEFAULT_PAYLOAD_SIZE = 0x4000
+FIREHOSE_MAX_XML_SIZE = 0x1000
+
+XML_HEADER = b'<?xml version="1.0" encoding="UTF-8" ?>\n'
+DATA_END = b'</data>'
+
+
+class FirehoseStorage(object):
+    '''
+    Storage device backed by an image file
+    '''
+
+    def __init__(self, filename, sector_size=512):
+        '''
+        :param filename: storage image
+        :param sector_size: default sector size (default: 512)
+        '''
+        self.filename = filename
+        self.sector_size = sector_size
+        self.fd = os.open(filename, os.O_RDWR)
+        self.size = os.fstat(self.fd).st_size
+        if not self.size:
+            raise Exception('Storage image %s is empty' % filename)
+        self.mmap = mmap(self.fd, self.size, access=ACCESS_WRITE)
+        self.view = memoryview(self.mmap)
+
+    def num_sectors(self, sector_size=None):
+        return self.size // (sector_size or self.sector_size)
+
+    def close(self):
+        if self.mmap is not None:
+            self.view.release()
+            self.mmap.flush()
+            self.mmap.close()
+            os.close(self.fd)
+            self.mmap = None
+
+
+def _attr(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return escape(str(value), {'"': '&quot;'})
+
+
+def firehose_xml(tag, attrs):
+    '''
+    :param tag: element name (response, log, ...)
+    :param attrs: list of (name, value)
+    :return: a complete Firehose XML document holding a single element
+    '''
+    body = ' '.join('%s="%s"' % (name, _attr(value)) for (name, value) in attrs)
+    return XML_HEADER + ('<data>\n<%s %s /></data>' % (tag, body)).encode()
+
+
+LOG_TEMPLATE = firehose_xml('log', [('value', '%s')])
+
+DOCUMENT_RE = re.compile(br'\s*(?:<\?xml[^>]*\?>)?\s*<data>(.*)</data>\s*$', re.S)
+ELEMENT_RE = re.compile(br'<([A-Za-z_][\w.-]*)((?:\s+[^\s=/>]+\s*=\s*"[^"]*")*)\s*/>')
+ATTRIBUTE_RE = re.compile(br'([^\s=]+)\s*=\s*"([^"]*)"')
+XML_ENTITIES = {'&quot;': '"', '&apos;': "'"}
+
+
+def _parse_commands_dom(document):
+    root = ElementTree.fromstring(document)
+    return [
+        (element.tag.lower(), dict((k.lower(), v) for (k, v) in element.attrib.items()))
+        for element in root
+    ]
+
+
+def parse_commands(document):
+    '''
+    :param document: a Firehose XML document
+    :return: list of (command, attributes), with lower case names
+    :raises: ElementTree.ParseError for bad XML
+    '''
+    match = DOCUMENT_RE.match(document)
+    if match is None:
+        return _parse_commands_dom(document)
+    body = match.group(1)
+    commands = []
+    pos = 0
+    for element in ELEMENT_RE.finditer(body):
+        if body[pos:element.start()].strip():
+            # nested elements, text or comments
+            return _parse_commands_dom(document)
+        pos = element.end()
+        attrs = {}
+        for name, value in ATTRIBUTE_RE.findall(element.group(2)):
+            value = value.decode()
+            if '&' in value:
+                value = unescape(value, XML_ENTITIES)
+            attrs[name.decode().lower()] = value
+        commands.append((element.group(1).decode().lower(), attrs))
+    if body[pos:].strip():
+        return _parse_commands_dom(document)
+    return commands
+
+
+class FirehoseFramer(object):
+    '''
+    Splits the OUT stream into <data>...</data> documents.
+
+    Only bytes that arrived since the last search are scanned for the
+    end of a document, so a command spread over many packets costs no
+    more than one sent in a single packet.
+    '''
+
+    def __init__(self):
+        self.buff = bytearray()
+        self.scanned = 0
+
+    def feed(self, data):
+        self.buff += data
+
+    def next_document(self):
+        '''
+        :return: the next complete document, or None
+        '''
+        end = self.buff.find(DATA_END, self.scanned)
+        if end < 0:
+            # the end tag may straddle the next packet
+            self.scanned = max(0, len(self.buff) - len(DATA_END) + 1)
+            return None
+        end += len(DATA_END)
+        document = bytes(self.buff[:end])
+        del self.buff[:end]
+        self.scanned = 0
+        return document
+
+    def pending(self):
+        return len(self.buff)
+
+    def drain(self):
+        '''
+        :return: all buffered bytes, which are no XML after all
+        '''
+        data = bytes(self.buff)
+        self.buff = bytearray()
+        self.scanned = 0
+        return data
+
+
+class FirehoseTarget(QcomTarget):
+    '''
+    The device side of the Firehose protocol
+
+    :param storage: :class:`FirehoseStorage`
+    :param send: callable sending data on the IN endpoint
+    '''
+
+    name = 'Firehose'
+
+    def __init__(self, storage, send):
+        super(FirehoseTarget, self).__init__(send)
+        self.storage = storage
+        self.max_payload_size = FIREHOSE_DEFAULT_PAYLOAD_SIZE
+        self.memory_name = 'eMMC'
+        # the host copes with zero length packets ending IN transfers
+        self.zlp_aware_host = True
+        self.framer = FirehoseFramer()
+        # serialized responses, by (ack, attributes)
+        self.responses = {}
+        # destination of raw data of a program command in progress
+        self.rx_offset = 0
+        self.rx_remaining = 0
+        self.handlers = {
+            'configure': self.handle_configure,
+            'getstorageinfo': self.handle_getstorageinfo,
+            'read': self.handle_read,
+            'program': self.handle_program,
+            'erase': self.handle_erase,
+            'nop': self.handle_nop,
+            'power': self.handle_power,
+        }
+
+    def respond(self, ack=True, **attrs):
+        key = (ack, tuple(sorted(attrs.items())))
+        response = self.responses.get(key, None)
+        if response is None:
+            response = firehose_xml('response', [('value', 'ACK' if ack else 'NAK')] + list(key[1]))
+            self.responses[key] = response
+        self.send(response)
+
+    def log(self, msg):
+        self.send(LOG_TEMPLATE.replace(b'%s', _attr(msg).encode(), 1))
+
+    def nak(self, msg):
+        self.warning(msg)
+        self.log(msg)
+        self.respond(False, rawmode=False)
+
+    def handle_data(self, data):
+        '''
+        :param data: data received on the OUT endpoint
+        '''
+        framer = self.framer
+        while data:
+            if self.rx_remaining:
+                data = self._receive_raw(data)
+                continue
+            framer.feed(data)
+            data = None
+            while not self.rx_remaining:
+                document = framer.next_document()
+                if document is None:
+                    break
+                self._handle_document(document)
+            if self.rx_remaining:
+                # raw data of a program command came with the command
+                data = framer.drain()
+            elif framer.pending() > FIREHOSE_MAX_XML_SIZE:
+                framer.drain()
+                self.nak('XML command too long')
+
+    def _handle_document(self, document):
+        try:
+            commands = parse_commands(document)
+        except ElementTree.ParseError as err:
+            self.nak('Bad XML: %s' % err)
+            return
+        for (command, attrs) in commands:
+            handler = self.handlers.get(command, None)
+            if handler is None:
+                self.nak('Unsupported command %s' % command)
+                continue
+            self.debug('Got %s %s' % (command, attrs))
+            try:
+                handler(attrs)
+            except ValueError as err:
+                # a numeric attribute that is not a number
+                self.nak('Bad attribute in %s: %s' % (command, err))
+
+    def _receive_raw(self, data):
+        '''
+        Write raw program data into the storage image
+
+        :return: whatever data follows the raw data
+        '''
+        count = min(len(data), self.rx_remaining)
+        self.storage.view[self.rx_offset:self.rx_offset + count] = memoryview(data)[:count]
+        self.rx_offset += count
+        self.rx_remaining -= count
+        if not self.rx_remaining:
+            self.respond(rawmode=False)
+        return data[count:]
+
+    def _sector_range(self, attrs):
+        '''
+        :return: (offset, length) in the storage image of the sectors a
+            command refers to, or None if it is out of range
+        '''
+        sector_size = int(attrs.get('sector_size_in_bytes', self.storage.sector_size))
+        num_sectors = int(attrs.get('num_partition_sectors', '0'))
+        physical = int(attrs.get('physical_partition_number', '0'))
+        start = attrs.get('start_sector', '0').rstrip('.')
+        total = self.storage.num_sectors(sector_size)
+        if start.startswith('NUM_DISK_SECTORS'):
+            start = total + int(start[len('NUM_DISK_SECTORS'):] or '0')
+        else:
+            start = int(start, 0)
+        if physical != 0 or start < 0 or start + num_sectors > total:
+            return None
+        return start * sector_size, num_sectors * sector_size
+
+    def handle_configure(self, attrs):
+        requested = int(attrs.get('maxpayloadsizetotargetinbytes', FIREHOSE_DEFAULT_PAYLOAD_SIZE))
+        self.max_payload_size = max(min(requested, FIREHOSE_MAX_PAYLOAD_SIZE), self.storage.sector_size)
+        self.memory_name = attrs.get('memoryname', self.memory_name)
+        self.zlp_aware_host = attrs.get('zlpawarehost', '1') != '0'
+        self.info('Configured for %s, max payload %#x' % (self.memory_name, self.max_payload_size))
+        self.respond(
+            MemoryName=self.memory_name,
+            MaxPayloadSizeFromTargetInBytes=self.max_payload_size,
+            MaxPayloadSizeToTargetInBytes=self.max_payload_size,
+            MaxPayloadSizeToTargetInBytesSupported=FIREHOSE_MAX_PAYLOAD_SIZE,
+            MaxXMLSizeInBytes=FIREHOSE_MAX_XML_SIZE,
+            Version=1,
+            TargetName='emulated',
+        )
+
+    def handle_getstorageinfo(self, attrs):
+        sector_size = self.storage.sector_size
+        info = {
+            'storage_info': {
+                'total_blocks': self.storage.num_sectors(),
+                'block_size': sector_size,
+                'page_size': sector_size,
+                'num_physical': 1,
+                'manufacturer_id': 0,
+                'serial_num': 0,
+                'fw_version': '0',
+                'mem_type': self.memory_name,
+                'prod_name': os.path.basename(self.storage.filename),
+            }
+        }
+        self.log('INFO: ' + json.dumps(info))
+        self.respond()
+
+    def handle_read(self, attrs):
+        sectors = self._sector_range(attrs)
+        if sectors is None:
+            self.nak('Read out of range')
+            return
+        offset, length = sectors
+        self.respond(rawmode=True)
+        view = self.storage.view
+        step = self.max_payload_size
+        for pos in range(offset, offset + length, step):
+            self.send(view[pos:min(pos + step, offset + length)])
+        self.respond(rawmode=False)
+
+    def handle_program(self, attrs):
+        sectors = self._sector_range(attrs)
+        if sectors is None:
+            self.nak('Program out of range')
+            return
+        self.rx_offset, self.rx_remaining = sectors
+        self.respond(rawmode=True)
+        if not self.rx_remaining:
+            self.respond(rawmode=False)
+
+    def handle_erase(self, attrs):
+        sectors = self._sector_range(attrs)
+        if sectors is None:
+            self.nak('Erase out of range')
+            return
+        offset, length = sectors
+        zeros = bytes(min(length, FIREHOSE_MAX_PAYLOAD_SIZE))
+        for pos in range(offset, offset + length, len(zeros) or 1):
+            count = min(len(zeros), offset + length - pos)
+            self.storage.view[pos:pos + count] = zeros[:count]
+        self.respond()
+
+    def handle_nop(self, attrs):
+        self.respond()
+
+    def handle_power(self, attrs):
+        self.info('Power %s' % attrs.get('value', 'reset'))
+        self.storage.mmap.flush()
+        self.respond()
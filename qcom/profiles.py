@@ -0,0 +1,205 @@
+'''
+Device profiles for the Sahara emulator.
+
+A profile holds what a device reports about itself in command mode:
+the MSM hardware id, the OEM public key hash, the serial number and the
+SBL version. Profiles are kept in a store backed by either a JSON file,
+a list of objects like::
+
+    {"name": "oneplus 3t", "hwid": "B93D702AE1F00500",
+     "pkhash": "c0c66e27...", "serial": "0x8d3e01ed", "sblversion": 2}
+
+or an SQLite database (.db / .sqlite) with a table::
+
+    profiles(id INTEGER PRIMARY KEY, name TEXT, hwid TEXT, pkhash TEXT,
+             msm_id INTEGER, serial INTEGER, sblversion INTEGER,
+             read64 INTEGER)
+
+hwid and pkhash are hex strings of the bytes as sent on the wire. The
+store is only read when a profile is first looked up, and SQLite stores
+are queried per lookup instead of being loaded as a whole.
+'''
+import os
+import json
+import struct
+import sqlite3
+import binascii
+
+# Sahara client commands answered from a profile
+SAHARA_EXEC_CMD_SERIAL_NUM_READ = 0x01
+SAHARA_EXEC_CMD_MSM_HW_ID_READ = 0x02
+SAHARA_EXEC_CMD_OEM_PK_HASH_READ = 0x03
+SAHARA_EXEC_CMD_GET_SOFTWARE_VERSION_SBL = 0x07
+
+EXEC_U32_DATA = struct.Struct('<I')
+EXEC_HWID_DATA = struct.Struct('8s8s8s')
+EXEC_PKHASH_DATA = struct.Struct('32s32s32s')
+
+DEFAULT_PROFILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles.json')
+
+
+def _int(value):
+    if isinstance(value, int):
+        return value
+    return int(value, 0)
+
+
+class DeviceProfile(object):
+    '''
+    Identity of an emulated device
+    '''
+
+    def __init__(self, name, hwid, pkhash, serial=0, sblversion=0, read64=False):
+        '''
+        :param name: profile name
+        :param hwid: MSM hardware id, 8 bytes as sent on the wire
+        :param pkhash: OEM public key hash, 32 bytes
+        :param serial: serial number (default: 0)
+        :param sblversion: SBL software version (default: 0)
+        :param read64: read images with 64-bit READ_DATA requests (default: False)
+        '''
+        if len(hwid) != 8:
+            raise Exception('Profile %s: hwid must be 8 bytes' % name)
+        if len(pkhash) != 32:
+            raise Exception('Profile %s: pkhash must be 32 bytes' % name)
+        self.name = name
+        self.hwid = bytes(hwid)
+        self.pkhash = bytes(pkhash)
+        self.serial = serial
+        self.sblversion = sblversion
+        self.read64 = read64
+        self._execute_data = None
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(
+            name=d.get('name', d['hwid']),
+            hwid=binascii.unhexlify(d['hwid']),
+            pkhash=binascii.unhexlify(d['pkhash']),
+            serial=_int(d.get('serial', 0)),
+            sblversion=_int(d.get('sblversion', 0)),
+            read64=bool(d.get('read64', False)),
+        )
+
+    @property
+    def msm_id(self):
+        return struct.unpack('<Q', self.hwid)[0] >> 32
+
+    @property
+    def hwid_str(self):
+        return binascii.hexlify(self.hwid).decode().upper()
+
+    @property
+    def pkhash_str(self):
+        return binascii.hexlify(self.pkhash).decode().lower()
+
+    @property
+    def execute_data(self):
+        '''
+        SAHARA_EXECUTE_DATA responses of this profile, by client command.
+        Built on first use only.
+        '''
+        if self._execute_data is None:
+            self._execute_data = {
+                SAHARA_EXEC_CMD_SERIAL_NUM_READ: EXEC_U32_DATA.pack(self.serial),
+                SAHARA_EXEC_CMD_MSM_HW_ID_READ: EXEC_HWID_DATA.pack(self.hwid, self.hwid, self.hwid),
+                SAHARA_EXEC_CMD_OEM_PK_HASH_READ: EXEC_PKHASH_DATA.pack(self.pkhash, self.pkhash, self.pkhash),
+                SAHARA_EXEC_CMD_GET_SOFTWARE_VERSION_SBL: EXEC_U32_DATA.pack(self.sblversion),
+            }
+        return self._execute_data
+
+    def __str__(self):
+        return '%s (hwid %s, msm id %#010x)' % (self.name, self.hwid_str, self.msm_id)
+
+
+class ProfileStore(object):
+    '''
+    Device profiles indexed by position, name, hwid, pkhash and MSM id
+    '''
+
+    def __init__(self, filename=DEFAULT_PROFILES):
+        self.filename = filename
+        self.is_sqlite = os.path.splitext(filename)[1].lower() in ('.db', '.sqlite', '.sqlite3')
+        self._profiles = None
+        self._index = None
+        self._db = None
+
+    def _load(self):
+        if self._profiles is not None:
+            return
+        with open(self.filename, 'r') as f:
+            self._profiles = [DeviceProfile.from_dict(d) for d in json.load(f)]
+        self._index = {}
+        for profile in self._profiles:
+            for key in (profile.name.lower(), profile.hwid_str.lower(), profile.pkhash_str, profile.msm_id):
+                self._index.setdefault(key, profile)
+
+    def _query(self, where, args):
+        if self._db is None:
+            self._db = sqlite3.connect(self.filename)
+        row = self._db.execute(
+            'SELECT name, hwid, pkhash, serial, sblversion, read64 FROM profiles %s ORDER BY id LIMIT 1' % where,
+            args
+        ).fetchone()
+        if row is None:
+            return None
+        name, hwid, pkhash, serial, sblversion, read64 = row
+        return DeviceProfile.from_dict({
+            'name': name, 'hwid': hwid, 'pkhash': pkhash,
+            'serial': serial or 0, 'sblversion': sblversion or 0, 'read64': read64,
+        })
+
+    def __len__(self):
+        if self.is_sqlite:
+            if self._db is None:
+                self._db = sqlite3.connect(self.filename)
+            return self._db.execute('SELECT COUNT(*) FROM profiles').fetchone()[0]
+        self._load()
+        return len(self._profiles)
+
+    def __getitem__(self, index):
+        if self.is_sqlite:
+            if self._db is None:
+                self._db = sqlite3.connect(self.filename)
+            row = self._db.execute('SELECT id FROM profiles ORDER BY id LIMIT 1 OFFSET ?', (index,)).fetchone()
+            if row is None:
+                raise IndexError(index)
+            return self._query('WHERE id = ?', (row[0],))
+        self._load()
+        return self._profiles[index]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def find(self, key):
+        '''
+        Look a profile up by position, name, hwid, pkhash or MSM id
+
+        :param key: index, or string with a name or hex hwid/pkhash/msm id
+        :return: the matching :class:`DeviceProfile`
+        :raises: Exception if no profile matches
+        '''
+        profile = None
+        if isinstance(key, int) or (key.isdigit() and len(key) < 8):
+            try:
+                profile = self[int(key)]
+            except IndexError:
+                pass
+        elif self.is_sqlite:
+            profile = self._query('WHERE lower(name) = ? OR lower(hwid) = ? OR lower(pkhash) = ?', (key.lower(),) * 3)
+            if profile is None and key.lower().startswith('0x'):
+                profile = self._query('WHERE msm_id = ?', (int(key, 16),))
+        else:
+            self._load()
+            profile = self._index.get(key.lower(), None)
+            if profile is None and key.lower().startswith('0x'):
+                profile = self._index.get(int(key, 16), None)
+        if profile is None:
+            raise Exception('No device profile matching %s in %s' % (key, self.filename))
+        return profile
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
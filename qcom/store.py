@@ -0,0 +1,148 @@
+'''
+Content-addressed store for captured loaders.
+
+Every distinct image is kept once, as blobs/<sha256> in the store
+directory. index.json records who offered which image::
+
+    {"sha256": ..., "size": ..., "header_hash": ..., "hwid": ..., "pkhash": ...,
+     "verdict": ...}
+
+The header hash covers the ELF and program headers plus the hash
+table segment of a signed image. Since the hash table holds the digest
+of every other segment, it identifies the whole image after only its
+first few KB have been received.
+'''
+import os
+import json
+import errno
+import hashlib
+from mmap import mmap, ACCESS_READ
+
+
+def file_sha256(filename):
+    '''
+    :param filename: file to hash
+    :return: SHA-256 hex digest of the file contents
+    '''
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size:
+            m = mmap(f.fileno(), 0, access=ACCESS_READ)
+            try:
+                digest.update(m)
+            finally:
+                m.close()
+    return digest.hexdigest()
+
+
+def link_or_copy(src, dst):
+    '''
+    Hard link src to dst, replacing dst. Falls back to a copy when the
+    two are on different file systems.
+    '''
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        # renaming a link over another link to the same file is a no-op
+        return
+    tmpname = dst + '.part'
+    if os.path.lexists(tmpname):
+        os.unlink(tmpname)
+    try:
+        os.link(src, tmpname)
+    except OSError as err:
+        if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        with open(src, 'rb') as fsrc, open(tmpname, 'wb') as fdst:
+            while True:
+                buff = fsrc.read(0x100000)
+                if not buff:
+                    break
+                fdst.write(buff)
+    os.rename(tmpname, dst)
+
+
+class LoaderStore(object):
+    '''
+    SHA-256 addressed loader blobs plus an index of where they came from
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.blob_dir = os.path.join(directory, 'blobs')
+        self.index_filename = os.path.join(directory, 'index.json')
+        if not os.path.isdir(self.blob_dir):
+            os.makedirs(self.blob_dir)
+        self.entries = []
+        self.by_header_hash = {}
+        self.by_sha256 = {}
+        if os.path.isfile(self.index_filename):
+            with open(self.index_filename, 'r') as f:
+                for entry in json.load(f):
+                    self._index(entry)
+
+    def _index(self, entry):
+        self.entries.append(entry)
+        self.by_sha256.setdefault(entry['sha256'], entry)
+        if entry.get('header_hash'):
+            self.by_header_hash.setdefault(entry['header_hash'], entry)
+
+    def _write_index(self):
+        tmpname = self.index_filename + '.part'
+        with open(tmpname, 'w') as f:
+            json.dump(self.entries, f, indent=4)
+        os.rename(tmpname, self.index_filename)
+
+    def blob_path(self, sha256):
+        return os.path.join(self.blob_dir, sha256)
+
+    def lookup(self, header_hash):
+        '''
+        :param header_hash: header hash of an image being received
+        :return: index entry of the known image, or None
+        '''
+        return self.by_header_hash.get(header_hash, None)
+
+    def add(self, filename, size, header_hash, profile, verdict=None):
+        '''
+        Store a finished capture and record it in the index
+
+        :param filename: the captured image
+        :param size: size of the image
+        :param header_hash: header hash of the image (None if it has none)
+        :param profile: DeviceProfile the image was captured with
+        :param verdict: outcome of the hash table check (default: None)
+        :return: index entry of the image
+        '''
+        sha256 = file_sha256(filename)
+        if sha256 not in self.by_sha256:
+            link_or_copy(filename, self.blob_path(sha256))
+        return self.record(sha256, size, header_hash, profile, verdict)
+
+    def record(self, sha256, size, header_hash, profile, verdict=None):
+        '''
+        Record that a profile was offered an image, unless already known
+
+        :return: index entry of the image
+        '''
+        for entry in self.entries:
+            if entry['sha256'] == sha256 and entry['hwid'] == profile.hwid_str and entry['pkhash'] == profile.pkhash_str:
+                return entry
+        entry = {
+            'sha256': sha256,
+            'size': size,
+            'header_hash': header_hash,
+            'hwid': profile.hwid_str,
+            'pkhash': profile.pkhash_str,
+            'verdict': verdict,
+        }
+        self._index(entry)
+        self._write_index()
+        return entry
+
+    def link(self, entry, filename):
+        '''
+        Make filename refer to the blob of an index entry
+
+        :param entry: index entry
+        :param filename: name to link the blob to
+        '''
+        link_or_copy(self.blob_path(entry['sha256']), filename)
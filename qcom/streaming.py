@@ -0,0 +1,281 @@
+'''
+Streaming download protocol emulation.
+
+The streaming download protocol is what the programmers of older
+flashing stacks speak once they run, reached from Sahara with the
+client command SWITCH_TO_STREAM_DLOAD or after a DMSS go. Packets are
+HDLC framed like DMSS download packets, with little endian arguments.
+
+Unframed stream writes carry an unframed header followed by the raw
+data, which is written straight into the storage image::
+
+    30 00 00 00 | address (4) | length (4) | data ...
+
+The storage image is a :class:`qcom.firehose.FirehoseStorage`, so
+reads and writes move data between the endpoints and the mmap'd image.
+'''
+import struct
+
+from qcom.dload import HdlcTarget, hdlc_frame
+
+HOST_MAGIC = b'QCOM fast download protocol host'
+TARGET_MAGIC = b'QCOM fast download protocol targ'
+
+
+class StreamingTarget(HdlcTarget):
+    '''
+    The programmer side of the streaming download protocol
+
+    :param storage: :class:`qcom.firehose.FirehoseStorage` to read and write
+    :param send: callable sending data on the IN endpoint
+    '''
+
+    name = 'Streaming'
+
+    CMD_HELLO = 0x01
+    CMD_HELLO_RSP = 0x02
+    CMD_READ = 0x03
+    CMD_READ_DATA = 0x04
+    CMD_SIMPLE_WRITE = 0x05
+    CMD_WROTE = 0x06
+    CMD_STREAM_WRITE = 0x07
+    CMD_BLOCK_WRITTEN = 0x08
+    CMD_NOP = 0x09
+    CMD_NOP_RSP = 0x0A
+    CMD_RESET = 0x0B
+    CMD_RESET_ACK = 0x0C
+    CMD_ERROR = 0x0D
+    CMD_LOG = 0x0E
+    CMD_POWER_OFF = 0x11
+    CMD_POWERING_DOWN = 0x12
+    CMD_OPEN = 0x13
+    CMD_OPENED = 0x14
+    CMD_CLOSE = 0x15
+    CMD_CLOSED = 0x16
+    CMD_SECURITY_MODE = 0x17
+    CMD_SECURITY_MODE_RSP = 0x18
+    CMD_OPEN_MULTI_IMAGE = 0x1B
+    CMD_OPENED_MULTI_IMAGE = 0x1C
+    CMD_UNFRAMED_STREAM_WRITE = 0x30
+    CMD_UNFRAMED_STREAM_WRITE_RSP = 0x31
+
+    ERROR_INVALID_DEST = 0x02
+    ERROR_INVALID_LEN = 0x03
+    ERROR_EARLY_END = 0x04
+    ERROR_INVALID_CMD = 0x05
+    ERROR_OP_FAILED = 0x07
+
+    PROTOCOL_VERSION = 8
+    COMPAT_VERSION = 2
+    MAX_BLOCK_SIZE = 0x400
+    MAX_FRAME_SIZE = 2 * MAX_BLOCK_SIZE + 0x20
+    WINDOW_SIZE = 1
+    FLASH_ID = b'eMMC'
+
+    HELLO_PKT = struct.Struct('<B32sBBB')
+    ADDRESS_PKT = struct.Struct('<BI')
+    READ_PKT = struct.Struct('<BIH')
+    NOP_PKT = struct.Struct('<BI')
+    UNFRAMED_HEADER = struct.Struct('<B3xII')
+
+    def __init__(self, storage, send):
+        super(StreamingTarget, self).__init__(send)
+        self.storage = storage
+        self.hello = False
+        self.opened = None
+        # destination of the raw data of an unframed stream write
+        self.rx_address = 0
+        self.rx_offset = 0
+        self.rx_remaining = 0
+        self.handlers = {
+            self.CMD_HELLO: self.handle_hello,
+            self.CMD_READ: self.handle_read,
+            self.CMD_SIMPLE_WRITE: self.handle_simple_write,
+            self.CMD_STREAM_WRITE: self.handle_stream_write,
+            self.CMD_NOP: self.handle_nop,
+            self.CMD_RESET: self.handle_reset,
+            self.CMD_POWER_OFF: self.handle_power_off,
+            self.CMD_OPEN: self.handle_open,
+            self.CMD_CLOSE: self.handle_close,
+            self.CMD_SECURITY_MODE: self.handle_security_mode,
+            self.CMD_OPEN_MULTI_IMAGE: self.handle_open_multi_image,
+        }
+        # single byte responses
+        self.responses = dict((cmd, hdlc_frame(struct.pack('B', cmd))) for cmd in (
+            self.CMD_RESET_ACK, self.CMD_POWERING_DOWN, self.CMD_OPENED, self.CMD_CLOSED, self.CMD_SECURITY_MODE_RSP,
+        ))
+        self.hello_rsp = hdlc_frame(
+            struct.pack(
+                '<B32sBBIIB', self.CMD_HELLO_RSP, TARGET_MAGIC, self.PROTOCOL_VERSION, self.COMPAT_VERSION,
+                self.MAX_BLOCK_SIZE, 0, len(self.FLASH_ID)
+            ) + self.FLASH_ID + struct.pack(
+                '<HHIB', self.WINDOW_SIZE, 1, storage.size, 0
+            )
+        )
+
+    def respond(self, cmd):
+        self.send(self.responses[cmd])
+
+    def error(self, code, msg):
+        self.warning(msg)
+        self.send(hdlc_frame(struct.pack('<BI', self.CMD_ERROR, code) + msg.encode()))
+
+    def handle_data(self, data):
+        '''
+        :param data: data received on the OUT endpoint
+        '''
+        decoder = self.decoder
+        while data:
+            if self.rx_remaining:
+                data = self._receive_raw(data)
+                continue
+            if not decoder.pending() and bytearray(data[:1])[0] == self.CMD_UNFRAMED_STREAM_WRITE:
+                data = self._start_unframed_write(data)
+                continue
+            self.receive_frames(data)
+            data = None
+
+    def bad_frame(self, reason):
+        self.error(self.ERROR_EARLY_END, reason)
+
+    def frame_too_long(self):
+        self.error(self.ERROR_INVALID_LEN, 'Packet too long')
+
+    def handle_packet(self, packet):
+        cmd = bytearray(packet)[0]
+        handler = self.handlers.get(cmd, None)
+        if handler is None:
+            self.error(self.ERROR_INVALID_CMD, 'Unsupported command %#x' % cmd)
+            return
+        if not self.hello and cmd != self.CMD_HELLO:
+            self.error(self.ERROR_OP_FAILED, 'Command %#x before hello' % cmd)
+            return
+        handler(packet)
+
+    def _check_range(self, address, length):
+        if address + length > self.storage.size:
+            self.error(self.ERROR_INVALID_DEST, 'Address %#x+%#x out of range' % (address, length))
+            return False
+        if self.opened is None:
+            self.error(self.ERROR_OP_FAILED, 'No image open')
+            return False
+        return True
+
+    def _start_unframed_write(self, data):
+        '''
+        :return: whatever data follows the header
+        '''
+        header = self.UNFRAMED_HEADER
+        if len(data) < header.size:
+            self.error(self.ERROR_EARLY_END, 'Short unframed write header')
+            return None
+        _, address, length = header.unpack_from(data)
+        if not self._check_range(address, length):
+            return None
+        self.debug('Unframed write of %#x bytes to %#x' % (length, address))
+        self.rx_address = self.rx_offset = address
+        self.rx_remaining = length
+        data = data[header.size:]
+        if not length:
+            self._end_unframed_write()
+        return data
+
+    def _receive_raw(self, data):
+        '''
+        Write raw data of an unframed stream write into the storage image
+
+        :return: whatever data follows the raw data
+        '''
+        count = min(len(data), self.rx_remaining)
+        self.storage.view[self.rx_offset:self.rx_offset + count] = memoryview(data)[:count]
+        self.rx_offset += count
+        self.rx_remaining -= count
+        if not self.rx_remaining:
+            self._end_unframed_write()
+        return data[count:]
+
+    def _end_unframed_write(self):
+        self.send(hdlc_frame(self.ADDRESS_PKT.pack(self.CMD_UNFRAMED_STREAM_WRITE_RSP, self.rx_address)))
+
+    def handle_hello(self, packet):
+        if len(packet) < self.HELLO_PKT.size:
+            self.error(self.ERROR_EARLY_END, 'Short hello')
+            return
+        _, magic, version, compat, features = self.HELLO_PKT.unpack_from(packet)
+        if magic != HOST_MAGIC:
+            self.error(self.ERROR_OP_FAILED, 'Bad hello magic')
+            return
+        self.info('Hello from host, protocol version %d' % version)
+        self.hello = True
+        self.send(self.hello_rsp)
+
+    def handle_read(self, packet):
+        if len(packet) < self.READ_PKT.size:
+            self.error(self.ERROR_EARLY_END, 'Short read request')
+            return
+        _, address, length = self.READ_PKT.unpack_from(packet)
+        if length > self.MAX_BLOCK_SIZE:
+            self.error(self.ERROR_INVALID_LEN, 'Read of %#x bytes too long' % length)
+            return
+        if not self._check_range(address, length):
+            return
+        self.send(hdlc_frame(
+            self.ADDRESS_PKT.pack(self.CMD_READ_DATA, address) + self.storage.view[address:address + length].tobytes()
+        ))
+
+    def _write(self, packet, response):
+        if len(packet) < self.ADDRESS_PKT.size:
+            self.error(self.ERROR_EARLY_END, 'Short write request')
+            return
+        address = self.ADDRESS_PKT.unpack_from(packet)[1]
+        data = memoryview(packet)[self.ADDRESS_PKT.size:]
+        if not self._check_range(address, len(data)):
+            return
+        self.storage.view[address:address + len(data)] = data
+        self.send(hdlc_frame(self.ADDRESS_PKT.pack(response, address)))
+
+    def handle_simple_write(self, packet):
+        self._write(packet, self.CMD_WROTE)
+
+    def handle_stream_write(self, packet):
+        self._write(packet, self.CMD_BLOCK_WRITTEN)
+
+    def handle_nop(self, packet):
+        if len(packet) < self.NOP_PKT.size:
+            self.error(self.ERROR_EARLY_END, 'Short nop')
+            return
+        self.send(hdlc_frame(self.NOP_PKT.pack(self.CMD_NOP_RSP, self.NOP_PKT.unpack_from(packet)[1])))
+
+    def handle_reset(self, packet):
+        self.info('Reset')
+        self.storage.mmap.flush()
+        self.respond(self.CMD_RESET_ACK)
+
+    def handle_power_off(self, packet):
+        self.info('Power off')
+        self.storage.mmap.flush()
+        self.respond(self.CMD_POWERING_DOWN)
+
+    def handle_security_mode(self, packet):
+        mode = bytearray(packet)[1] if len(packet) > 1 else 0
+        self.debug('Security mode %d' % mode)
+        self.respond(self.CMD_SECURITY_MODE_RSP)
+
+    def handle_open(self, packet):
+        self.opened = bytearray(packet)[1] if len(packet) > 1 else 0
+        self.info('Open, mode %d' % self.opened)
+        self.respond(self.CMD_OPENED)
+
+    def handle_open_multi_image(self, packet):
+        if len(packet) < 2:
+            self.error(self.ERROR_EARLY_END, 'Short open multi-image')
+            return
+        self.opened = bytearray(packet)[1]
+        self.info('Open multi-image, type %#x' % self.opened)
+        self.send(hdlc_frame(struct.pack('BB', self.CMD_OPENED_MULTI_IMAGE, 0)))
+
+    def handle_close(self, packet):
+        self.info('Close')
+        self.opened = None
+        self.storage.mmap.flush()
+        self.respond(self.CMD_CLOSED)
@@ -0,0 +1,28 @@
+'''
+Common functionality for the emulated protocol targets (Firehose, DMSS
+download, streaming download).
+'''
+import logging
+
+
+class QcomTarget(object):
+    '''
+    Base of the protocol targets a Sahara device hands its endpoints to
+
+    :param send: callable sending data on the IN endpoint
+    '''
+
+    name = 'Target'
+
+    def __init__(self, send):
+        self.send = send
+        self.logger = logging.getLogger('umap2')
+
+    def debug(self, msg, *args, **kwargs):
+        self.logger.debug('[%s] %s' % (self.name, msg), *args, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self.logger.info('[%s] %s' % (self.name, msg), *args, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        self.logger.warning('[%s] %s' % (self.name, msg), *args, **kwargs)
@@ -0,0 +1,161 @@
+'''
+Timeline of a Sahara session.
+
+Protocol events are recorded with their time into a ring buffer that is
+allocated up front, so recording costs a few array stores and no
+allocation while data is moving. The timeline can be exported as JSON,
+together with latency histograms per request type, to tell a slow host
+from a slow phy or a slow handler.
+'''
+import os
+import json
+import time
+from array import array
+
+EVENT_ENUMERATED = 0
+EVENT_HELLO = 1
+EVENT_HELLO_RSP = 2
+EVENT_CMD_READY = 3
+EVENT_EXECUTE_REQ = 4
+EVENT_EXECUTE_DATA = 5
+EVENT_READ_DATA = 6
+EVENT_READ_DONE = 7
+EVENT_END_TRANSFER = 8
+EVENT_DONE_REQ = 9
+EVENT_DONE_RSP = 10
+EVENT_SWITCH_MODE = 11
+EVENT_RESET = 12
+EVENT_MEMORY_READ = 13
+EVENT_MEMORY_READ_DONE = 14
+
+EVENT_NAMES = {
+    EVENT_ENUMERATED: 'enumerated',
+    EVENT_HELLO: 'hello',
+    EVENT_HELLO_RSP: 'hello_rsp',
+    EVENT_CMD_READY: 'cmd_ready',
+    EVENT_EXECUTE_REQ: 'execute_req',
+    EVENT_EXECUTE_DATA: 'execute_data',
+    EVENT_READ_DATA: 'read_data',
+    EVENT_READ_DONE: 'read_done',
+    EVENT_END_TRANSFER: 'end_transfer',
+    EVENT_DONE_REQ: 'done_req',
+    EVENT_DONE_RSP: 'done_rsp',
+    EVENT_SWITCH_MODE: 'switch_mode',
+    EVENT_RESET: 'reset',
+    EVENT_MEMORY_READ: 'memory_read',
+    EVENT_MEMORY_READ_DONE: 'memory_read_done',
+}
+
+# request type -> (event starting a request, event completing it)
+LATENCY_PAIRS = [
+    ('hello', EVENT_HELLO, EVENT_HELLO_RSP),
+    ('execute', EVENT_EXECUTE_REQ, EVENT_EXECUTE_DATA),
+    ('read_data', EVENT_READ_DATA, EVENT_READ_DONE),
+    ('end_transfer', EVENT_END_TRANSFER, EVENT_DONE_REQ),
+    ('memory_read', EVENT_MEMORY_READ, EVENT_MEMORY_READ_DONE),
+]
+
+
+class SessionTimeline(object):
+    '''
+    Ring buffer of (time, event, value) records
+    '''
+
+    def __init__(self, capacity=0x10000):
+        '''
+        :param capacity: number of events kept, older events are
+            overwritten (default: 64K)
+        '''
+        self.capacity = capacity
+        self.times = array('d', [0.0]) * capacity
+        self.events = array('B', [0]) * capacity
+        self.values = array('q', [0]) * capacity
+        self.count = 0
+        self.clock = time.time
+
+    def record(self, event, value=0):
+        '''
+        :param event: one of the EVENT_* constants
+        :param value: event argument, e.g. the offset of a read
+        '''
+        i = self.count % self.capacity
+        self.times[i] = self.clock()
+        self.events[i] = event
+        self.values[i] = value
+        self.count += 1
+
+    def clear(self):
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def __iter__(self):
+        '''
+        :return: (time, event, value) of the kept events, oldest first
+        '''
+        first = max(0, self.count - self.capacity)
+        for n in range(first, self.count):
+            i = n % self.capacity
+            yield self.times[i], self.events[i], self.values[i]
+
+    def latencies(self):
+        '''
+        :return: dict of request type -> list of latencies in seconds
+        '''
+        starts = dict((start, name) for (name, start, _) in LATENCY_PAIRS)
+        ends = dict((end, (name, start)) for (name, start, end) in LATENCY_PAIRS)
+        pending = {}
+        result = dict((name, []) for (name, _, _) in LATENCY_PAIRS)
+        for (t, event, _) in self:
+            if event in starts:
+                pending[event] = t
+            elif event in ends:
+                name, start = ends[event]
+                started = pending.pop(start, None)
+                if started is not None:
+                    result[name].append(t - started)
+        return result
+
+    def histograms(self):
+        '''
+        Latency histograms with power of two microsecond buckets
+
+        :return: dict of request type -> {count, min_us, max_us, mean_us,
+            buckets: list of [upper bound in us, count]}
+        '''
+        result = {}
+        for name, latencies in self.latencies().items():
+            if not latencies:
+                continue
+            buckets = {}
+            for latency in latencies:
+                bound = 1 << int(latency * 1e6).bit_length()
+                buckets[bound] = buckets.get(bound, 0) + 1
+            result[name] = {
+                'count': len(latencies),
+                'min_us': round(min(latencies) * 1e6, 1),
+                'max_us': round(max(latencies) * 1e6, 1),
+                'mean_us': round(sum(latencies) * 1e6 / len(latencies), 1),
+                'buckets': [[bound, buckets[bound]] for bound in sorted(buckets)],
+            }
+        return result
+
+    def to_dict(self):
+        events = list(self)
+        base = events[0][0] if events else 0.0
+        return {
+            'start': base,
+            'dropped': max(0, self.count - self.capacity),
+            'events': [
+                {'t_us': round((t - base) * 1e6, 1), 'event': EVENT_NAMES.get(event, event), 'value': value}
+                for (t, event, value) in events
+            ],
+            'histograms': self.histograms(),
+        }
+
+    def save(self, filename):
+        tmpname = filename + '.part'
+        with open(tmpname, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+        os.rename(tmpname, filename)
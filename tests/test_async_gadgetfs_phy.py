@@ -0,0 +1,347 @@
+'''
+Tests for the asyncio GadgetFS phy
+
+Endpoint files are stood in for by SOCK_SEQPACKET socket pairs: like an
+endpoint file, each write is one record (a packet or transfer) and a
+zero-length write shows up as a zero-length record on the host side.
+Every test runs with the endpoints served by the event loop, and with
+the executor fallback used for endpoint files that do not poll.
+'''
+import os
+import time
+import socket
+import shutil
+import asyncio
+import logging
+import tempfile
+import unittest
+import threading
+
+from app.ulogger import prepare_logging, set_default_handler_level
+from usb.usb_endpoint import USBEndpoint
+from phy.tx_queue import TxQueue
+from phy.async_gadgetfs_phy import AsyncGadgetFsPhy, AsyncEndpoint
+
+EP_OUT_SYNC = 1
+EP_OUT_ASYNC = 2
+EP_IN = 3
+EP_OUT_QUEUED = 4
+MAX_PACKET_SIZE = 512
+CHUNK_SIZE = 0x10000
+TIMEOUT = 5
+
+
+def setUpModule():
+    prepare_logging()
+    set_default_handler_level(logging.WARNING)
+
+
+class FakeApp(object):
+
+    def should_stop_phy(self):
+        return False
+
+
+class FakeEndpoint(object):
+    '''
+    The parts of a USBEndpoint the phy uses
+    '''
+
+    def __init__(self, number, direction, fd, handler=None):
+        self.number = number
+        self.direction = direction
+        self.fd = fd
+        self.handler = handler
+        self.transfer_size = None
+        self.zlp = False
+        if direction == USBEndpoint.direction_in:
+            self.address = number | 0x80
+        else:
+            self.address = number
+
+    def _get_max_packet_size(self, usb_type):
+        return MAX_PACKET_SIZE
+
+
+class FakeDevice(object):
+    '''
+    Records what the phy hands it. EP_OUT_SYNC is handled synchronously,
+    EP_OUT_ASYNC by a coroutine echoing the data on EP_IN. When offered
+    EP_IN, everything in tx is handed over, like mass storage does.
+    '''
+
+    name = 'FakeDevice'
+
+    def __init__(self, phy):
+        self.phy = phy
+        self.offers = []
+        self.received = []
+        self.tx = None
+        self.max_queued = 0
+
+    def handle_buffer_available(self, ep_num):
+        self.offers.append(ep_num)
+        if self.tx is None:
+            return
+        while not self.tx.empty():
+            data, more = self.tx.get_nowait()
+            self.phy.send_on_endpoint(EP_IN, data, more)
+        endpoint = self.phy.endpoints[EP_IN | 0x80]
+        self.max_queued = max(self.max_queued, endpoint.queued)
+
+    def handle_data_available(self, ep_num, data):
+        if ep_num == EP_OUT_SYNC:
+            self.received.append((ep_num, type(data), bytes(data)))
+            return None
+        return self._echo(ep_num, data)
+
+    async def _echo(self, ep_num, data):
+        self.received.append((ep_num, type(data), bytes(data)))
+        await self.phy.send(EP_IN, b'echo:' + bytes(data))
+
+
+class AsyncGadgetFsPhyTests(object):
+    '''
+    Tests for both values of pollable_endpoints, mixed into the
+    TestCase classes below
+    '''
+
+    pollable_endpoints = None
+
+    def setUp(self):
+        self.gadgetfs_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.gadgetfs_dir, 'net2280'), 'w'):
+            pass
+        self.phy = AsyncGadgetFsPhy(FakeApp(), self.gadgetfs_dir)
+        self.phy.pollable_endpoints = self.pollable_endpoints
+        self.loop = self.phy.loop
+        asyncio.set_event_loop(self.loop)
+        self.device = FakeDevice(self.phy)
+        self.phy.connected_device = self.device
+        self.hosts = {}
+        self.eps = {}
+        self._add_endpoint(EP_OUT_SYNC, USBEndpoint.direction_out, self.device.handle_data_available)
+        self._add_endpoint(EP_OUT_ASYNC, USBEndpoint.direction_out, self.device.handle_data_available)
+        self._add_endpoint(EP_OUT_QUEUED, USBEndpoint.direction_out)
+        self._add_endpoint(EP_IN, USBEndpoint.direction_in)
+        self.disconnected = False
+
+    def tearDown(self):
+        if not self.disconnected:
+            self._disconnect()
+        self.loop.run_until_complete(self.loop.shutdown_default_executor())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        shutil.rmtree(self.gadgetfs_dir)
+
+    def _add_endpoint(self, number, direction, handler=None):
+        host, device = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        # without poll, endpoint files block
+        device.setblocking(not self.pollable_endpoints)
+        ep = FakeEndpoint(number, direction, device.detach(), handler)
+        endpoint = AsyncEndpoint(self.phy, ep)
+        self.phy.endpoints[ep.address] = endpoint
+        endpoint.start()
+        self.hosts[number] = host
+        self.eps[number] = ep
+
+    def _disconnect(self):
+        # end of file for readers blocked in the executor
+        for host in self.hosts.values():
+            host.close()
+        self.phy.control_fd = None
+        self.phy.disconnect()
+        self.disconnected = True
+
+    def _run(self, coro):
+        return self.loop.run_until_complete(asyncio.wait_for(coro, TIMEOUT))
+
+    async def _wait_until(self, condition):
+        deadline = time.time() + TIMEOUT
+        while not condition():
+            self.assertLess(time.time(), deadline, 'timed out')
+            await asyncio.sleep(0.01)
+
+    def _host_read(self, count=None):
+        '''
+        :param count: number of records to wait for, None for what is
+            there already
+        :return: list of records the device wrote to EP_IN
+        '''
+        host = self.hosts[EP_IN]
+        records = []
+        host.settimeout(TIMEOUT if count else 0)
+        while count is None or len(records) < count:
+            try:
+                records.append(host.recv(0x10000))
+            except (BlockingIOError, socket.timeout):
+                break
+        return records
+
+    def test_out_data_to_sync_handler(self):
+        self.hosts[EP_OUT_SYNC].send(b'hello')
+        self._run(self._wait_until(lambda: self.device.received))
+        self.assertEqual(self.device.received, [(EP_OUT_SYNC, bytes, b'hello')])
+
+    def test_out_transfer_to_sync_handler(self):
+        self.eps[EP_OUT_SYNC].transfer_size = 3000
+        self.hosts[EP_OUT_SYNC].send(b'a' * 3000)
+        self._run(self._wait_until(lambda: self.device.received))
+        self.assertEqual(self.device.received, [(EP_OUT_SYNC, memoryview, b'a' * 3000)])
+
+    def test_out_data_to_coroutine_handler(self):
+        self.hosts[EP_OUT_ASYNC].send(b'ping')
+        self._run(self._wait_until(lambda: self.device.received))
+        self.assertEqual(self.device.received, [(EP_OUT_ASYNC, bytes, b'ping')])
+        self.assertEqual(self._host_read(1), [b'echo:ping'])
+
+    def test_receive_queued_data(self):
+        self.hosts[EP_OUT_QUEUED].send(b'first')
+        self._run(self._wait_until(lambda: self.phy.endpoints[EP_OUT_QUEUED].received))
+        self.assertEqual(self._run(self.phy.receive(EP_OUT_QUEUED)), b'first')
+
+    def test_receive_before_handler(self):
+        async def receive():
+            receiving = asyncio.ensure_future(self.phy.receive(EP_OUT_SYNC))
+            await asyncio.sleep(0)
+            self.hosts[EP_OUT_SYNC].send(b'for receive')
+            return await receiving
+        self.assertEqual(self._run(receive()), b'for receive')
+        self.assertEqual(self.device.received, [])
+
+    def test_send_completes(self):
+        self.assertEqual(self._run(self.phy.send(EP_IN, b'x' * 1000)), 1000)
+        self.assertEqual(self._host_read(), [b'x' * 1000])
+
+    def test_more_joins_transfer(self):
+        self.phy.send_on_endpoint(EP_IN, b'm' * 500, more=True)
+        self.assertEqual(self._host_read(), [])
+        self.assertEqual(self._run(self.phy.send(EP_IN, b'n' * 300)), 800)
+        self.assertEqual(self._host_read(), [b'm' * 500 + b'n' * 300])
+
+    def test_zlp_after_full_packets(self):
+        self.eps[EP_IN].zlp = True
+        self.phy.send_on_endpoint(EP_IN, b'm' * 500, more=True)
+        self._run(self.phy.send(EP_IN, b'n' * 524))
+        self._run(self.phy.send(EP_IN, b'short'))
+        self._run(self._wait_until(lambda: not self.phy.endpoints[EP_IN | 0x80].handling_write()))
+        self.assertEqual(self._host_read(), [b'm' * 500 + b'n' * 524, b'', b'short'])
+
+    def test_no_zlp_when_disabled(self):
+        self._run(self.phy.send(EP_IN, b'y' * 1024))
+        self.assertEqual(self._host_read(), [b'y' * 1024])
+
+    def test_buffer_available_after_drain(self):
+        endpoint = self.phy.endpoints[EP_IN | 0x80]
+        chunk = b'z' * 0x10000
+        count = 32
+
+        async def drain():
+            for _ in range(count):
+                self.phy.send_on_endpoint(EP_IN, chunk)
+            # the host is not reading, the endpoint stays busy
+            await asyncio.sleep(0.05)
+            self.assertTrue(endpoint.handling_write())
+            self.phy.wakeup()
+            await asyncio.sleep(0.05)
+            self.assertEqual(self.device.offers, [])
+            records = await self.loop.run_in_executor(None, self._host_read, count)
+            await self._wait_until(lambda: self.device.offers)
+            return records
+        records = self._run(drain())
+        self.assertEqual(records, [chunk] * count)
+        self.assertEqual(self.device.offers, [EP_IN])
+        self.assertFalse(endpoint.handling_write())
+
+    def _read_transfer(self, size):
+        '''
+        :return: the records of a transfer of size bytes, read once the
+            endpoint had time to fill up
+        '''
+        time.sleep(0.1)
+        records = []
+        while sum(len(record) for record in records) < size:
+            records.extend(self._host_read(1))
+        return records
+
+    def test_large_more_transfer_is_throttled(self):
+        count = 64
+        chunks = [bytes([i]) * CHUNK_SIZE for i in range(count)]
+        tx_limit = 4 * CHUNK_SIZE
+        self.device.tx = TxQueue(tx_limit)
+
+        def produce():
+            for i, chunk in enumerate(chunks):
+                self.device.tx.put(chunk, more=i < count - 1)
+                self.phy.wakeup()
+        producer = threading.Thread(target=produce)
+        producer.start()
+        try:
+            records = self._run(self.loop.run_in_executor(None, self._read_transfer, count * CHUNK_SIZE))
+        finally:
+            self.device.tx.clear()
+            producer.join()
+        self.assertEqual(b''.join(records), b''.join(chunks))
+        self.assertTrue(all(len(record) <= AsyncEndpoint.coalesce_limit for record in records))
+        self.assertGreater(self.device.tx.stats()['waits'], 0)
+        self.assertLess(self.device.max_queued, tx_limit + MAX_PACKET_SIZE)
+
+    def test_send_waits_for_room(self):
+        count = 64
+        chunks = [bytes([i]) * CHUNK_SIZE for i in range(count)]
+        endpoint = self.phy.endpoints[EP_IN | 0x80]
+        endpoint.limit = 4 * CHUNK_SIZE
+        queued = []
+
+        async def produce():
+            reading = self.loop.run_in_executor(None, self._read_transfer, count * CHUNK_SIZE)
+            for i, chunk in enumerate(chunks):
+                more = i < count - 1
+                length = await self.phy.send(EP_IN, chunk, more)
+                self.assertEqual(length, CHUNK_SIZE if more else count * CHUNK_SIZE)
+                queued.append(endpoint.queued)
+            return await reading
+        records = self._run(produce())
+        self.assertEqual(b''.join(records), b''.join(chunks))
+        self.assertLessEqual(max(queued), endpoint.limit)
+
+    def test_no_buffer_available_without_wakeup(self):
+        async def send():
+            await self.phy.send(EP_IN, b'filler')
+            await asyncio.sleep(0.05)
+        self._run(send())
+        self.assertEqual(self.device.offers, [])
+
+    def test_wakeup_offers_idle_endpoint(self):
+        self.phy.wakeup()
+        self._run(self._wait_until(lambda: self.device.offers))
+        self.assertEqual(self.device.offers, [EP_IN])
+
+    def test_no_fds_left(self):
+        fds = os.listdir('/proc/self/fd')
+        phy = AsyncGadgetFsPhy(FakeApp(), self.gadgetfs_dir)
+        phy.loop.close()
+        self.assertEqual(os.listdir('/proc/self/fd'), fds)
+
+    def test_disconnect_leaves_no_tasks(self):
+        async def start_receive():
+            receiving = asyncio.ensure_future(self.phy.receive(EP_OUT_QUEUED))
+            await asyncio.sleep(0.05)
+            return receiving
+        receiving = self._run(start_receive())
+        self._disconnect()
+        self.assertTrue(receiving.cancelled())
+        self.assertEqual(self.phy.endpoints, {})
+        self.assertEqual(asyncio.all_tasks(self.loop), set())
+
+
+class PollableEndpointsTest(AsyncGadgetFsPhyTests, unittest.TestCase):
+    pollable_endpoints = True
+
+
+class ExecutorEndpointsTest(AsyncGadgetFsPhyTests, unittest.TestCase):
+    pollable_endpoints = False
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -22,14 +22,15 @@ class USBBaseActor(object):
         self.str_dict = {}
         self.logger = logging.getLogger('umap2')
 
-    def send_on_endpoint(self, ep, data):
+    def send_on_endpoint(self, ep, data, more=False):
         '''
         Send data on a given endpoint
 
         :param ep: endpoint number
         :param data: data to send
+        :param more: more data of the same transfer follows (default: False)
         '''
-        self.phy.send_on_endpoint(ep, data)
+        self.phy.send_on_endpoint(ep, data, more)
 
     def usb_function_supported(self, reason=None):
         '''
@@ -253,7 +253,7 @@ class USBDevice(USBBaseActor):
             self.usb_function_supported('data received on endpoint %#x' % (ep_num))
             endpoint = self.endpoints[ep_num]
             if callable(endpoint.handler):
-                endpoint.handler(data)
+                return endpoint.handler(data)
 
     def handle_buffer_available(self, ep_num):
         if self.state == State.configured and ep_num in self.endpoints:
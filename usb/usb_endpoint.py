@@ -26,7 +26,7 @@ class USBEndpoint(USBBaseActor):
     def __init__(
             self, app, phy, number, direction, transfer_type, sync_type,
             usage_type, max_packet_size, interval, handler, cs_endpoints=None,
-            usb_class=None, usb_vendor=None):
+            usb_class=None, usb_vendor=None, transfer_size=None, zlp=False):
         '''
         :param app: umap2 application
         :param phy: physical connection
@@ -44,6 +44,14 @@ class USBEndpoint(USBBaseActor):
         :param cs_endpoints: list of class-specific endpoints (default: None)
         :param usb_class: USBClass instance (default: None)
         :param usb_vendor: USB device vendor (default: None)
+        :param transfer_size: length of the next OUT transfer, if known.
+            It is read at once and handed to the handler as a memoryview
+            that is only valid until the handler returns. Devices update
+            it as they learn what the host sends next (default: None,
+            read one packet at a time)
+        :param zlp: end IN transfers whose length is a multiple of the
+            max packet size with a zero length packet, for hosts that read
+            with larger buffers (default: False)
 
         .. note:: OUT endpoint is 1, IN endpoint is either 2 or 3
         '''
@@ -60,6 +68,8 @@ class USBEndpoint(USBBaseActor):
         self.usb_class = usb_class
         self.usb_vendor = usb_vendor
         self.cs_endpoints = [] if cs_endpoints is None else cs_endpoints
+        self.transfer_size = transfer_size
+        self.zlp = zlp
         self.address = (self.number & 0x0f) | (self.direction << 7)
 
         self.request_handlers = {